@@ -0,0 +1,391 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+
+import instrument
+from f135 import straighten_35mm_negative, get_35mm_strip_colors, get_straightened_shape, get_35mm_strip_geometry, \
+    get_35mm_negative_colors
+from frames import get_35mm_frame_rects, extract_frames, invert_frames, frame_path_for
+from invert import invert_negative, calc_inversion_params, create_inversion_lut, apply_lut, invert_negative_density
+from roll import create_roll_profile, save_roll_profile, load_roll_profile, create_roll_lut, roll_sample_strips
+from strip import find_sprocket_holes, find_strips
+from tiff import read_negative, create_tiff_memmap, write_tiff
+
+input_extensions = ('.tif', '.tiff')
+output_extension = '.tif'
+
+# Files submitted to the pool per worker, bounds the number of images held in memory
+in_flight_per_worker = 2
+
+
+def process_35mm_negative(negative, out=None, roll_profile=None, density=None):
+    """
+    Runs the whole pipeline: straightens the strip, computes the film base colors
+    and inverts the negative.
+
+    Straightening runs in low memory mode, everything after it works in place.
+
+    Supports any color depth.
+
+    :param negative: Original negative image.
+    :param out: Optional output buffer, see 'get_straightened_shape()'.
+    :param roll_profile: Optional RollProfile. If given, its inversion parameters are used
+        instead of computing the film base colors of this negative.
+    :param density: Optional output encoding, 'log' or 'linear'. If given, the negative is inverted
+        by its density, see 'invert_negative_density()'. Not supported together with a roll profile.
+    :return: Straight positive with border.
+    """
+    assert density is None or roll_profile is None, "Density inversion does not use roll profiles"
+
+    (rotated_negative, geometry) = straighten_35mm_negative(negative, return_geometry=True, low_memory=True, out=out)
+
+    if roll_profile is not None:
+        assert negative.dtype.name == roll_profile.dtype, \
+            "Roll profile is for {}, negative is {}".format(roll_profile.dtype, negative.dtype)
+
+        return apply_lut(rotated_negative, create_roll_lut(roll_profile))
+
+    (darkest_color, brightest_color) = get_35mm_strip_colors(rotated_negative, geometry=geometry)
+
+    if density is not None:
+        return invert_negative_density(rotated_negative, brightest_color, in_place=True, output=density)
+
+    return invert_negative(rotated_negative, darkest_color, brightest_color, in_place=True)
+
+
+def process_negative_frames(in_path, out_dir, workers=None):
+    """
+    Reads the negative, straightens it and writes every frame as positive.
+
+    Frames are views of the straightened negative, they are inverted and written by
+    a thread pool (see 'invert_frames()').
+
+    :param in_path: Path of negative.
+    :param out_dir: Output directory, frames are named like 'output_path_for()' plus frame number.
+    :param workers: Number of threads, defaults to the number of cores.
+    :return: List of written paths.
+    """
+    with instrument.stage('read'):
+        negative = read_negative(in_path)
+
+    (rotated_negative, geometry) = straighten_35mm_negative(negative, return_geometry=True, low_memory=True)
+    (darkest_color, brightest_color) = get_35mm_strip_colors(rotated_negative, geometry=geometry)
+
+    (color_correction, color_displacement, color_factor) = \
+        calc_inversion_params(darkest_color, brightest_color, rotated_negative.dtype)
+    lut = create_inversion_lut(color_correction, color_displacement, color_factor, rotated_negative.dtype)
+
+    frames = extract_frames(rotated_negative, get_35mm_frame_rects(rotated_negative, geometry))
+    paths = [frame_path_for(output_path_for(in_path, out_dir), i) for i in range(0, len(frames))]
+
+    def write(index, frame):
+        with instrument.stage('write'):
+            write_tiff(paths[index], frame, bgr=False)
+
+    os.makedirs(out_dir, exist_ok=True)
+    invert_frames(frames, lut, write, workers)
+
+    return paths
+
+
+def process_35mm_strips(negative, workers=None, on_strip=None, name=None):
+    """
+    Runs 'process_35mm_negative()' for every strip of a scan with several strips
+    (see 'find_strips()').
+
+    Strips are views of the negative and processed by a thread pool. OpenCV releases the GIL,
+    so the strips run in parallel. A strip that fails does not stop the others.
+
+    :param negative: Scan with one or more strips.
+    :param workers: Number of threads, defaults to the number of cores.
+    :param on_strip: Optional callback(index, positive), called within the thread of the strip,
+        e.g. to write it right away. Its errors count as errors of the strip.
+    :param name: Optional name of the scan. Stages of each strip are recorded for the image
+        'strip_path_for(name, index)', see 'instrument.image()'.
+    :return: List of tuples (rect, positive, error) per strip, see 'find_strips()' for rect. On
+        success error is None, otherwise positive is None and error the formatted exception.
+    """
+    rects = find_strips(negative)
+
+    def process(index):
+        (x1, y1, x2, y2) = rects[index]
+
+        # Image labels belong to a thread, so every strip gets its own
+        with instrument.image(strip_path_for(name, index) if name is not None else None):
+            try:
+                positive = process_35mm_negative(negative[y1:y2, x1:x2])
+
+                if on_strip is not None:
+                    on_strip(index, positive)
+
+                return rects[index], positive, None
+            except Exception:
+                return rects[index], None, traceback.format_exc()
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        return list(executor.map(process, range(0, len(rects))))
+
+
+def strip_path_for(path, index):
+    """
+    :param path: Path of the whole scan, e.g. 'out/scan.tif'.
+    :param index: Index of the strip.
+    :return: Path of the strip, e.g. 'out/scan_s01.tif'.
+    """
+    (root, ext) = os.path.splitext(path)
+    return '{}_s{:02d}{}'.format(root, index + 1, ext)
+
+
+def process_negative_strips(in_path, out_dir, workers=None):
+    """
+    Reads a scan with several strips, processes them in parallel (see 'process_35mm_strips()')
+    and writes every strip as positive.
+
+    :param in_path: Path of the scan.
+    :param out_dir: Output directory, strips are named like 'output_path_for()' plus strip number.
+    :param workers: Number of threads, defaults to the number of cores.
+    :return: List of tuples (out_path, error) per strip, error is None on success.
+    """
+    with instrument.stage('read'):
+        negative = read_negative(in_path)
+
+    out_path = output_path_for(in_path, out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    def write(index, positive):
+        with instrument.stage('write'):
+            write_tiff(strip_path_for(out_path, index), positive, bgr=False)
+
+    results = process_35mm_strips(negative, workers, write, in_path)
+
+    return [(strip_path_for(out_path, index), error) for (index, (_, _, error)) in enumerate(results)]
+
+
+def list_negatives(in_dir):
+    """
+    Lists all TIFF files within the given directory (not recursive), sorted by name.
+
+    :param in_dir: Directory to search.
+    :return: List of file paths.
+    """
+    names = sorted(os.listdir(in_dir))
+    return [
+        os.path.join(in_dir, name) for name in names
+        if name.lower().endswith(input_extensions) and os.path.isfile(os.path.join(in_dir, name))
+    ]
+
+
+def output_path_for(in_path, out_dir):
+    """
+    :param in_path: Path of negative.
+    :param out_dir: Output directory.
+    :return: Path the positive gets written to.
+    """
+    name = os.path.splitext(os.path.basename(in_path))[0]
+    return os.path.join(out_dir, name + output_extension)
+
+
+def sample_negative_colors(in_path):
+    """
+    Computes the film base colors of a negative for a roll profile. Only the sprocket holes are
+    detected and the border areas straightened, see 'get_35mm_negative_colors()'.
+
+    Errors are returned like in 'process_negative_file()'.
+
+    :param in_path: Path of negative.
+    :return: Tuple (in_path, colors, error, records). colors is a tuple (darkest_color, brightest_color, dtype).
+    """
+    colors = None
+    error = None
+
+    with instrument.image(in_path):
+        try:
+            with instrument.stage('read'):
+                negative = read_negative(in_path)
+
+            (top_holes, bottom_holes) = find_sprocket_holes(negative)
+            geometry = get_35mm_strip_geometry(negative.shape, top_holes, bottom_holes)
+
+            colors = get_35mm_negative_colors(negative, geometry) + (negative.dtype,)
+        except Exception:
+            error = traceback.format_exc()
+
+    return in_path, colors, error, instrument.take_records()
+
+
+def process_negative_file(in_path, out_path, roll_profile=None, density=None):
+    """
+    Reads the negative, processes it and writes the positive.
+
+    Uncompressed TIFFs are memory mapped instead of decoded (see 'tiff.read_negative()'), and the
+    positive is rendered straight into a memory mapped uncompressed TIFF. So no full size copy
+    of either image is held besides the mappings.
+
+    The result is written to a temporary file first and renamed afterwards. By that
+    an interrupted run never leaves a half written output that would be skipped on resume.
+
+    Errors are not raised but returned, so one broken scan does not stop the batch.
+
+    If instrumentation is enabled, the records of this file are returned too.
+
+    :param in_path: Path of negative.
+    :param out_path: Path of positive.
+    :param roll_profile: Optional RollProfile, see 'process_35mm_negative()'.
+    :param density: Optional density output encoding, see 'process_35mm_negative()'.
+    :return: Tuple (in_path, error, records). error is None on success, otherwise the formatted exception.
+    """
+    error = None
+    tmp_path = out_path + '.part' + output_extension
+
+    with instrument.image(in_path):
+        try:
+            with instrument.stage('read'):
+                negative = read_negative(in_path)
+
+            positive = create_tiff_memmap(tmp_path, get_straightened_shape(negative.shape), negative.dtype)
+
+            process_35mm_negative(negative, positive, roll_profile, density)
+
+            with instrument.stage('write'):
+                positive.flush()
+            del positive, negative
+            os.replace(tmp_path, out_path)
+        except Exception:
+            error = traceback.format_exc()
+
+            # Only complete outputs are renamed into place, a partial one is removed
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    return in_path, error, instrument.take_records()
+
+
+def _init_worker(profile=False):
+    # Pool already uses every core, OpenCV's own threads would only compete
+    cv2.setNumThreads(1)
+
+    if profile:
+        instrument.enable()
+
+
+def run_batch(in_dir, out_dir, workers=None, overwrite=False, on_done=None, records=None, roll_path=None,
+              roll_samples=None, density=None):
+    """
+    Processes all negatives of a directory with one process per core.
+
+    Only a limited number of files is submitted at once (see 'in_flight_per_worker'),
+    so memory usage stays flat no matter how many files the directory contains.
+    Files whose output already exists are skipped unless overwrite is set.
+
+    If a roll profile path is given, all negatives are inverted with the same parameters
+    (see 'roll.RollProfile'). An existing profile is loaded, otherwise it is merged from the
+    first negatives of the directory and saved. If none of them can be sampled, every negative
+    gets its own colors as usual.
+
+    :param in_dir: Directory with negatives.
+    :param out_dir: Directory for positives. Will be created if missing.
+    :param workers: Number of worker processes, defaults to the number of cores.
+    :param overwrite: If True, existing outputs are processed again.
+    :param on_done: Optional callback(in_path, error), called in this process for every finished file.
+    :param records: Optional list. If given, the workers are instrumented and all their
+        records are appended to it (see 'instrument.stage()').
+    :param roll_path: Optional path of a roll profile (JSON).
+    :param roll_samples: Number of negatives a new roll profile is merged from, defaults to 'roll_sample_strips'.
+    :param density: Optional density output encoding, see 'process_35mm_negative()'.
+        Not supported together with a roll profile.
+    :return: Tuple (processed, skipped, failed). failed is a list of (in_path, error).
+    """
+    assert density is None or roll_path is None, "Density inversion does not use roll profiles"
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    roll_profile = None
+    if roll_path is not None and os.path.exists(roll_path):
+        roll_profile = load_roll_profile(roll_path)
+
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * in_flight_per_worker
+
+    jobs = []
+    skipped = []
+    for in_path in list_negatives(in_dir):
+        out_path = output_path_for(in_path, out_dir)
+
+        if not overwrite and os.path.exists(out_path):
+            skipped.append(in_path)
+        else:
+            jobs.append((in_path, out_path))
+
+    processed = []
+    failed = []
+
+    profile = records is not None
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(profile,)) as executor:
+        if roll_path is not None and roll_profile is None:
+            # Sampled from all negatives, so a resumed run gets the same profile
+            samples = list_negatives(in_dir)[:roll_samples or roll_sample_strips]
+
+            roll_profile = _sample_roll_profile(executor, samples, records)
+            if roll_profile is not None:
+                save_roll_profile(roll_profile, roll_path)
+
+        pending = set()
+        jobs_iter = iter(jobs)
+
+        while True:
+            # Top up until limit is reached or no job is left
+            for job in jobs_iter:
+                pending.add(executor.submit(process_negative_file, *job, roll_profile, density))
+
+                if len(pending) >= max_in_flight:
+                    break
+
+            if len(pending) == 0:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                (in_path, error, file_records) = future.result()
+
+                if profile:
+                    records.extend(file_records)
+
+                if error is None:
+                    processed.append(in_path)
+                else:
+                    failed.append((in_path, error))
+
+                if on_done is not None:
+                    on_done(in_path, error)
+
+    return processed, skipped, failed
+
+
+def _sample_roll_profile(executor, paths, records=None):
+    strip_colors = []
+    strips = []
+    dtype = None
+
+    for (in_path, colors, error, file_records) in executor.map(sample_negative_colors, paths):
+        if records is not None:
+            records.extend(file_records)
+
+        if error is not None:
+            continue
+
+        # A profile only holds values of one color depth
+        dtype = dtype or colors[2]
+        if colors[2] == dtype:
+            strip_colors.append(colors[:2])
+            strips.append(os.path.basename(in_path))
+
+    if len(strip_colors) == 0:
+        return None
+
+    return create_roll_profile(strip_colors, dtype, strips)
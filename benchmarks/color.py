@@ -0,0 +1,121 @@
+"""
+Benchmark of the float32 color engine ('color.apply_levels()') against the inversion tables
+and the original int64 script.
+
+All methods run on one core on a stack of synthetic strips. Throughput is given in megapixels
+and in gigabytes (read plus write) per second. Equivalence to the tables is checked on the
+stack and on every possible input value: 'max diff' is the biggest difference of an output
+value, 'diff share' the share of output values that differ at all.
+
+Run from the repository root: python -m benchmarks.color
+"""
+import argparse
+
+import cv2
+import numpy as np
+
+import color
+from benchmarks.common import best_time, legacy_invert
+from benchmarks.synthetic import create_synthetic_strip
+from color import apply_levels, levels_from_inversion_params
+from invert import calc_inversion_params, invert_negatives, create_inversion_lut, apply_lut
+
+
+def _difference(result, expected):
+    diff = np.abs(result.astype(np.int64) - expected.astype(np.int64))
+    return diff.max(), np.count_nonzero(diff) / diff.size
+
+
+def check_all_values(darkest_color, brightest_color, dtype):
+    """
+    Compares the levels with the table on an image holding every value in every channel.
+
+    :return: Tuple (max diff, diff share).
+    """
+    max_val = np.iinfo(dtype).max
+    values = np.repeat(np.arange(max_val + 1, dtype=dtype), 3).reshape((1, -1, 3))
+
+    params = calc_inversion_params(darkest_color, brightest_color, dtype)
+    expected = apply_lut(values.copy(), create_inversion_lut(*params, dtype))
+
+    return _difference(apply_levels(values, levels_from_inversion_params(*params, dtype)), expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--strips', type=int, default=4, help='strips in the stack')
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--depths', type=int, nargs='+', default=[8, 16], choices=[8, 16])
+    parser.add_argument('--chunks', type=int, nargs='+', default=[64, 256, 1024, 16384],
+                        help='chunk sizes in KiB of the float32 buffer')
+    parser.add_argument('--gamma', type=float, default=2.2)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+
+    print("{:>5} {:>6} {:<26} {:>9} {:>8} {:>7} {:>9} {:>10}".format(
+        "depth", "MP", "method", "time [s]", "MP/s", "GB/s", "max diff", "diff share"
+    ))
+
+    for depth in args.depths:
+        dtype = np.uint8 if depth == 8 else np.uint16
+        max_val = np.iinfo(dtype).max
+
+        stack = np.stack([
+            create_synthetic_strip(args.width, dtype, angle=0, seed=seed) for seed in range(0, args.strips)
+        ])
+
+        # Colors like 'get_35mm_strip_colors()' returns them for the synthetic film base
+        darkest_color = (np.array([0.3, 0.42, 0.7]) * max_val).astype(dtype)
+        brightest_color = (np.array([0.35, 0.5, 0.8]) * max_val).astype(dtype)
+        params = calc_inversion_params(darkest_color, brightest_color, dtype)
+        levels = levels_from_inversion_params(*params, dtype)
+
+        megapixels = stack.shape[0] * stack.shape[1] * stack.shape[2] / 1e6
+        flat = stack.reshape((-1,) + stack.shape[2:])
+
+        (_, expected) = best_time(lambda: invert_negatives(stack, *params), 1)
+
+        methods = [
+            ('legacy int64 per image', 1,
+             lambda: np.stack([legacy_invert(strip, darkest_color, brightest_color) for strip in stack])),
+            ('table (invert_negatives)', args.repeat, lambda: invert_negatives(stack, *params)),
+        ]
+
+        default_chunk = color.color_chunk_bytes
+        for chunk_kib in args.chunks:
+            def run(chunk_bytes=chunk_kib * 1024):
+                color.color_chunk_bytes = chunk_bytes
+                try:
+                    return apply_levels(flat, levels).reshape(stack.shape)
+                finally:
+                    color.color_chunk_bytes = default_chunk
+
+            methods.append(('float32 levels {} KiB'.format(chunk_kib), args.repeat, run))
+
+        for (name, repeat, func) in methods:
+            (seconds, result) = best_time(func, repeat)
+            (max_diff, share) = _difference(result, expected)
+
+            print("{:>5} {:>6.1f} {:<26} {:>9.4f} {:>8.1f} {:>7.2f} {:>9} {:>10.2e}".format(
+                depth, megapixels, name, seconds, megapixels / seconds, 2 * stack.nbytes / seconds / 1e9,
+                max_diff, share
+            ))
+
+        # Gamma has no table to compare with
+        gamma_levels = levels._replace(gamma=args.gamma)
+        (seconds, _) = best_time(lambda: apply_levels(flat, gamma_levels), args.repeat)
+        print("{:>5} {:>6.1f} {:<26} {:>9.4f} {:>8.1f} {:>7.2f}".format(
+            depth, megapixels, 'float32 levels gamma {:g}'.format(args.gamma), seconds, megapixels / seconds,
+            2 * stack.nbytes / seconds / 1e9
+        ))
+
+        (max_diff, share) = check_all_values(darkest_color, brightest_color, dtype)
+        print("{:>5} {:>6} {:<26} {:>9} {:>8} {:>7} {:>9} {:>10.2e}".format(
+            depth, '', 'all values check', '', '', '', max_diff, share
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark of 'get_k_colors()' against the previous full k-means on 16bit border ROIs.
+
+The previous version converted every pixel of the ROI to float32 and ran k-means
+with random centers. The ROIs are synthetic film base areas: two base colors
+(e.g. exposed and unexposed border) with noise.
+
+Run from the repository root: python -m benchmarks.colors
+"""
+import argparse
+
+import numpy as np
+
+from benchmarks.common import best_time, legacy_get_k_colors
+from util import get_k_colors, sort_colors_by_brightness
+
+
+def create_roi(width, height, dtype=np.uint16, seed=0):
+    """
+    :param width: ROI width.
+    :param height: ROI height.
+    :param dtype: uint8 or uint16.
+    :param seed: Random seed.
+    :return: BGR view into a bigger image, like the ROIs of 'get_35mm_strip_colors()'.
+    """
+    rng = np.random.RandomState(seed)
+    max_val = np.iinfo(dtype).max
+
+    img = np.empty((height + 20, width + 20, 3), dtype=np.float32)
+    img[:] = np.array([0.35, 0.5, 0.8]) * max_val
+    img[:, (width + 20) // 3:] = np.array([0.3, 0.42, 0.7]) * max_val
+    img += rng.normal(0, 0.01 * max_val, img.shape)
+
+    img = np.clip(img, 0, max_val).astype(dtype)
+
+    return img[10:10 + height, 10:10 + width]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', default=['1000x40', '3000x100', '6000x150', '8000x250'],
+                        help='ROI sizes as WIDTHxHEIGHT')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:>10} {:>10} {:>12} {:>12} {:>8} {:>10} {:>13}".format(
+        "roi", "pixels", "current [s]", "legacy [s]", "speedup", "max diff", "deterministic"
+    ))
+
+    for size in args.sizes:
+        (width, height) = map(int, size.split('x'))
+        roi = create_roi(width, height)
+
+        (t_current, colors) = best_time(lambda: sort_colors_by_brightness(get_k_colors(roi, 2)), args.repeat)
+        (t_legacy, legacy_colors) = best_time(lambda: sort_colors_by_brightness(legacy_get_k_colors(roi, 2)), 1)
+
+        deterministic = all(
+            np.array_equal(a, b) for a, b in zip(colors, sort_colors_by_brightness(get_k_colors(roi, 2)))
+        )
+        max_diff = max(np.abs(a.astype(np.int64) - b).max() for a, b in zip(colors, legacy_colors))
+
+        print("{:>10} {:>10} {:>12.4f} {:>12.4f} {:>7.1f}x {:>10} {:>13}".format(
+            size, width * height, t_current, t_legacy, t_legacy / t_current, max_diff, str(deterministic)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Helpers shared by the benchmarks: timing, and the previous implementations the current
+code is compared with. The grouping references live in 'tests/legacy.py', the tests use them too.
+"""
+import math
+import time
+
+import cv2
+import numpy as np
+
+from util import calc_white_balance_diff
+
+
+def best_time(func, repeat):
+    """
+    :param func: Function without arguments.
+    :param repeat: Number of runs.
+    :return: Tuple (best time in seconds, result of the last run).
+    """
+    best = math.inf
+    result = None
+    for i in range(0, repeat):
+        t_start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t_start)
+
+    return best, result
+
+
+def legacy_invert(negative, darkest_color, brightest_color):
+    # As in the original main.py
+    wb_negative = negative.copy()
+
+    color_correction = -calc_white_balance_diff(brightest_color)
+
+    before_type = wb_negative.dtype
+    wb_negative = wb_negative.astype(dtype=np.int64)
+    wb_negative[:, :] += color_correction
+    wb_negative = np.clip(wb_negative, 0, np.iinfo(before_type).max)
+    wb_negative = wb_negative.astype(dtype=before_type)
+
+    wb_negative = cv2.bitwise_not(wb_negative)
+
+    max_val = np.iinfo(wb_negative.dtype).max
+    pos_brightest_color = max_val - (darkest_color + color_correction)
+    pos_darkest_color = max_val - (brightest_color + color_correction)
+
+    color_displacement = np.mean(pos_darkest_color) * 1.15
+    color_factor = max_val / (np.mean(pos_brightest_color) - color_displacement) * 0.7
+
+    before_type = wb_negative.dtype
+    wb_negative = wb_negative.astype(dtype=np.int64)
+
+    wb_negative[:, :] = (wb_negative[:, :] - color_displacement)
+    wb_negative = np.clip(wb_negative, 0, np.iinfo(before_type).max)
+
+    wb_negative[:, :] = wb_negative[:, :] * color_factor
+    wb_negative = np.clip(wb_negative, 0, np.iinfo(before_type).max)
+
+    return wb_negative.astype(dtype=before_type)
+
+
+def legacy_get_k_colors(img, k):
+    # Full k-means on every pixel with random centers, before 'get_k_colors()' subsampled
+    data = np.float32(img.reshape((-1, 3)))
+    iterations = 10
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 1.0)
+    ret, label, center = cv2.kmeans(data, k, None, criteria, iterations, cv2.KMEANS_RANDOM_CENTERS)
+
+    return list(map(lambda col: np.array([col[0], col[1], col[2]], dtype=img.dtype), center))
+
+
+def legacy_sort_colors_by_brightness(colors):
+    # As before the packed helpers
+    def color_weight(col):
+        f_col = np.float32(col)
+        return f_col[0] + f_col[1] + f_col[2]
+
+    col_and_avgs = list(map(lambda col: (col, color_weight(col)), colors))
+    sorted_cols = sorted(col_and_avgs, key=lambda tup: tup[1])
+
+    return list(map(lambda tup: tup[0], sorted_cols))
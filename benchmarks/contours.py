@@ -0,0 +1,116 @@
+"""
+Benchmark of the packed contour helpers (one points array plus offsets, see 'pack_contours()')
+against the per contour helpers.
+
+The contours are sprocket holes of many strips (rounded rectangles as found by
+cv2.findContours), the line fits run per strip and row like 'contours_top_line()'.
+Packing is included in the packed timings.
+
+Run from the repository root: python -m benchmarks.contours
+"""
+import argparse
+
+import cv2
+import numpy as np
+
+from benchmarks.common import best_time, legacy_sort_colors_by_brightness
+from util import SprocketHole, create_sprocket_holes, pack_contours, packed_contours_extremes, \
+    packed_contours_moments, packed_fit_lines, contour_top, contour_bottom, contour_left, contour_right, \
+    contours_centers, points_to_line, sort_colors_by_brightness
+
+hole_pitch = 57
+hole_size = (38, 26)
+row_distance = 600
+
+
+def create_hole_contours(strips, holes, seed=0):
+    """
+    :param strips: Number of strips.
+    :param holes: Holes per row.
+    :param seed: Random seed for the small position jitter.
+    :return: List of rows, each a list of int32 contours sorted left to right.
+    """
+    rng = np.random.RandomState(seed)
+    (w, h) = hole_size
+
+    # One rounded hole, found like in 'get_sprocket_holes_contours()'
+    img = np.zeros((h + 20, w + 20), dtype=np.uint8)
+    cv2.rectangle(img, (10 + 4, 10), (10 + w - 4, 10 + h), 255, -1)
+    cv2.rectangle(img, (10, 10 + 4), (10 + w, 10 + h - 4), 255, -1)
+    for (cx, cy) in ((14, 14), (6 + w, 14), (14, 6 + h), (6 + w, 6 + h)):
+        cv2.circle(img, (cx, cy), 4, 255, -1)
+    (contours, _) = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    hole = contours[0]
+
+    rows = []
+    for strip in range(0, strips):
+        for row in range(0, 2):
+            y = strip * 2 * row_distance + row * row_distance
+            rows.append([
+                hole + np.array([i * hole_pitch + rng.randint(0, 3), y + rng.randint(0, 3)], dtype=np.int32)
+                for i in range(0, holes)
+            ])
+
+    return rows
+
+
+def _packed_top_lines(rows):
+    (points, offsets) = pack_contours([contour for row in rows for contour in row])
+    (tops, _, _, _) = packed_contours_extremes(points, offsets)
+
+    row_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=row_offsets[1:])
+
+    return packed_fit_lines(tops, row_offsets)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--strips', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--holes', type=int, default=40, help='sprocket holes per row')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print("{:>7} {:>9} {:<18} {:>12} {:>12} {:>8} {:>6}".format(
+        "strips", "contours", "helper", "current [s]", "packed [s]", "speedup", "equal"
+    ))
+
+    for strips in args.strips:
+        rows = create_hole_contours(strips, args.holes)
+        contours = [contour for row in rows for contour in row]
+        colors = [np.array(color, dtype=np.uint16) for color in np.random.RandomState(0).randint(0, 65536, (100, 3))]
+
+        def current_extremes():
+            return [np.array([f(contour) for contour in contours]) for f in
+                    (contour_top, contour_bottom, contour_left, contour_right)]
+
+        def current_holes():
+            return [SprocketHole(contour) for contour in contours]
+
+        cases = [
+            ('extremes', current_extremes, lambda: packed_contours_extremes(*pack_contours(contours)),
+             lambda a, b: all(np.array_equal(x, y) for (x, y) in zip(a, b))),
+            ('centers', lambda: contours_centers(contours), lambda: packed_contours_moments(*pack_contours(contours))[1],
+             lambda a, b: np.allclose(a, b, rtol=0, atol=1e-9)),
+            ('top lines', lambda: [points_to_line([contour_top(c) for c in row]) for row in rows],
+             lambda: _packed_top_lines(rows),
+             lambda a, b: np.allclose(a, b, rtol=1e-9, atol=1e-6)),
+            ('sprocket holes', current_holes, lambda: create_sprocket_holes(contours),
+             lambda a, b: all(np.allclose(x.center, y.center, rtol=0, atol=1e-9) and
+                              np.array_equal(x.top, y.top) and np.array_equal(x.left, y.left) for (x, y) in zip(a, b))),
+            ('sort colors', lambda: legacy_sort_colors_by_brightness(colors),
+             lambda: sort_colors_by_brightness(colors),
+             lambda a, b: all(x is y for (x, y) in zip(a, b))),
+        ]
+
+        for (name, current, packed, equal) in cases:
+            (t_current, expected) = best_time(current, args.repeat)
+            (t_packed, result) = best_time(packed, args.repeat)
+
+            print("{:>7} {:>9} {:<18} {:>12.5f} {:>12.5f} {:>7.1f}x {:>6}".format(
+                strips, len(contours), name, t_current, t_packed, t_current / t_packed, str(equal(expected, result))
+            ))
+
+
+if __name__ == '__main__':
+    main()
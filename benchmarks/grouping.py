@@ -0,0 +1,44 @@
+"""
+Benchmark of 'group_contours_by_distance()' for growing numbers of contours.
+
+The contours are laid out like several strips with two rows of sprocket holes each,
+plus some randomly placed dust (see 'tests/legacy.py'). The previous implementation (one
+cv2.moments call per candidate and query) runs as reference for the smaller sizes.
+
+Run from the repository root: python -m benchmarks.grouping
+"""
+import argparse
+
+from benchmarks.common import best_time
+from tests.legacy import create_contours, legacy_group_contours_by_distance
+from util import group_contours_by_distance
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--counts', type=int, nargs='+', default=[100, 500, 1000, 2000, 5000])
+    parser.add_argument('--legacy-max', type=int, default=1000, help='largest count the old version runs for')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:>8} {:>8} {:>12} {:>12} {:>8}".format("contours", "groups", "current [s]", "legacy [s]", "speedup"))
+
+    for count in args.counts:
+        contours = create_contours(count)
+
+        (t_current, groups) = best_time(lambda: group_contours_by_distance(contours, 2), args.repeat)
+
+        legacy = ""
+        speedup = ""
+        if count <= args.legacy_max:
+            (t_legacy, legacy_groups) = best_time(lambda: legacy_group_contours_by_distance(contours, 2), 1)
+            assert [len(g) for g in legacy_groups] == [len(g) for g in groups], "Grouping differs from legacy"
+
+            legacy = "{:.4f}".format(t_legacy)
+            speedup = "{:.1f}x".format(t_legacy / t_current)
+
+        print("{:>8} {:>8} {:>12.4f} {:>12} {:>8}".format(len(contours), len(groups), t_current, legacy, speedup))
+
+
+if __name__ == '__main__':
+    main()
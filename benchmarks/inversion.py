@@ -0,0 +1,113 @@
+"""
+Benchmark of the inversion (white balance, inversion and contrast) on a stack of strips.
+
+Compared are the original per image script (int64 arithmetic, several full size temporaries),
+'invert_negative()' per strip and 'invert_negatives()' on the whole stack. All run on one
+core. Throughput is given in megapixels and in gigabytes (read plus write) per second.
+
+The density inversion ('invert_negative_density()', log and linear output) is compared with
+the same computation done by float64 log10/power arithmetic on the whole image, 'max diff' is
+its biggest deviation.
+
+Run from the repository root: python -m benchmarks.inversion
+"""
+import argparse
+
+import cv2
+import numpy as np
+
+from benchmarks.common import best_time, legacy_invert
+from benchmarks.synthetic import create_synthetic_strip
+from invert import calc_inversion_params, invert_negative, invert_negatives, invert_negative_density, \
+    calc_density_params
+
+
+def _direct_density_invert(negative, base_color, output):
+    # Density inversion without tables, same parameters
+    max_val = np.iinfo(negative.dtype).max
+    (base_density, white_density) = calc_density_params(negative, base_color)
+
+    density = -np.log10(np.maximum(negative, 0.5) / max_val) - base_density
+    if output == 'linear':
+        positive = (np.power(10.0, density) - 1) * (max_val / (np.power(10.0, white_density) - 1))
+    else:
+        positive = density * (max_val / white_density)
+
+    return np.clip(np.round(positive), 0, max_val).astype(negative.dtype)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--strips', type=int, default=4, help='strips in the stack')
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--depths', type=int, nargs='+', default=[8, 16], choices=[8, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+
+    print("{:>5} {:>6} {:<22} {:>9} {:>8} {:>7} {:>8} {:>6}".format(
+        "depth", "MP", "method", "time [s]", "MP/s", "GB/s", "speedup", "equal"
+    ))
+
+    for depth in args.depths:
+        dtype = np.uint8 if depth == 8 else np.uint16
+        max_val = np.iinfo(dtype).max
+
+        stack = np.stack([
+            create_synthetic_strip(args.width, dtype, angle=0, seed=seed) for seed in range(0, args.strips)
+        ])
+
+        # Colors like 'get_35mm_strip_colors()' returns them for the synthetic film base
+        darkest_color = (np.array([0.3, 0.42, 0.7]) * max_val).astype(dtype)
+        brightest_color = (np.array([0.35, 0.5, 0.8]) * max_val).astype(dtype)
+        params = calc_inversion_params(darkest_color, brightest_color, dtype)
+
+        megapixels = stack.shape[0] * stack.shape[1] * stack.shape[2] / 1e6
+
+        (t_legacy, expected) = best_time(
+            lambda: np.stack([legacy_invert(strip, darkest_color, brightest_color) for strip in stack]), 1
+        )
+
+        methods = [
+            ('legacy int64 per image', t_legacy, expected),
+            ('invert_negative', *best_time(
+                lambda: np.stack([invert_negative(strip, darkest_color, brightest_color) for strip in stack]),
+                args.repeat
+            )),
+            ('invert_negatives stack', *best_time(lambda: invert_negatives(stack, *params), args.repeat)),
+        ]
+
+        # In place avoids the copy of the input, so only the table lookups are timed
+        #  > first run is checked, repeated runs invert the result again which takes the same time
+        work = stack.copy()
+        in_place_result = invert_negatives(work, *params, in_place=True).copy()
+        (t_in_place, _) = best_time(lambda: invert_negatives(work, *params, in_place=True), args.repeat)
+        methods.append(('  in place', t_in_place, in_place_result))
+
+        for (name, seconds, result) in methods:
+            print("{:>5} {:>6.1f} {:<22} {:>9.4f} {:>8.1f} {:>7.2f} {:>7.1f}x {:>6}".format(
+                depth, megapixels, name, seconds, megapixels / seconds, 2 * stack.nbytes / seconds / 1e9,
+                t_legacy / seconds, str(np.array_equal(result, expected))
+            ))
+
+        # Density inversion, the brightest color is the film base
+        for output in ('log', 'linear'):
+            (t_direct, density_expected) = best_time(
+                lambda: np.stack([_direct_density_invert(strip, brightest_color, output) for strip in stack]), 1
+            )
+            (t_density, density_result) = best_time(
+                lambda: np.stack([invert_negative_density(strip, brightest_color, output=output) for strip in stack]),
+                args.repeat
+            )
+            max_diff = np.abs(density_result.astype(np.int64) - density_expected.astype(np.int64)).max()
+
+            for (name, seconds, note) in (('density {} direct'.format(output), t_direct, ''),
+                                          ('density {} table'.format(output), t_density, 'diff {}'.format(max_diff))):
+                print("{:>5} {:>6.1f} {:<22} {:>9.4f} {:>8.1f} {:>7.2f} {:>7.1f}x {:>6}".format(
+                    depth, megapixels, name, seconds, megapixels / seconds, 2 * stack.nbytes / seconds / 1e9,
+                    t_legacy / seconds, note
+                ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""
+Benchmark suite: times the pipeline on synthetic strips and the bundled fixtures.
+
+Every case runs in its own process, reading its image from a TIFF like a real scan
+(memory mapped where possible, like 'batch' does),
+so the reported peak RSS belongs to that case only. Timed are 'straighten_35mm_negative()',
+'get_35mm_strip_colors()' and the inversion, each as best of several runs.
+
+The startup time of the command line is tracked too (see 'startup_commands'), each command
+in a fresh interpreter.
+
+Results can be saved as JSON and compared to an earlier run:
+
+    python -m benchmarks.suite --save before.json
+    ... change something ...
+    python -m benchmarks.suite --compare before.json
+
+Run from the repository root.
+"""
+import argparse
+import glob
+import itertools
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Relative slowdown reported as regression when comparing
+regression_threshold = 0.1
+
+fixtures_pattern = os.path.join('images', 'test_*.tiff')
+
+# Commands whose startup is timed, name -> arguments of the python interpreter
+#  > help and invalid arguments must not load OpenCV, import loads all processing modules
+startup_commands = {
+    'startup_help': ['main.py', '--help'],
+    'startup_invalid_args': ['main.py', 'batch', os.path.join('missing', 'dir'), 'out'],
+    'startup_import_all': ['-c', 'import batch, pipeline, preview, watch'],
+}
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(path, repeat):
+    """
+    Runs one case, meant to be called in a fresh process.
+
+    :param path: Path of the negative.
+    :param repeat: Runs per stage, the best time is taken.
+    :return: Dict with megapixels, stage times in seconds, megapixels per second and peak RSS.
+    """
+    from benchmarks.common import best_time
+    from f135 import straighten_35mm_negative, get_35mm_strip_colors
+    from invert import invert_negative
+    from tiff import read_negative
+
+    negative = read_negative(path)
+
+    (t_straighten, (rotated, geometry)) = best_time(
+        lambda: straighten_35mm_negative(negative, return_geometry=True), repeat
+    )
+    (t_colors, (darkest, brightest)) = best_time(lambda: get_35mm_strip_colors(rotated), repeat)
+    (t_colors_geometry, _) = best_time(lambda: get_35mm_strip_colors(rotated, geometry=geometry), repeat)
+    (t_invert, _) = best_time(lambda: invert_negative(rotated, darkest, brightest), repeat)
+
+    megapixels = negative.shape[0] * negative.shape[1] / 1e6
+    total = t_straighten + t_colors_geometry + t_invert
+
+    return {
+        'megapixels': megapixels,
+        'straighten': t_straighten,
+        'colors': t_colors,
+        'colors_geometry': t_colors_geometry,
+        'invert': t_invert,
+        'total': total,
+        'mp_per_s': megapixels / total,
+        'peak_rss': _peak_rss_bytes()
+    }
+
+
+def synthetic_cases(widths, depths, angles, holes):
+    """
+    :return: List of (name, kwargs for 'create_synthetic_strip()').
+    """
+    cases = []
+    for (width, depth, angle, hole_count) in itertools.product(widths, depths, angles, holes):
+        name = 'synthetic_w{}_{}bit_a{:g}_h{}'.format(width, depth, angle, hole_count)
+        cases.append((name, {'width': width, 'depth': depth, 'angle': angle, 'sprocket_holes': hole_count}))
+
+    return cases
+
+
+def run_suite(cases, fixtures, repeat):
+    """
+    Runs all synthetic cases and fixtures, one process per case.
+
+    :param cases: Synthetic cases, see 'synthetic_cases()'.
+    :param fixtures: Paths of fixture images.
+    :param repeat: Runs per stage.
+    :return: Dict case name -> result (see 'run_case()') or {'error': message}.
+    """
+    import numpy as np
+
+    from benchmarks.synthetic import create_synthetic_strip
+    from tiff import write_tiff
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        jobs = [(os.path.splitext(os.path.basename(path))[0], path) for path in fixtures]
+
+        for (name, kwargs) in cases:
+            kwargs = dict(kwargs)
+            dtype = np.uint8 if kwargs.pop('depth') == 8 else np.uint16
+
+            path = os.path.join(tmp_dir, name + '.tif')
+            write_tiff(path, create_synthetic_strip(dtype=dtype, **kwargs))
+            jobs.append((name, path))
+
+        for (name, path) in jobs:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    results[name] = executor.submit(run_case, path, repeat).result()
+                except Exception as e:
+                    results[name] = {'error': repr(e)}
+
+            print_result(name, results[name])
+
+    return results
+
+
+def run_startup(repeat):
+    """
+    Times the commands of 'startup_commands', each in a new interpreter.
+
+    :param repeat: Runs per command, the best time is taken.
+    :return: Dict name -> {'total': seconds} or {'error': message}.
+    """
+    results = {}
+
+    for (name, arguments) in startup_commands.items():
+        best = math.inf
+        for i in range(0, repeat):
+            t_start = time.perf_counter()
+            exit_code = subprocess.call([sys.executable] + arguments, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+            best = min(best, time.perf_counter() - t_start)
+
+            # Usage errors exit with 2 and are expected for invalid arguments
+            if exit_code not in (0, 2):
+                best = None
+                break
+
+        # No peak RSS: Linux keeps the one of the forking process for the started one
+        results[name] = {'error': 'exit code {}'.format(exit_code)} if best is None else {'total': best}
+
+        print_startup(name, results[name])
+
+    return results
+
+
+def print_startup(name, result):
+    if 'error' in result:
+        print("{:<44} {}".format(name, result['error']))
+        return
+
+    print("{:<44} {:>10.4f}".format(name, result['total']), flush=True)
+
+
+def print_header():
+    print("{:<44} {:>6} {:>10} {:>10} {:>10} {:>10} {:>8} {:>9}".format(
+        "case", "MP", "straight.", "colors", "col.+geo", "invert", "MP/s", "RSS [MB]"
+    ))
+
+
+def print_result(name, result):
+    if 'error' in result:
+        print("{:<44} {}".format(name, result['error']))
+        return
+
+    print("{:<44} {:>6.1f} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f} {:>8.1f} {:>9.0f}".format(
+        name, result['megapixels'], result['straighten'], result['colors'], result['colors_geometry'],
+        result['invert'], result['mp_per_s'], result['peak_rss'] / 1e6
+    ), flush=True)
+
+
+def compare(results, baseline):
+    """
+    Prints the relative change of total time and peak RSS per case.
+
+    :param results: Current results.
+    :param baseline: Earlier results.
+    :return: List of case names that got slower by more than 'regression_threshold'.
+    """
+    regressions = []
+
+    print("\n{:<44} {:>10} {:>10} {:>10} {:>10}".format("case", "base [s]", "now [s]", "time", "RSS"))
+
+    for name in sorted(set(results) & set(baseline)):
+        (now, base) = (results[name], baseline[name])
+        if 'error' in now or 'error' in base:
+            continue
+
+        time_change = now['total'] / base['total'] - 1
+        rss_change = now['peak_rss'] / base['peak_rss'] - 1 if 'peak_rss' in now and 'peak_rss' in base else None
+
+        flag = ''
+        if time_change > regression_threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+
+        print("{:<44} {:>10.4f} {:>10.4f} {:>+9.1%} {:>10}{}".format(
+            name, base['total'], now['total'], time_change, '' if rss_change is None else format(rss_change, '+.1%'),
+            flag
+        ))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--widths', type=int, nargs='+', default=[2000, 6000])
+    parser.add_argument('--depths', type=int, nargs='+', default=[8, 16], choices=[8, 16])
+    parser.add_argument('--angles', type=float, nargs='+', default=[1.5])
+    parser.add_argument('--holes', type=int, nargs='+', default=[40], help='sprocket holes per row')
+    parser.add_argument('--no-fixtures', action='store_true', help='skip the bundled fixture images')
+    parser.add_argument('--no-startup', action='store_true', help='skip the startup times of the command line')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, best time counts')
+    parser.add_argument('--save', metavar='PATH', help='save results as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='compare with saved results')
+    args = parser.parse_args()
+
+    cases = synthetic_cases(args.widths, args.depths, args.angles, args.holes)
+    fixtures = [] if args.no_fixtures else sorted(glob.glob(fixtures_pattern))
+
+    print_header()
+    results = run_suite(cases, fixtures, args.repeat)
+
+    if not args.no_startup:
+        print("\n{:<44} {:>10}".format("startup", "time [s]"))
+        results.update(run_startup(args.repeat))
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({'platform': platform.platform(), 'python': platform.python_version(), 'results': results},
+                      file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+
+        if len(compare(results, baseline)) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Synthetic 35mm negative strips for benchmarks.
+
+A strip lies on white background (like a scan with backlight around the film) and
+has the orange film base, two rows of sprocket holes and darker frames. It gets
+rotated and noise is added.
+"""
+import cv2
+import numpy as np
+
+# Film dimensions in mm
+film_height = 35.0
+hole_pitch = 4.75
+hole_width = 1.98
+hole_height = 2.79
+hole_edge_distance = 2.0
+frame_width = 36.0
+frame_height = 24.0
+frame_pitch = 38.0
+
+# Background around the strip in mm
+margin = 6.0
+
+# Film base color relative to max value (BGR)
+base_color = (0.35, 0.5, 0.8)
+
+
+def create_synthetic_strip(width=6000, dtype=np.uint16, angle=1.0, sprocket_holes=40, noise=0.01, seed=0):
+    """
+    Creates a synthetic 35mm strip scan.
+
+    The height follows from the width and the strip length (given by the number of holes per row).
+
+    :param width: Image width in pixels.
+    :param dtype: uint8 or uint16.
+    :param angle: Rotation of the strip in degrees.
+    :param sprocket_holes: Number of sprocket holes per row.
+    :param noise: Standard deviation of the noise relative to max value.
+    :param seed: Random seed.
+    :return: BGR image.
+    """
+    rng = np.random.RandomState(seed)
+    max_val = np.iinfo(dtype).max
+
+    length = sprocket_holes * hole_pitch
+    px_per_mm = width / (length + 2 * margin)
+    height = int(round((film_height + 2 * margin) * px_per_mm))
+
+    def px(mm):
+        return int(round(mm * px_per_mm))
+
+    img = np.full((height, width, 3), max_val, dtype=np.float32)
+
+    base = np.array(base_color) * max_val
+    cv2.rectangle(img, (px(margin), px(margin)), (px(margin + length), px(margin + film_height)), base.tolist(), -1)
+
+    # Frames with some low frequency content
+    frame_top = margin + (film_height - frame_height) / 2
+    frame_left = margin + 1.0
+    while frame_left + frame_width < margin + length:
+        (x1, y1) = (px(frame_left), px(frame_top))
+        (x2, y2) = (px(frame_left + frame_width), px(frame_top + frame_height))
+
+        content = rng.uniform(0.3, 1.0, (6, 9, 3)).astype(np.float32)
+        content = cv2.resize(content, (x2 - x1, y2 - y1), interpolation=cv2.INTER_CUBIC)
+        img[y1:y2, x1:x2] = base * np.clip(content, 0.2, 1.0)
+
+        frame_left += frame_pitch
+
+    for i in range(0, sprocket_holes):
+        cx = margin + (i + 0.5) * hole_pitch
+        for cy in (margin + hole_edge_distance + hole_height / 2,
+                   margin + film_height - hole_edge_distance - hole_height / 2):
+            pt1 = (px(cx - hole_width / 2), px(cy - hole_height / 2))
+            pt2 = (px(cx + hole_width / 2), px(cy + hole_height / 2))
+            cv2.rectangle(img, pt1, pt2, (max_val,) * 3, -1)
+
+    m_rot = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    img = cv2.warpAffine(img, m_rot, (width, height), borderValue=(max_val,) * 3)
+
+    # Row chunks keep the float64 noise small
+    for y in range(0, height, 256):
+        block = img[y:y + 256]
+        block += rng.normal(0, noise * max_val, block.shape).astype(np.float32)
+
+    return np.clip(img, 0, max_val).astype(dtype)
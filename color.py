@@ -0,0 +1,129 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from instrument import instrumented
+from invert import calc_inversion_params
+
+# Size of the float32 working buffer, rows are converted in chunks of this size so the
+# buffer stays in the L2 cache between the steps (see benchmarks/color.py)
+color_chunk_bytes = 1024 * 1024
+
+# Parameters of 'apply_levels()', per channel in the channel order of the image
+#  > color_correction: white balance offset added to the negative, see 'calc_inversion_params()'
+#  > black_point, white_point: values of the inverted image that become black and white
+#  > gamma: optional gamma of the output curve (output = normalized ** (1 / gamma)), None is linear
+Levels = namedtuple('Levels', ['color_correction', 'black_point', 'white_point', 'gamma'])
+
+
+def levels_from_inversion_params(color_correction, color_displacement, color_factor, dtype, gamma=None):
+    """
+    Translates the parameters of 'calc_inversion_params()' into levels.
+
+    The table of 'create_inversion_lut()' truncates after subtracting the displacement, which
+    equals an integral black point. So without gamma, 'apply_levels()' gives the same output
+    as the table up to float32 rounding of the stretch (at most 1).
+
+    :param color_correction: Per channel white balance offset.
+    :param color_displacement: Displacement subtracted after inversion.
+    :param color_factor: Contrast stretch factor.
+    :param dtype: Image dtype (uint8 or uint16).
+    :param gamma: Optional gamma.
+    :return: Levels.
+    """
+    max_val = np.iinfo(dtype).max
+
+    black_point = math.ceil(color_displacement)
+    white_point = black_point + max_val / color_factor
+
+    return Levels(
+        tuple(int(c) for c in color_correction),
+        (float(black_point),) * 3,
+        (float(white_point),) * 3,
+        gamma
+    )
+
+
+def create_levels(darkest_color, brightest_color, dtype, gamma=None):
+    """
+    Computes the levels of the film base colors, like 'invert_negative()' does.
+
+    :param darkest_color: Darkest film base color.
+    :param brightest_color: Brightest film base color.
+    :param dtype: Image dtype (uint8 or uint16).
+    :param gamma: Optional gamma.
+    :return: Levels.
+    """
+    return levels_from_inversion_params(*calc_inversion_params(darkest_color, brightest_color, dtype), dtype, gamma)
+
+
+@instrumented
+def apply_levels(negative, levels, in_place=False):
+    """
+    Inverts the negative with float32 arithmetic: white balance, inversion, per channel black
+    and white point and an optional gamma curve. Alternative to the tables of 'invert.py',
+    e.g. for per channel points or gamma which the tables do not cover.
+
+    Rows are converted in chunks of 'color_chunk_bytes'. The channels stay interleaved: the per
+    channel values are repeated along a whole row, so every step runs over contiguous memory
+    with plain vector instructions.
+
+    Supports uint8 and uint16.
+
+    :param negative: Straightened negative (BGR or RGB, like the levels).
+    :param levels: Levels, see 'create_levels()'.
+    :param in_place: If True, the given image will be overwritten.
+    :return: Positive image.
+    """
+    dtype = negative.dtype
+    max_val = np.iinfo(dtype).max
+
+    positive = negative if in_place else np.empty_like(negative)
+
+    (h, w) = negative.shape[:2]
+    row_length = w * 3
+
+    black_point = np.array(levels.black_point, dtype=np.float64)
+    white_point = np.array(levels.white_point, dtype=np.float64)
+    assert np.all(white_point > black_point), "White point must be above black point"
+
+    # Per channel values along a row
+    #  > inverted - black point = (max_val - black point) - clip(negative + color correction)
+    correction = np.tile(np.array(levels.color_correction, dtype=np.float32), w)
+    offset = np.tile((max_val - black_point).astype(np.float32), w)
+    stretch = np.tile((max_val / (white_point - black_point)).astype(np.float32), w)
+
+    chunk_rows = max(1, color_chunk_bytes // (row_length * 4))
+    buffer = np.empty((chunk_rows, row_length), dtype=np.float32)
+
+    packed = negative.strides[1:] == (3 * negative.itemsize, negative.itemsize)
+
+    for y in range(0, h, chunk_rows):
+        block = negative[y:y + chunk_rows]
+        if not packed:
+            # Pixels are not packed within the rows (e.g. a view of every other column)
+            block = np.ascontiguousarray(block)
+
+        rows = block.reshape((-1, row_length))
+        work = buffer[:len(rows)]
+
+        np.add(rows, correction, out=work)
+        np.clip(work, 0, max_val, out=work)
+        np.subtract(offset, work, out=work)
+        np.multiply(work, stretch, out=work)
+        np.clip(work, 0, max_val, out=work)
+
+        if levels.gamma is not None:
+            work *= 1.0 / max_val
+            np.power(work, 1.0 / levels.gamma, out=work)
+            work *= max_val
+
+        # Truncates like the tables do
+        target = positive[y:y + chunk_rows]
+        if packed:
+            np.copyto(target.reshape((-1, row_length)), work, casting='unsafe')
+        else:
+            target[:] = work.reshape(target.shape).astype(dtype)
+
+    return positive
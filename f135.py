@@ -1,76 +1,284 @@
 import math
+from collections import namedtuple
 
 import cv2
 
+from instrument import instrumented, stage
 from strip import create_bordered_negative, create_bw_negative, get_sprocket_holes_contours, split_sprocket_holes, \
-    get_average_sprocket_hole_size
-from util import contours_center_line, line_angle, contours_top_line, most_right_contour, most_left_contour, \
-    contour_center, contours_bottom_line, get_k_colors, sort_colors_by_brightness
+    get_average_sprocket_hole_size, find_sprocket_holes, detection_scale, get_border_size
+from util import contours_top_line, most_right_contour, most_left_contour, contour_center, contours_bottom_line, \
+    get_k_colors, sort_colors_by_brightness, transform_contours, fit_line
 
 import numpy as np
 
 border_start_dist_rel_to_hole_size = 0.12
 border_end_dist_rel_to_hole_size = 0.45
 
-
-def straighten_35mm_negative(negative):
+# Holes further away from the line of their row count as outliers, see 'StripGeometry'
+hole_inlier_dist_rel_to_hole_size = 0.1
+
+# Result of the sprocket hole detection, see 'straighten_35mm_negative()'
+#  > rotation_matrix: 2x3 affine matrix, maps original negative coords to straightened image coords
+#  > top_holes, bottom_holes: SprocketHole objects within the straightened image, sorted left to right
+#  > hole_size: tuple (avg_width, avg_height) of all holes
+#  > angle: strip rotation in degrees, as given to cv2.getRotationMatrix2D
+#  > confidence: 0 to 1, share of holes close to the line of their row (see 'hole_inlier_dist_rel_to_hole_size')
+#  > residual: root mean square distance of the hole centers to the line of their row, in pixels
+#  Both lines have the strip angle, so rows which are not parallel lower the confidence too.
+StripGeometry = namedtuple('StripGeometry', [
+    'rotation_matrix', 'top_holes', 'bottom_holes', 'hole_size', 'angle', 'confidence', 'residual'
+])
+
+
+@instrumented
+def straighten_35mm_negative(negative, angle_tolerance=None, refine=False, return_geometry=False,
+                             low_memory=False, out=None, line_fit=None, min_confidence=None):
     """
     Computes sprocket holes and uses them to calculate strip rotation.
 
     This method fixes the strip rotation and returns an image with white borders.
     This way you will always have a white background within the image.
 
+    By default the sprocket holes are detected in full resolution. If an angle tolerance
+    is given, detection runs on a downscaled image which is just big enough to compute
+    the angle with that precision (see 'detection_scale()').
+
+    In low memory mode, no bordered copies are created: both borders are folded into the
+    affine transformation, which writes straight into one output buffer. The result equals
+    the default mode up to rounding of the interpolation. The buffer can be passed in to
+    reuse it, its shape is given by 'get_straightened_shape()'.
+
+    If a minimum confidence is given, detections below it (see 'StripGeometry') fail before
+    the image gets rotated.
+
     Supports any color depth.
 
     :param negative: Original negative image.
-    :return: Image of straight negative with white background around it.
+    :param angle_tolerance: Optional tolerated error of the strip angle in degrees, greater than 0.
+    :param refine: If True, holes found on the downscaled image are refined in full resolution.
+    :param return_geometry: If True, the detected StripGeometry is returned too. It can be passed
+        to 'get_35mm_strip_colors()' to skip the second detection.
+    :param low_memory: If True, the rotation writes directly into the padded output.
+    :param out: Optional output buffer for low memory mode.
+    :param line_fit: Method to fit the lines through the holes, see 'fit_line()'.
+    :param min_confidence: Optional minimum confidence of the detection.
+    :return: Image of straight negative with white background around it[, StripGeometry].
     """
 
-    # First let us add a border
-    #  > by that we always have an image with white background
-    bordered_negative = create_bordered_negative(negative)
+    scale = 1.0
+    if angle_tolerance is not None:
+        scale = detection_scale(negative, angle_tolerance)
+
+    # Now let us find all sprocket holes within the strip and divide them into top and bottom
+    (top_holes, bottom_holes) = find_sprocket_holes(negative, scale, refine)
+
+    geometry = get_35mm_strip_geometry(negative.shape, top_holes, bottom_holes, line_fit)
+
+    assert min_confidence is None or geometry.confidence >= min_confidence, \
+        "Sprocket hole detection not reliable, confidence {:.2f}".format(geometry.confidence)
+
+    border_color = (np.iinfo(negative.dtype).max,) * 3
 
-    # Makes background black and strip white
-    bw_negative = create_bw_negative(bordered_negative)
+    if low_memory:
+        rotated_bordered_negative = warp_straightened_region(negative, geometry.rotation_matrix, out=out)
+    else:
+        bordered_negative = create_bordered_negative(negative)
 
-    # Now let us find all sprocket hole contours within the strip
-    sprocket_holes_contours = get_sprocket_holes_contours(bw_negative)
+        # We can rotate the original image > border is everywhere the same,
+        # computed angle works for original image too
+        (h, w) = bordered_negative.shape[:2]
+        center = (cX, cY) = (w // 2, h // 2)
+        m_rot = cv2.getRotationMatrix2D(center, geometry.angle, 1.0)
 
-    # Let us divide the holes into top and bottom
-    (top_holes, bottom_holes) = split_sprocket_holes(sprocket_holes_contours)
+        with stage('warpAffine'):
+            rotated_negative = cv2.warpAffine(
+                bordered_negative, m_rot, (w, h),
+                borderMode=cv2.BORDER_CONSTANT,
+                borderValue=border_color
+            )
+
+        rotated_bordered_negative = create_bordered_negative(rotated_negative)
+
+    if not return_geometry:
+        return rotated_bordered_negative
+
+    return rotated_bordered_negative, geometry
+
+
+def get_35mm_strip_geometry(negative_shape, top_holes, bottom_holes, line_fit=None):
+    """
+    Computes the strip rotation from the sprocket holes and the transformation used by
+    'straighten_35mm_negative()'.
+
+    :param negative_shape: Shape of the original negative.
+    :param top_holes: Top sprocket holes in coordinates of the original negative.
+    :param bottom_holes: Bottom sprocket holes in coordinates of the original negative.
+    :param line_fit: Method to fit the lines through the holes, see 'fit_line()'.
+    :return: StripGeometry.
+    """
 
     # Let us find top and bottom line via sprocket holes and compute rot. angle
-    tcl = contours_center_line(top_holes)
-    bcl = contours_center_line(bottom_holes)
+    top_centers = np.array([contour_center(hole) for hole in top_holes])
+    bottom_centers = np.array([contour_center(hole) for hole in bottom_holes])
+
+    (_, angle_top, _) = fit_line(top_centers, line_fit)
+    (_, angle_bottom, _) = fit_line(bottom_centers, line_fit)
 
-    angle_top = line_angle(tcl)
-    angle_bottom = line_angle(bcl)
     strip_angle = 0.5 * (angle_top + angle_bottom)
     strip_angle_degrees = math.degrees(strip_angle)
 
-    # Now let us rotate the image
+    hole_size = get_average_sprocket_hole_size(top_holes + bottom_holes)
+
+    # Detection quality: distances of the holes to a line with the strip angle through their row
+    normal = np.array([-math.sin(strip_angle), math.cos(strip_angle)])
+    residuals = []
+    for centers in (top_centers, bottom_centers):
+        offsets = centers.dot(normal)
+        residuals.append(offsets - np.median(offsets))
+
+    residuals = np.concatenate(residuals)
+    confidence = np.mean(np.abs(residuals) <= hole_inlier_dist_rel_to_hole_size * min(hole_size))
+
+    m_full = get_straightening_matrix(negative_shape, strip_angle_degrees)
+
+    return StripGeometry(
+        m_full,
+        transform_contours(top_holes, m_full),
+        transform_contours(bottom_holes, m_full),
+        hole_size,
+        strip_angle_degrees,
+        float(confidence),
+        float(np.sqrt(np.mean(residuals ** 2)))
+    )
+
+
+def get_straightening_matrix(negative_shape, angle):
+    """
+    Computes the transformation of 'straighten_35mm_negative()' for a strip angle, e.g. to reuse
+    an angle detected on a downscaled copy (see 'preview.create_preview()').
+
+    :param negative_shape: Shape of the original negative.
+    :param angle: Strip rotation in degrees, see 'StripGeometry'.
+    :return: 2x3 affine matrix, maps original negative coords to straightened image coords.
+    """
+
+    # The image gets a border, is rotated around the center of the bordered image
+    # and gets another border afterwards
+    #  > by that we always have an image with white background
     #  > we do not need to resize the image, through rotation only
     #    strip "spikes" on the left and right vanishes behind the borders
-    (h, w) = bordered_negative.shape[:2]
+    pad = get_border_size(negative_shape)
+    (h, w) = (negative_shape[0] + 2 * pad, negative_shape[1] + 2 * pad)
     center = (cX, cY) = (w // 2, h // 2)
-    m_rot = cv2.getRotationMatrix2D(center, strip_angle_degrees, 1.0)
+    m_rot = cv2.getRotationMatrix2D(center, angle, 1.0)
+
+    rotated_pad = get_border_size((h, w))
+
+    # Combine first border, rotation and second border into one matrix
+    m_full = m_rot.copy()
+    m_full[:, 2] += m_rot[:, :2].dot([pad, pad]) + rotated_pad
+
+    return m_full
+
+
+def get_straightened_shape(negative_shape):
+    """
+    Computes the shape of the image returned by 'straighten_35mm_negative()', e.g. to
+    allocate a buffer for its low memory mode.
+
+    :param negative_shape: Shape of the original negative.
+    :return: Shape of the straightened image.
+    """
+    (h, w) = _bordered_dims(negative_shape)
+    rotated_pad = get_border_size((h, w))
+
+    return (h + 2 * rotated_pad, w + 2 * rotated_pad) + tuple(negative_shape[2:])
+
+
+def warp_straightened_region(negative, rotation_matrix, region=None, out=None):
+    """
+    Renders a region of the straightened image directly from the original negative:
+    rotation and both white borders in one pass, see low memory mode of 'straighten_35mm_negative()'.
+
+    Only the part of the negative the region maps to is read, which keeps memory
+    low for memory mapped or tiled inputs.
+
+    :param negative: Original negative.
+    :param rotation_matrix: Matrix of the StripGeometry.
+    :param region: Tuple (x1, y1, x2, y2) within the straightened image, defaults to the whole image.
+    :param out: Optional output buffer with the region's shape.
+    :return: Rendered region.
+    """
+    (sh, sw) = get_straightened_shape(negative.shape)[:2]
+    rotated_pad = get_border_size(_bordered_dims(negative.shape))
+
+    (x1, y1, x2, y2) = region if region is not None else (0, 0, sw, sh)
+    shape = (y2 - y1, x2 - x1) + negative.shape[2:]
+
+    if out is None:
+        out = np.empty(shape, dtype=negative.dtype)
+
+    assert out.shape == shape and out.dtype == negative.dtype, \
+        "Expected output buffer {} {}, got {} {}".format(shape, negative.dtype, out.shape, out.dtype)
+
+    max_val = np.iinfo(negative.dtype).max
+
+    # Inner area, the rest is the second border
+    ix1 = min(max(x1, rotated_pad), x2)
+    iy1 = min(max(y1, rotated_pad), y2)
+    ix2 = max(min(x2, sw - rotated_pad), ix1)
+    iy2 = max(min(y2, sh - rotated_pad), iy1)
+
+    out[:iy1 - y1] = max_val
+    out[iy2 - y1:] = max_val
+    out[:, :ix1 - x1] = max_val
+    out[:, ix2 - x1:] = max_val
+
+    if ix2 > ix1 and iy2 > iy1:
+        _warp_inner(negative, rotation_matrix, (ix1, iy1, ix2, iy2), out[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1])
+
+    return out
+
+
+def _bordered_dims(negative_shape):
+    pad = get_border_size(negative_shape)
+    return negative_shape[0] + 2 * pad, negative_shape[1] + 2 * pad
+
+
+def _warp_inner(negative, rotation_matrix, region, out):
+    (x1, y1, x2, y2) = region
+    (h, w) = negative.shape[:2]
+
+    # Source area needed for the region, one pixel more on each side for the interpolation
+    m_inv = cv2.invertAffineTransform(rotation_matrix)
+    corners = np.array([[[x1, y1]], [[x2, y1]], [[x1, y2]], [[x2, y2]]], dtype=np.float64)
+    src_corners = cv2.transform(corners, m_inv).reshape((-1, 2))
+
+    sx1 = int(max(math.floor(src_corners[:, 0].min()) - 1, 0))
+    sy1 = int(max(math.floor(src_corners[:, 1].min()) - 1, 0))
+    sx2 = int(min(math.ceil(src_corners[:, 0].max()) + 2, w))
+    sy2 = int(min(math.ceil(src_corners[:, 1].max()) + 2, h))
 
     border_color = (np.iinfo(negative.dtype).max,) * 3
 
-    # We can rotate the original image > border is everywhere the same,
-    # computed angle works for original image too
-    rotated_negative = cv2.warpAffine(
-        bordered_negative, m_rot, (w, h),
-        borderMode=cv2.BORDER_CONSTANT,
-        borderValue=border_color
-    )
+    if sx2 <= sx1 or sy2 <= sy1:
+        # Region does not cover the negative at all
+        out[:] = border_color[0]
+        return
 
-    rotated_bordered_negative = create_bordered_negative(rotated_negative)
+    # Move the matrix to the source window and the region
+    m_region = rotation_matrix.copy()
+    m_region[:, 2] += rotation_matrix[:, :2].dot([sx1, sy1]) - [x1, y1]
 
-    return rotated_bordered_negative
+    with stage('warpAffine'):
+        cv2.warpAffine(
+            negative[sy1:sy2, sx1:sx2], m_region, (x2 - x1, y2 - y1), dst=out,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=border_color
+        )
 
 
-def get_35mm_strip_top_border_coords(top_sprocket_holes):
+def get_35mm_strip_top_border_coords(top_sprocket_holes, hole_size=None):
     """
     Only works properly if the sprocket holes are horizontally aligned.
 
@@ -99,12 +307,18 @@ def get_35mm_strip_top_border_coords(top_sprocket_holes):
 
 
     :param top_sprocket_holes: Sprocket hole contours, sorted left to right.
+    :param hole_size: Optional average hole size (w, h), e.g. of a StripGeometry. Computed from
+        the holes if not given.
     :return: Tuple (pt1, pt2). pt1 corner top left, pt2 bottom right. Points are tuples of (x, y).
     """
 
+    if hole_size is None:
+        hole_size = get_average_sprocket_hole_size(top_sprocket_holes)
+
+    (top_hole_w, top_hole_h) = hole_size
+
     top_line = contours_top_line(top_sprocket_holes)
 
-    (top_hole_w, top_hole_h) = get_average_sprocket_hole_size(top_sprocket_holes)
     top_left_hole = most_left_contour(top_sprocket_holes)
     top_right_hole = most_right_contour(top_sprocket_holes)
 
@@ -117,7 +331,7 @@ def get_35mm_strip_top_border_coords(top_sprocket_holes):
     return (left_bound, top_bound), (right_bound, bottom_bound)
 
 
-def get_35mm_strip_bottom_border_coords(bottom_sprocket_holes):
+def get_35mm_strip_bottom_border_coords(bottom_sprocket_holes, hole_size=None):
     """
     Only works properly if the sprocket holes are horizontally aligned.
 
@@ -145,12 +359,18 @@ def get_35mm_strip_bottom_border_coords(bottom_sprocket_holes):
     =========================================================== (border)
 
     :param bottom_sprocket_holes: Sprocket hole contours, sorted left to right.
+    :param hole_size: Optional average hole size (w, h), e.g. of a StripGeometry. Computed from
+        the holes if not given.
     :return: Tuple (pt1, pt2). pt1 corner top left, pt2 bottom right. Points are tuples of (x, y).
     """
 
+    if hole_size is None:
+        hole_size = get_average_sprocket_hole_size(bottom_sprocket_holes)
+
+    (bottom_hole_w, bottom_hole_h) = hole_size
+
     bottom_line = contours_bottom_line(bottom_sprocket_holes)
 
-    (bottom_hole_w, bottom_hole_h) = get_average_sprocket_hole_size(bottom_sprocket_holes)
     bottom_left_hole = most_left_contour(bottom_sprocket_holes)
     bottom_right_hole = most_right_contour(bottom_sprocket_holes)
 
@@ -163,7 +383,8 @@ def get_35mm_strip_bottom_border_coords(bottom_sprocket_holes):
     return (left_bound, top_bound), (right_bound, bottom_bound)
 
 
-def get_35mm_strip_colors(negative, positive=False):
+@instrumented
+def get_35mm_strip_colors(negative, positive=False, geometry=None):
     """
     Negative must have a white border/background all around!
 
@@ -174,20 +395,29 @@ def get_35mm_strip_colors(negative, positive=False):
     Returns brightest and darkest color found in there.
 
     :param negative: Negative with white border.
-    :param positive: If True, negative image will be inverted before processing
+    :param positive: If True, negative image will be inverted before processing. Only affects
+        the sprocket hole detection, so it can not be combined with a geometry.
+    :param geometry: Optional StripGeometry from 'straighten_35mm_negative()'. If given,
+        the sprocket holes are not detected again.
     :return: Returns tuple (darkest_color, brightest_color).
     """
-    neg_copy = negative
-    if positive:
-        neg_copy = cv2.bitwise_not(neg_copy)
+    assert not (positive and geometry is not None), "A geometry skips the detection, positive is not used"
+
+    hole_size = None
+    if geometry is None:
+        neg_copy = negative
+        if positive:
+            neg_copy = cv2.bitwise_not(neg_copy)
 
-    bw = create_bw_negative(neg_copy)
-    sprocket_holes = get_sprocket_holes_contours(bw)
-    (top_holes, bottom_holes) = split_sprocket_holes(sprocket_holes)
+        bw = create_bw_negative(neg_copy)
+        sprocket_holes = get_sprocket_holes_contours(bw)
+        (top_holes, bottom_holes) = split_sprocket_holes(sprocket_holes)
+    else:
+        (top_holes, bottom_holes, hole_size) = (geometry.top_holes, geometry.bottom_holes, geometry.hole_size)
 
     # Compute the border rectangles
-    top_border_rect = get_35mm_strip_top_border_coords(top_holes)
-    bottom_border_rect = get_35mm_strip_bottom_border_coords(bottom_holes)
+    top_border_rect = get_35mm_strip_top_border_coords(top_holes, hole_size)
+    bottom_border_rect = get_35mm_strip_bottom_border_coords(bottom_holes, hole_size)
 
     # Extract sub images
     roi_top = negative[
@@ -200,6 +430,41 @@ def get_35mm_strip_colors(negative, positive=False):
         bottom_border_rect[0][0]:bottom_border_rect[1][0]   # x1 and x2
     ]
 
+    return get_35mm_border_colors(roi_top, roi_bottom)
+
+
+@instrumented
+def get_35mm_negative_colors(negative, geometry):
+    """
+    Computes the film base colors like 'get_35mm_strip_colors()', but from the original negative:
+    only the two border areas are straightened (see 'warp_straightened_region()').
+
+    :param negative: Original negative.
+    :param geometry: StripGeometry of the negative.
+    :return: Returns tuple (darkest_color, brightest_color).
+    """
+    rois = []
+    rects = (
+        get_35mm_strip_top_border_coords(geometry.top_holes, geometry.hole_size),
+        get_35mm_strip_bottom_border_coords(geometry.bottom_holes, geometry.hole_size)
+    )
+    for rect in rects:
+        ((x1, y1), (x2, y2)) = rect
+        rois.append(warp_straightened_region(negative, geometry.rotation_matrix, (x1, y1, x2, y2)))
+
+    return get_35mm_border_colors(*rois)
+
+
+def get_35mm_border_colors(roi_top, roi_bottom):
+    """
+    Computes two most dominant colors within each border area and returns the
+    darkest and brightest of them.
+
+    :param roi_top: Border area between top sprocket holes and edge.
+    :param roi_bottom: Border area between bottom sprocket holes and edge.
+    :return: Returns tuple (darkest_color, brightest_color).
+    """
+
     # Now compute brightest and darkest color
     colors = list()
     colors.extend(get_k_colors(roi_top, 2))
@@ -0,0 +1,216 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from instrument import instrumented, stage
+from invert import apply_lut
+from util import contours_bottom_line, contours_top_line, most_left_contour, most_right_contour, contour_left, \
+    contour_right
+
+# 35mm film: a frame is 36mm wide and advanced by 8 sprocket holes (38mm, hole pitch 4.75mm)
+frame_pitch_rel_to_hole_pitch = 8
+frame_width_rel_to_hole_pitch = 36.0 / 4.75
+
+# Distance a gap may be away from its position on the regular frame pitch
+gap_search_rel_to_hole_pitch = 1.0
+
+# Frames cut by the strip ends are only returned if at least this part is visible
+frame_min_coverage = 0.95
+
+
+def get_hole_pitch(geometry):
+    """
+    :param geometry: StripGeometry, see 'straighten_35mm_negative()'.
+    :return: Median horizontal distance between neighbouring sprocket holes.
+    """
+    distances = []
+    for holes in (geometry.top_holes, geometry.bottom_holes):
+        centers = sorted(hole.center[0] for hole in holes)
+        distances.extend(np.diff(centers))
+
+    assert len(distances) > 0, "At least two sprocket holes in a row are needed"
+
+    # Missing holes lead to multiples of the pitch, median ignores them
+    return float(np.median(distances))
+
+
+def get_35mm_frame_band(geometry):
+    """
+    Computes the area of the straightened strip between both rows of sprocket holes,
+    which contains the frames.
+
+    :param geometry: StripGeometry, see 'straighten_35mm_negative()'.
+    :return: Tuple (x1, y1, x2, y2). x from the most left to the most right hole, y between the rows.
+    """
+    holes = geometry.top_holes + geometry.bottom_holes
+
+    x1 = int(math.ceil(contour_left(most_left_contour(holes))[0]))
+    x2 = int(math.floor(contour_right(most_right_contour(holes))[0]))
+    y1 = int(math.ceil(contours_bottom_line(geometry.top_holes)[1]))
+    y2 = int(math.floor(contours_top_line(geometry.bottom_holes)[1]))
+
+    return x1, y1, x2, y2
+
+
+def column_brightness_profile(image, band):
+    """
+    :param image: Straightened image.
+    :param band: Tuple (x1, y1, x2, y2), see 'get_35mm_frame_band()'.
+    :return: Average brightness of every column of the band (float32, all channels averaged).
+    """
+    (x1, y1, x2, y2) = band
+    area = image[y1:y2, x1:x2]
+
+    # cv2.reduce wants a contiguous single channel image
+    columns = cv2.reduce(area.reshape((area.shape[0], -1)), 0, cv2.REDUCE_AVG, dtype=cv2.CV_32F)
+
+    return columns.reshape((x2 - x1, -1)).mean(axis=1)
+
+
+def find_frame_gaps(profile, hole_pitch):
+    """
+    Finds the gaps between frames, which are the brightest columns of a negative (unexposed film base).
+
+    First the phase of the regular frame pitch is searched which puts the gaps on the brightest
+    columns on average. Then every gap is moved to the brightest position nearby, as frame
+    spacing is not perfectly regular.
+
+    :param profile: Column brightness, see 'column_brightness_profile()'. Gaps must be the brightest columns.
+    :param hole_pitch: Sprocket hole pitch in pixels, see 'get_hole_pitch()'.
+    :return: List of gap start columns, sorted left to right.
+    """
+    pitch = frame_pitch_rel_to_hole_pitch * hole_pitch
+    gap_width = max(1, int(round((frame_pitch_rel_to_hole_pitch - frame_width_rel_to_hole_pitch) * hole_pitch)))
+
+    if len(profile) < gap_width:
+        return []
+
+    # Average brightness of a gap starting at each column
+    sums = np.concatenate([[0.0], np.cumsum(profile, dtype=np.float64)])
+    windows = (sums[gap_width:] - sums[:-gap_width]) / gap_width
+    last_start = len(windows) - 1
+
+    # Score every phase by the mean over all gaps at that phase
+    phases = np.arange(0, int(math.ceil(pitch)))
+    steps = np.arange(0, int(last_start // pitch) + 2)
+    starts = np.round(phases[:, np.newaxis] + steps[np.newaxis, :] * pitch).astype(np.int64)
+    valid = starts <= last_start
+
+    scores = np.where(valid, windows[np.minimum(starts, last_start)], 0).sum(axis=1) / valid.sum(axis=1)
+    best = int(np.argmax(scores))
+
+    # Refine every gap locally
+    search = int(round(gap_search_rel_to_hole_pitch * hole_pitch))
+    gaps = []
+    for start in starts[best][valid[best]]:
+        lo = max(0, start - search)
+        hi = min(last_start, start + search) + 1
+        gap = lo + int(np.argmax(windows[lo:hi]))
+
+        # Refinement may move two gaps onto the same spot
+        if len(gaps) == 0 or gap - gaps[-1] >= gap_width:
+            gaps.append(gap)
+
+    return gaps
+
+
+@instrumented
+def get_35mm_frame_rects(image, geometry, positive=False, min_coverage=None):
+    """
+    Only works properly on straightened strips, see 'straighten_35mm_negative()'.
+
+    Locates the single frames of a strip: the gaps between frames are found on a brightness
+    projection of the columns between both sprocket hole rows. At least one gap needs to be visible!
+
+    Frames at the strip ends are cut off by the end of the film (or the scan). They are only
+    returned if the part given by min_coverage is visible.
+
+    :param image: Straightened negative (or positive, see below).
+    :param geometry: StripGeometry, see 'straighten_35mm_negative()'.
+    :param positive: If True, the image is a positive (gaps are the darkest columns).
+    :param min_coverage: Visible part of the frame width needed at the strip ends,
+        defaults to 'frame_min_coverage'.
+    :return: List of frame rectangles (x1, y1, x2, y2), sorted left to right.
+    """
+    if min_coverage is None:
+        min_coverage = frame_min_coverage
+
+    hole_pitch = get_hole_pitch(geometry)
+    (x1, y1, x2, y2) = get_35mm_frame_band(geometry)
+
+    profile = column_brightness_profile(image, (x1, y1, x2, y2))
+    if positive:
+        profile = -profile
+
+    gaps = find_frame_gaps(profile, hole_pitch)
+    if len(gaps) == 0:
+        return []
+
+    frame_width = frame_width_rel_to_hole_pitch * hole_pitch
+    gap_width = max(1, int(round((frame_pitch_rel_to_hole_pitch - frame_width_rel_to_hole_pitch) * hole_pitch)))
+
+    # Frames between gaps plus the ones before the first and after the last gap
+    spans = [(gaps[0] - frame_width, gaps[0])]
+    spans.extend((gaps[i] + gap_width, gaps[i + 1]) for i in range(0, len(gaps) - 1))
+    spans.append((gaps[-1] + gap_width, gaps[-1] + gap_width + frame_width))
+
+    rects = []
+    for (start, end) in spans:
+        start = int(round(max(start, 0)))
+        end = int(round(min(end, len(profile))))
+
+        if end - start >= min_coverage * frame_width:
+            rects.append((x1 + start, y1, x1 + end, y2))
+
+    return rects
+
+
+def extract_frames(image, rects):
+    """
+    :param image: Straightened image.
+    :param rects: Frame rectangles, see 'get_35mm_frame_rects()'.
+    :return: List of frames. These are views, no pixels are copied.
+    """
+    return [image[y1:y2, x1:x2] for (x1, y1, x2, y2) in rects]
+
+
+def frame_path_for(path, index):
+    """
+    :param path: Path of the whole strip, e.g. 'out/strip.tif'.
+    :param index: Index of the frame.
+    :return: Path of the frame, e.g. 'out/strip_01.tif'.
+    """
+    (root, ext) = os.path.splitext(path)
+    return '{}_{:02d}{}'.format(root, index + 1, ext)
+
+
+@instrumented
+def invert_frames(frames, lut, write=None, workers=None):
+    """
+    Inverts the frames in place and optionally writes them, one frame per thread.
+
+    cv2.LUT and the image encoders release the GIL, so frames are processed in parallel.
+    As frames are views, the strip they belong to gets inverted too.
+
+    :param frames: Frames, see 'extract_frames()'. They must not overlap.
+    :param lut: Inversion table, see 'create_inversion_lut()'.
+    :param write: Optional callback(index, frame) storing a frame, called right after its inversion.
+    :param workers: Number of threads, defaults to the number of cores.
+    :return: The given frames.
+    """
+
+    def process(index):
+        with stage('frame'):
+            apply_lut(frames[index], lut)
+
+            if write is not None:
+                write(index, frames[index])
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        # Re-raises errors of the threads
+        list(executor.map(process, range(0, len(frames))))
+
+    return frames
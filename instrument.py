@@ -0,0 +1,246 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# None while instrumentation is disabled
+_recording = None
+
+
+class _Recording(object):
+    __slots__ = ('records', 'trace_memory', 'started_tracing', 'local', 'lock')
+
+    def __init__(self, trace_memory, started_tracing):
+        self.records = []
+        self.trace_memory = trace_memory
+        # Only tracing started by 'enable()' is stopped again, a session of the caller is kept
+        self.started_tracing = started_tracing
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+
+def enable(trace_memory=True):
+    """
+    Starts recording all stages (see 'stage()'). Recording is per process.
+
+    Memory is traced with tracemalloc, which covers numpy arrays including the ones
+    OpenCV returns. Tracing slows everything down noticeably, so it can be switched off.
+
+    :param trace_memory: If True, the peak allocated bytes are recorded per stage.
+    """
+    global _recording
+
+    # Enabled again: the tracing started before is still ours
+    started_tracing = _recording is not None and _recording.started_tracing
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracing = True
+
+    _recording = _Recording(trace_memory, started_tracing)
+
+
+def disable():
+    """
+    Stops recording. Memory tracing is only stopped if 'enable()' started it.
+
+    :return: All records not taken yet.
+    """
+    global _recording
+
+    recording = _recording
+    _recording = None
+
+    if recording is None:
+        return []
+
+    if recording.started_tracing and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    return recording.records
+
+
+def is_enabled():
+    return _recording is not None
+
+
+def take_records():
+    """
+    Returns all records so far and clears them, e.g. to send them from a worker process.
+
+    :return: List of records, see 'stage()'.
+    """
+    recording = _recording
+    if recording is None:
+        return []
+
+    with recording.lock:
+        records = recording.records
+        recording.records = []
+
+    return records
+
+
+@contextmanager
+def image(name):
+    """
+    Labels all stages within this context with the given image name.
+
+    :param name: Image name, e.g. its path.
+    """
+    recording = _recording
+    if recording is None:
+        yield
+        return
+
+    previous = getattr(recording.local, 'image', None)
+    recording.local.image = name
+    try:
+        yield
+    finally:
+        recording.local.image = previous
+
+
+def _update_peaks(stack):
+    # tracemalloc only knows one peak, so it is handed to all open stages before resetting it
+    (current, peak) = tracemalloc.get_traced_memory()
+    for frame in stack:
+        frame[1] = max(frame[1], peak)
+
+    tracemalloc.reset_peak()
+
+    return current
+
+
+@contextmanager
+def stage(name):
+    """
+    Records wall time, CPU time and peak allocated bytes of the enclosed code.
+    Does nothing if instrumentation is disabled.
+
+    Stages can be nested. A record is a dict with the keys image, stage, depth, start
+    (seconds since epoch), wall, cpu (seconds), peak_bytes (allocated on top of what existed
+    when the stage started, None without memory tracing), pid and tid.
+
+    CPU time is the process time, so it contains OpenCV's own threads. Memory peaks of
+    stages running in parallel threads are mixed.
+
+    :param name: Stage name.
+    """
+    recording = _recording
+    if recording is None:
+        yield
+        return
+
+    stack = getattr(recording.local, 'stack', None)
+    if stack is None:
+        stack = recording.local.stack = []
+
+    trace_memory = recording.trace_memory and hasattr(tracemalloc, 'reset_peak')
+
+    # [start bytes, peak bytes]
+    frame = [0, 0]
+    if trace_memory:
+        frame[0] = frame[1] = _update_peaks(stack)
+
+    stack.append(frame)
+
+    start = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        if trace_memory:
+            _update_peaks(stack)
+
+        stack.pop()
+
+        record = {
+            'image': getattr(recording.local, 'image', None),
+            'stage': name,
+            'depth': len(stack),
+            'start': start,
+            'wall': wall,
+            'cpu': cpu,
+            'peak_bytes': frame[1] - frame[0] if trace_memory else None,
+            'pid': os.getpid(),
+            'tid': threading.get_ident()
+        }
+
+        with recording.lock:
+            recording.records.append(record)
+
+
+def instrumented(func):
+    """
+    Decorator, runs the whole function as a stage named like the function.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _recording is None:
+            return func(*args, **kwargs)
+
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def write_json_lines(records, path):
+    """
+    Writes one JSON object per record and line. Appends to existing files, so runs can be collected.
+
+    :param records: Records, see 'stage()'.
+    :param path: File path.
+    """
+    with open(path, 'a') as file:
+        for record in records:
+            file.write(json.dumps(record) + '\n')
+
+
+def write_chrome_trace(records, path):
+    """
+    Writes the records in Chrome's trace event format, viewable in chrome://tracing or Perfetto.
+
+    :param records: Records, see 'stage()'.
+    :param path: File path.
+    """
+    events = []
+    for record in records:
+        events.append({
+            'name': record['stage'],
+            'cat': 'stage',
+            'ph': 'X',
+            'ts': record['start'] * 1e6,
+            'dur': record['wall'] * 1e6,
+            'pid': record['pid'],
+            'tid': record['tid'],
+            'args': {
+                'image': record['image'],
+                'cpu': record['cpu'],
+                'peak_bytes': record['peak_bytes']
+            }
+        })
+
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+def write_records(records, path):
+    """
+    Writes records as Chrome trace for '.json' files, otherwise as JSON lines.
+
+    :param records: Records, see 'stage()'.
+    :param path: File path.
+    """
+    if path.lower().endswith('.json'):
+        write_chrome_trace(records, path)
+    else:
+        write_json_lines(records, path)
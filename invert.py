@@ -0,0 +1,321 @@
+import math
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+from instrument import instrumented
+from util import calc_white_balance_diff
+
+displacement_rel_to_darkest = 1.15
+contrast_factor_scale = 0.7
+
+# Rows converted at once when applying 16bit tables, keeps temporaries small
+lut_chunk_rows = 64
+
+# Density inversion, see 'invert_negative_density()'
+#  > percentage of the densities (above the film base) of each channel that stay below white
+density_white_percentile = 99.5
+#  > pixels the white point is computed from at most, a regular grid like in 'get_k_colors()'
+density_max_samples = 100000
+#  > encodings of the positive: density above the base ('log') or linear light ('linear'), see 'create_density_lut()'
+density_outputs = ('log', 'linear')
+
+
+def calc_inversion_params(darkest_color, brightest_color, dtype):
+    """
+    Computes the white balance correction, the displacement and the contrast factor
+    from the film base colors (see 'get_35mm_strip_colors()').
+
+    The brightest color is used for the white balance. After inverting, everything darker than
+    the displacement becomes black, the rest gets stretched by the factor.
+
+    :param darkest_color: Darkest film base color.
+    :param brightest_color: Brightest film base color.
+    :param dtype: Image dtype (uint8 or uint16).
+    :return: Tuple (color_correction, color_displacement, color_factor).
+    """
+    max_val = np.iinfo(dtype).max
+
+    color_correction = -calc_white_balance_diff(brightest_color)
+
+    pos_brightest_color = max_val - (darkest_color + color_correction)
+    pos_darkest_color = max_val - (brightest_color + color_correction)
+
+    color_displacement = np.mean(pos_darkest_color) * displacement_rel_to_darkest
+    color_factor = max_val / (np.mean(pos_brightest_color) - color_displacement) * contrast_factor_scale
+
+    return color_correction, color_displacement, color_factor
+
+
+@instrumented
+def create_inversion_lut(color_correction, color_displacement, color_factor, dtype):
+    """
+    Folds white balance, inversion, displacement and stretch into one lookup table
+    per channel. Clipping and truncation happen in the same order as if the steps
+    were applied one after another on the image.
+
+    Supports uint8 and uint16.
+
+    :param color_correction: Per channel white balance offset.
+    :param color_displacement: Displacement subtracted after inversion.
+    :param color_factor: Contrast stretch factor.
+    :param dtype: Image dtype.
+    :return: Table of shape (3, max_val+1) with given dtype.
+    """
+    max_val = np.iinfo(dtype).max
+    values = np.arange(max_val + 1, dtype=np.int64)
+
+    lut = np.empty((3, max_val + 1), dtype=dtype)
+
+    for channel in range(0, 3):
+        # White balance
+        col = np.clip(values + int(color_correction[channel]), 0, max_val)
+
+        # Invert
+        col = max_val - col
+
+        # First displacement, then stretch
+        col = np.clip(np.trunc(col - color_displacement), 0, max_val)
+        col = np.clip(np.trunc(col * color_factor), 0, max_val)
+
+        lut[channel] = col
+
+    return lut
+
+
+@instrumented
+def apply_lut(img, lut):
+    """
+    Applies a per channel lookup table in place.
+
+    8bit images are handled by cv2.LUT, 16bit images are converted in row chunks
+    so no temporary buffer of the image size gets allocated. Each chunk is split into
+    contiguous channels first, which makes the table lookups about twice as fast as
+    on the interleaved channels.
+
+    :param img: BGR image (uint8 or uint16). Will be modified.
+    :param lut: Table of shape (3, max_val+1), see 'create_inversion_lut()'.
+    :return: The given image.
+    """
+    assert img.dtype == lut.dtype, "Table dtype {} does not match image dtype {}".format(lut.dtype, img.dtype)
+
+    if img.strides[1:] == (3 * img.itemsize, img.itemsize):
+        return _apply_lut_packed(img, lut)
+
+    # Pixels are not packed within the rows (e.g. a view of every other column),
+    # OpenCV can not write to those directly
+    h = img.shape[0]
+    for y in range(0, h, lut_chunk_rows):
+        block = np.ascontiguousarray(img[y:y + lut_chunk_rows])
+        img[y:y + lut_chunk_rows] = _apply_lut_packed(block, lut)
+
+    return img
+
+
+def _apply_lut_packed(img, lut):
+    if img.dtype == np.uint8:
+        # cv2.LUT takes a table with one channel per image channel
+        cv2.LUT(img, lut.T.reshape((256, 1, 3)), dst=img)
+        return img
+
+    h = img.shape[0]
+    for y in range(0, h, lut_chunk_rows):
+        block = img[y:y + lut_chunk_rows]
+
+        channels = cv2.split(block)
+        for channel in range(0, 3):
+            np.take(lut[channel], channels[channel], out=channels[channel])
+
+        cv2.merge(channels, dst=block)
+
+    return img
+
+
+@instrumented
+def invert_negatives(negatives, color_correction, color_displacement, color_factor, in_place=False):
+    """
+    Applies the same inversion to several straightened negatives, e.g. all strips of one
+    roll (see 'roll.RollProfile'). The table is created once for all of them.
+
+    A stacked array of shape (n, h, w, 3) is processed as one image, in row chunks.
+
+    :param negatives: List of negatives or stacked array, all of the same dtype (uint8 or uint16).
+    :param color_correction: Per channel white balance offset.
+    :param color_displacement: Displacement subtracted after inversion.
+    :param color_factor: Contrast stretch factor.
+    :param in_place: If True, the given images will be overwritten.
+    :return: Positives, list or stacked array like the input.
+    """
+    if len(negatives) == 0:
+        return negatives
+
+    dtype = negatives[0].dtype
+    lut = create_inversion_lut(color_correction, color_displacement, color_factor, dtype)
+
+    if isinstance(negatives, np.ndarray):
+        positives = negatives if in_place else negatives.copy()
+
+        if positives.flags.c_contiguous:
+            # Rows of all strips one after another
+            apply_lut(positives.reshape((-1,) + positives.shape[2:]), lut)
+        else:
+            for positive in positives:
+                apply_lut(positive, lut)
+
+        return positives
+
+    assert all(negative.dtype == dtype for negative in negatives), "All negatives need the same dtype"
+
+    positives = negatives if in_place else [negative.copy() for negative in negatives]
+    for positive in positives:
+        apply_lut(positive, lut)
+
+    return positives
+
+
+@instrumented
+def invert_negative(negative, darkest_color, brightest_color, in_place=False):
+    """
+    Turns the negative into a positive: white balance based on the brightest color,
+    inversion and contrast stretch based on both colors.
+
+    Supports uint8 and uint16.
+
+    :param negative: Straightened negative.
+    :param darkest_color: Darkest film base color.
+    :param brightest_color: Brightest film base color.
+    :param in_place: If True, the given image will be overwritten.
+    :return: Positive image.
+    """
+    (color_correction, color_displacement, color_factor) = \
+        calc_inversion_params(darkest_color, brightest_color, negative.dtype)
+
+    lut = create_inversion_lut(color_correction, color_displacement, color_factor, negative.dtype)
+
+    positive = negative if in_place else negative.copy()
+
+    return apply_lut(positive, lut)
+
+
+@lru_cache(maxsize=2)
+def create_density_table(dtype):
+    """
+    Optical density of every value of the dtype: -log10(value / max_val). Value 0 gets the
+    density of value 0.5, the table needs a finite value there.
+
+    Computed once per dtype, so density conversions are table lookups.
+
+    :param dtype: Image dtype (uint8 or uint16).
+    :return: float32 array of length max_val+1. Do not modify.
+    """
+    max_val = np.iinfo(dtype).max
+
+    values = np.arange(max_val + 1, dtype=np.float64)
+    values[0] = 0.5
+
+    return (-np.log10(values / max_val)).astype(np.float32)
+
+
+def calc_density_params(negative, base_color, max_samples=None):
+    """
+    Computes the film base density and the white point of every channel for
+    'create_density_lut()'.
+
+    The white point is the 'density_white_percentile' of the densities above the base, per
+    channel. So every channel is stretched on its own, which neutralizes the orange mask
+    together with the base.
+
+    :param negative: Straightened negative (uint8 or uint16).
+    :param base_color: Film base color, e.g. the brightest color of 'get_35mm_strip_colors()'.
+    :param max_samples: Max number of pixels used, defaults to 'density_max_samples'.
+    :return: Tuple (base_density, white_density), float arrays with one value per channel.
+        white_density is relative to the base.
+    """
+    if max_samples is None:
+        max_samples = density_max_samples
+
+    table = create_density_table(np.dtype(negative.dtype))
+
+    base_density = table[np.asarray(base_color).astype(np.int64)].astype(np.float64)
+
+    (h, w) = negative.shape[:2]
+    step = max(1, int(np.ceil(np.sqrt(h * w / max_samples))))
+    samples = np.take(table, negative[::step, ::step].reshape((-1, 3)))
+
+    white_density = np.percentile(samples, density_white_percentile, axis=0) - base_density
+    assert np.all(white_density > 0), "Negative is not denser than its film base: {}".format(white_density)
+
+    return base_density, white_density
+
+
+@instrumented
+def create_density_lut(base_density, white_density, dtype, output='log'):
+    """
+    Folds density conversion, film base removal, the per channel stretch and the output curve
+    into one lookup table per channel (see 'create_inversion_lut()').
+
+    The film base gets black, the white density white. Subtracting the base density equals
+    dividing by the base color in linear values, which removes the orange mask.
+
+    Output encodings (see 'density_outputs'):
+     > 'log': the positive stays density encoded, values are proportional to the density above
+       the base. Like a log scan, its tone curve differs from 'invert_negative()'.
+     > 'linear': the density is converted back to linear light (exp curve): values are
+       proportional to base / negative - 1, the inverted transmittance relative to the base.
+
+    Both curves are evaluated once per table entry, so the image gets a single lookup.
+
+    :param base_density: Per channel film base density.
+    :param white_density: Per channel white point, density above the base.
+    :param dtype: Image dtype (uint8 or uint16).
+    :param output: Encoding of the positive, see above.
+    :return: Table of shape (3, max_val+1) with given dtype.
+    """
+    assert output in density_outputs, "Unknown density output {}, expected one of {}".format(output, density_outputs)
+
+    max_val = np.iinfo(dtype).max
+    table = create_density_table(np.dtype(dtype)).astype(np.float64)
+
+    lut = np.empty((3, max_val + 1), dtype=dtype)
+
+    for channel in range(0, 3):
+        density = table - base_density[channel]
+
+        if output == 'linear':
+            col = np.expm1(density * math.log(10)) * (max_val / math.expm1(white_density[channel] * math.log(10)))
+        else:
+            col = density * (max_val / white_density[channel])
+
+        lut[channel] = np.clip(np.round(col), 0, max_val)
+
+    return lut
+
+
+@instrumented
+def invert_negative_density(negative, base_color, in_place=False, output='log'):
+    """
+    Turns the negative into a positive by its density (log) instead of the linear values of
+    'invert_negative()': the film base density is subtracted per channel and every channel is
+    stretched to its own white point (see 'calc_density_params()').
+
+    By default the positive stays density encoded, with 'linear' output it is converted back
+    to linear light (see 'create_density_lut()').
+
+    All curves are tables, so this is as fast as 'invert_negative()'.
+
+    Supports uint8 and uint16.
+
+    :param negative: Straightened negative.
+    :param base_color: Film base color, e.g. the brightest color of 'get_35mm_strip_colors()'.
+    :param in_place: If True, the given image will be overwritten.
+    :param output: Encoding of the positive, 'log' or 'linear', see 'density_outputs'.
+    :return: Positive image.
+    """
+    (base_density, white_density) = calc_density_params(negative, base_color)
+
+    lut = create_density_lut(base_density, white_density, negative.dtype, output)
+
+    positive = negative if in_place else negative.copy()
+
+    return apply_lut(positive, lut)
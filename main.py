@@ -1,114 +1,431 @@
-from time import sleep
-
-import cv2
+import argparse
+import os
+import sys
 import time
-import math
-import numpy as np
 
-from f135 import straighten_35mm_negative, get_35mm_strip_colors, get_35mm_strip_top_border_coords, \
-    get_35mm_strip_bottom_border_coords
-from strip import create_bordered_negative, create_bw_negative, get_sprocket_holes_contours, split_sprocket_holes, \
-    get_average_sprocket_hole_size
-from util import draw_line, group_contours_by_distance, closest_transitive_contours, contours_top_line, \
-    contours_bottom_line, contours_center_line, n_closest_contours, line_angle, most_left_contour, most_right_contour, \
-    contour_center, points_to_line, get_k_colors, sort_colors_by_brightness, calc_white_balance_diff
+import instrument
+
+# OpenCV, numpy and the processing modules are imported by the commands themselves,
+# so '--help' and invalid arguments are answered without loading them.
+
+# Output encodings of '--density', like 'invert.density_outputs'
+density_outputs = ('log', 'linear')
 
 # todo: what happens if i have a negative with background all around?
 
-window = 'negative'
-cv2.namedWindow(window, cv2.WINDOW_NORMAL)
-cv2.resizeWindow(window, 800, 600)
 
+def show(path, profile=None, preview=False, density=None):
+    """
+    Processes a single negative, prints the computed values and shows the positive in a window.
+
+    :param path: Path of negative.
+    :param profile: Optional path to write the stage records to (see 'instrument.write_records()').
+    :param preview: If True, a downscaled 8bit positive is computed instead, see 'create_preview()'.
+    :param density: Optional output encoding ('log' or 'linear'). If given, the negative is inverted by
+        its density, see 'invert_negative_density()'.
+    """
+    import cv2
+    from f135 import straighten_35mm_negative, get_35mm_strip_colors
+    from invert import calc_inversion_params, create_inversion_lut, apply_lut, calc_density_params, \
+        create_density_lut
+    from tiff import read_negative
+
+    if profile is not None:
+        instrument.enable()
+
+    # RGB like batch, so the printed colors match the roll profiles
+    negative = read_negative(path)
+
+    if preview:
+        return _show_preview(negative, profile)
+
+    # Processing start
+    t_start = time.time()
+
+    (rotated_negative, geometry) = straighten_35mm_negative(negative, return_geometry=True)
+
+    # Compute colors for white balance, the holes are already known
+    darkest_color, brightest_color = get_35mm_strip_colors(rotated_negative, geometry=geometry)
+
+    print("Angle: {:.3f}, confidence: {:.2f}, residual: {:.2f}px".format(
+        geometry.angle, geometry.confidence, geometry.residual
+    ))
+
+    print("Darkest color: {}".format(darkest_color))
+    print("Brightest color: {}".format(brightest_color))
+
+    if density is not None:
+        # Film base density is removed per channel, every channel gets its own white point
+        (base_density, white_density) = calc_density_params(rotated_negative, brightest_color)
+
+        print("Base density: {}".format(base_density))
+        print("White density: {}".format(white_density))
+
+        lut = create_density_lut(base_density, white_density, rotated_negative.dtype, density)
+    else:
+        # Let us do the white balance :), invert and handle the contrast
+        #  > all steps are folded into one lookup table, applied in place
+        (color_correction, color_displacement, color_factor) = \
+            calc_inversion_params(darkest_color, brightest_color, rotated_negative.dtype)
+
+        print("Diff: {}".format(color_correction))
+
+        print("Displacement: {}".format(color_displacement))
+        print("Factor: {}".format(color_factor))
+
+        lut = create_inversion_lut(color_correction, color_displacement, color_factor, rotated_negative.dtype)
+
+    wb_negative = apply_lut(rotated_negative, lut)
+
+    t_end = time.time()
+    print("time: {:.3f}s".format((t_end-t_start)))
+    # Processing end
+
+    if profile is not None:
+        instrument.write_records(instrument.disable(), profile)
+
+    window = 'negative'
+    cv2.namedWindow(window, cv2.WINDOW_NORMAL)
+    cv2.resizeWindow(window, 800, 600)
 
+    cv2.imshow(window, _to_display(wb_negative))
+    cv2.waitKey(0)
 
+    cv2.destroyAllWindows()
 
 
-#negative = cv2.imread("images/test_negative_small_rotated_mirrored.tiff")
-#negative = cv2.imread("images/test_negative_small_rotated.tiff")
-#negative = cv2.imread("images/test_single_negative_small.tiff")
-#negative = cv2.imread("images/test_negative_small.tiff")
-#negative = cv2.imread("images/test_negative.tiff")
+def _to_display(positive):
+    import cv2
 
-dir = "images/ektar_16/"
-#negative = cv2.imread(dir + "ektar_16bit_01_s.tif", cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
-negative = cv2.imread(dir + "ektar_16bit_01_r.tif", cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+    # cv2.imshow expects BGR
+    if positive.ndim == 3:
+        return cv2.cvtColor(positive, cv2.COLOR_RGB2BGR)
+    return positive
 
 
+def _show_preview(negative, profile=None):
+    import cv2
+    from preview import create_preview
 
-# Processing start
-t_start = time.time()
+    t_start = time.time()
+    result = create_preview(negative)
+    t_end = time.time()
 
-rotated_negative = straighten_35mm_negative(negative)
+    print("Scale: {:.3f}".format(result.scale))
+    print("Angle: {:.3f}, confidence: {:.2f}".format(result.angle, result.confidence))
+    print("Diff: {}".format(result.profile.color_correction))
 
+    print("Darkest color: {}".format(result.profile.darkest_color))
+    print("Brightest color: {}".format(result.profile.brightest_color))
 
+    print("Displacement: {}".format(result.profile.color_displacement))
+    print("Factor: {}".format(result.profile.color_factor))
 
-# Compute colors for white balance
-darkest_color, brightest_color = get_35mm_strip_colors(rotated_negative)
+    print("time: {:.3f}s".format((t_end-t_start)))
 
+    if profile is not None:
+        instrument.write_records(instrument.disable(), profile)
 
+    window = 'preview'
+    cv2.namedWindow(window, cv2.WINDOW_NORMAL)
+    cv2.resizeWindow(window, 800, 600)
 
+    cv2.imshow(window, _to_display(result.positive))
+    cv2.waitKey(0)
 
+    cv2.destroyAllWindows()
 
 
-# Let us do the white balance :)
-wb_negative = rotated_negative.copy()
+def batch(in_dir, out_dir, workers=None, overwrite=False, profile=None, roll=None, roll_samples=None,
+          pipeline=False, in_flight=None, density=None):
+    """
+    Processes a whole directory, prints one line per file and a report of all failed files.
 
-color_mask = calc_white_balance_diff(brightest_color)
-color_correction = -color_mask
+    :param in_dir: Directory with negatives.
+    :param out_dir: Directory for positives.
+    :param workers: Number of worker processes (threads of the geometry stage in pipeline mode).
+    :param overwrite: Process files again even if the output exists.
+    :param profile: Optional path to write the stage records to (see 'instrument.write_records()').
+    :param roll: Optional path of a roll profile, see 'run_batch()'.
+    :param roll_samples: Number of negatives a new roll profile is merged from.
+    :param pipeline: If True, files are processed by 'pipeline.run_pipeline()' within this process.
+    :param in_flight: Images within the pipeline at most.
+    :param density: Optional density output encoding, see 'run_batch()'.
+    :return: Exit code, 1 if any file failed.
+    """
+    from batch import run_batch
+    from pipeline import run_pipeline
 
-print("Mask: {}".format(color_mask))
-print("Diff: {}".format(color_correction))
+    def on_done(in_path, error):
+        print("{} {}".format("ok    " if error is None else "FAILED", in_path), flush=True)
 
+    t_start = time.time()
+    if pipeline:
+        if profile is not None:
+            instrument.enable()
 
-print("Darkest color: {}".format(darkest_color))
-print("Brightest color: {}".format(brightest_color))
+        (processed, skipped, failed) = run_pipeline(in_dir, out_dir, workers, overwrite, in_flight, on_done)
+        records = instrument.disable()
+    else:
+        records = [] if profile is not None else None
+        (processed, skipped, failed) = run_batch(
+            in_dir, out_dir, workers, overwrite, on_done, records, roll, roll_samples, density
+        )
+    t_end = time.time()
 
-# Apply color correction
+    if profile is not None:
+        instrument.write_records(records, profile)
 
-before_type = wb_negative.dtype
-wb_negative = wb_negative.astype(dtype=np.int64)
-wb_negative[:, :] += color_correction
-wb_negative = np.clip(wb_negative, 0, np.iinfo(before_type).max)
-wb_negative = wb_negative.astype(dtype=before_type)
+    print("processed: {}, skipped: {}, failed: {}, time: {:.3f}s".format(
+        len(processed), len(skipped), len(failed), t_end-t_start
+    ))
 
+    for (in_path, error) in failed:
+        print("\n{}:\n{}".format(in_path, error), file=sys.stderr)
 
-# And invert
-wb_negative = cv2.bitwise_not(wb_negative)
+    return 1 if len(failed) > 0 else 0
 
-# Now let us handle the contrast
-max_val = np.iinfo(wb_negative.dtype).max
-pos_brightest_color = max_val-(darkest_color+color_correction)
-pos_darkest_color = max_val-(brightest_color+color_correction)
 
-color_displacement = np.mean(pos_darkest_color) * 1.15
-color_factor = max_val/(np.mean(pos_brightest_color)-color_displacement) * 0.7
+def frames(path, out_dir, workers=None, profile=None):
+    """
+    Extracts the single frames of a negative, prints the written files.
 
-print("Pos. brightest: {}".format(pos_brightest_color))
-print("Pos. darkest:   {}".format(pos_darkest_color))
+    :param path: Path of negative.
+    :param out_dir: Directory for the positive frames.
+    :param workers: Number of threads.
+    :param profile: Optional path to write the stage records to (see 'instrument.write_records()').
+    :return: Exit code, 1 if no frame was found.
+    """
+    from batch import process_negative_frames
 
-print("Displacement: {}".format(color_displacement))
-print("Factor: {}".format(color_factor))
+    if profile is not None:
+        instrument.enable()
 
-before_type = wb_negative.dtype
-wb_negative = wb_negative.astype(dtype=np.int64)
+    t_start = time.time()
+    with instrument.image(path):
+        paths = process_negative_frames(path, out_dir, workers)
+    t_end = time.time()
 
-# First displacement
-wb_negative[:, :] = (wb_negative[:, :]-color_displacement)
-wb_negative = np.clip(wb_negative, 0, np.iinfo(before_type).max)
+    if profile is not None:
+        instrument.write_records(instrument.disable(), profile)
 
-# Then stretch
-wb_negative[:, :] = wb_negative[:, :] * color_factor
-wb_negative = np.clip(wb_negative, 0, np.iinfo(before_type).max)
+    for frame_path in paths:
+        print(frame_path)
 
-wb_negative = wb_negative.astype(dtype=before_type)
+    print("frames: {}, time: {:.3f}s".format(len(paths), t_end-t_start))
 
-t_end = time.time()
-print("time: {:.3f}s".format((t_end-t_start)))
-# Processing end
+    return 0 if len(paths) > 0 else 1
 
 
-cv2.imshow(window, wb_negative)
-cv2.waitKey(0)
+def strips(path, out_dir, workers=None, profile=None):
+    """
+    Processes a scan with several strips (e.g. from a flatbed), prints the written files and
+    the errors of failed strips.
+
+    :param path: Path of the scan.
+    :param out_dir: Directory for the positive strips.
+    :param workers: Number of threads.
+    :param profile: Optional path to write the stage records to (see 'instrument.write_records()').
+    :return: Exit code, 1 if any strip failed.
+    """
+    from batch import process_negative_strips
+
+    if profile is not None:
+        instrument.enable()
+
+    t_start = time.time()
+    with instrument.image(path):
+        results = process_negative_strips(path, out_dir, workers)
+    t_end = time.time()
+
+    if profile is not None:
+        instrument.write_records(instrument.disable(), profile)
+
+    failed = [(strip_path, error) for (strip_path, error) in results if error is not None]
+
+    for (strip_path, error) in results:
+        print("{} {}".format("ok    " if error is None else "FAILED", strip_path))
+
+    print("strips: {}, failed: {}, time: {:.3f}s".format(len(results), len(failed), t_end-t_start))
+
+    for (strip_path, error) in failed:
+        print("\n{}:\n{}".format(strip_path, error), file=sys.stderr)
+
+    return 1 if len(failed) > 0 else 0
+
+
+def watch(in_dir, out_dir, workers=None, poll=False, debounce=None):
+    """
+    Processes new negatives of a directory until Ctrl+C, prints one line per file with its
+    latency and a summary at the end.
+
+    :param in_dir: Watched directory, e.g. the output folder of the scanner software.
+    :param out_dir: Directory for positives.
+    :param workers: Number of worker processes.
+    :param poll: If True, the directory is polled instead of using inotify.
+    :param debounce: Seconds a file without close event must be unchanged before it is processed.
+    :return: Exit code, 1 if any file failed.
+    """
+    from watch import watch as run_watch
+
+    def on_done(in_path, error, latency, processing_time):
+        print("{} {} latency: {:.3f}s, processing: {:.3f}s".format(
+            "ok    " if error is None else "FAILED", in_path, latency, processing_time
+        ), flush=True)
+
+        if error is not None:
+            print(error, file=sys.stderr)
+
+    print("watching {}, Ctrl+C to stop".format(in_dir), flush=True)
+    results = run_watch(in_dir, out_dir, workers, poll, debounce, on_done)
+
+    latencies = sorted(result[2] for result in results)
+    failed = [result for result in results if result[1] is not None]
+
+    if latencies:
+        print("processed: {}, failed: {}, latency median: {:.3f}s, p95: {:.3f}s, max: {:.3f}s".format(
+            len(results), len(failed), latencies[len(latencies) // 2],
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], latencies[-1]
+        ))
+    else:
+        print("processed: 0")
+
+    return 1 if len(failed) > 0 else 0
+
+
+def create_parser():
+    profile_help = 'record time and memory per stage: Chrome trace for .json, otherwise JSON lines'
+    density_help = 'invert by density: film base removed per channel in log space, per channel white point. ' \
+                   'The positive stays density (log) encoded unless "linear" is given, which converts it ' \
+                   'back to linear light'
+
+    parser = argparse.ArgumentParser(prog='negative-extractor', description='Straightens and inverts film negatives.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    show_parser = commands.add_parser('show', help='process one negative and show the positive')
+    show_parser.add_argument('path', help='negative image')
+    show_parser.add_argument('--profile', metavar='PATH', help=profile_help)
+    show_parser.add_argument('--preview', action='store_true', help='quick downscaled 8bit positive')
+    show_parser.add_argument('--density', nargs='?', const='log', choices=density_outputs, help=density_help)
+
+    batch_parser = commands.add_parser('batch', help='process all TIFFs of a directory, headless')
+    batch_parser.add_argument('in_dir', help='directory with negatives')
+    batch_parser.add_argument('out_dir', help='directory for positives')
+    batch_parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: cores)')
+    batch_parser.add_argument('--overwrite', action='store_true', help='process files with existing output again')
+    batch_parser.add_argument('--profile', metavar='PATH', help=profile_help)
+    batch_parser.add_argument('--roll', metavar='PATH',
+                              help='invert all files with one roll profile (JSON), created if missing')
+    batch_parser.add_argument('--roll-samples', type=int, default=None, metavar='N',
+                              help='files a new roll profile is merged from (default: 3)')
+    batch_parser.add_argument('--pipeline', action='store_true',
+                              help='one process, load/compute/write overlapped in stages (e.g. for network drives)')
+    batch_parser.add_argument('--density', nargs='?', const='log', choices=density_outputs, help=density_help)
+    batch_parser.add_argument('--in-flight', type=int, default=None, metavar='K',
+                              help='images in memory at once in pipeline mode (default: 4)')
+
+    frames_parser = commands.add_parser('frames', help='extract the single frames of a negative as positives')
+    frames_parser.add_argument('path', help='negative image')
+    frames_parser.add_argument('out_dir', help='directory for frames')
+    frames_parser.add_argument('-j', '--workers', type=int, default=None, help='threads (default: cores)')
+    frames_parser.add_argument('--profile', metavar='PATH', help=profile_help)
+
+    strips_parser = commands.add_parser('strips', help='process a scan with several strips (e.g. flatbed)')
+    strips_parser.add_argument('path', help='scan with one or more strips')
+    strips_parser.add_argument('out_dir', help='directory for positives')
+    strips_parser.add_argument('-j', '--workers', type=int, default=None, help='threads (default: cores)')
+    strips_parser.add_argument('--profile', metavar='PATH', help=profile_help)
+
+    watch_parser = commands.add_parser('watch', help='process new negatives of a directory as they arrive')
+    watch_parser.add_argument('in_dir', help='watched directory (e.g. scanner hot folder)')
+    watch_parser.add_argument('out_dir', help='directory for positives')
+    watch_parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: cores)')
+    watch_parser.add_argument('--poll', action='store_true', help='poll the directory instead of using inotify')
+    watch_parser.add_argument('--debounce', type=float, default=None, metavar='S',
+                              help='seconds a file must be unchanged before it is processed, if no close event is '
+                                   'seen (default: 0.2)')
+
+    return parser
+
+
+def validate_args(parser, args):
+    """
+    Checks paths and numbers before anything gets processed. Exits with a usage error
+    (see 'argparse.ArgumentParser.error()') on the first problem.
+
+    Runs without loading OpenCV, so a typo is reported at once.
+
+    :param parser: Parser of 'create_parser()'.
+    :param args: Parsed arguments.
+    """
+    for name in ('workers', 'in_flight', 'roll_samples'):
+        value = getattr(args, name, None)
+        if value is not None and value < 1:
+            parser.error('--{} must be at least 1'.format(name.replace('_', '-')))
+
+    if getattr(args, 'debounce', None) is not None and args.debounce < 0:
+        parser.error('--debounce must not be negative')
+
+    if args.command in ('show', 'frames', 'strips') and not os.path.isfile(args.path):
+        parser.error('negative not found: {}'.format(args.path))
+
+    if args.command in ('batch', 'watch'):
+        if not os.path.isdir(args.in_dir):
+            parser.error('input directory not found: {}'.format(args.in_dir))
+
+        if args.command == 'watch' and os.path.realpath(args.in_dir) == os.path.realpath(args.out_dir):
+            parser.error('output directory must differ from the watched one')
+
+    out_dir = getattr(args, 'out_dir', None)
+    if out_dir is not None and os.path.exists(out_dir) and not os.path.isdir(out_dir):
+        parser.error('output is not a directory: {}'.format(out_dir))
+
+    profile = getattr(args, 'profile', None)
+    if profile is not None and not os.path.isdir(os.path.dirname(os.path.abspath(profile))):
+        parser.error('directory of --profile not found: {}'.format(profile))
+
+    if args.command == 'show' and args.preview and args.density is not None:
+        parser.error('--density is not supported with --preview')
+
+    if args.command == 'batch' and args.pipeline and args.density is not None:
+        parser.error('--density is not supported with --pipeline')
+
+    if args.command == 'batch' and args.roll is not None:
+        if args.pipeline:
+            parser.error('--roll is not supported with --pipeline')
+
+        if args.density is not None:
+            parser.error('--roll is not supported with --density')
+
+        if os.path.exists(args.roll):
+            from roll import load_roll_profile
+
+            try:
+                load_roll_profile(args.roll)
+            except (OSError, ValueError, KeyError, TypeError, AssertionError) as e:
+                parser.error('invalid roll profile {}: {}'.format(args.roll, e))
+
+
+def main(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    validate_args(parser, args)
+
+    if args.command == 'show':
+        show(args.path, args.profile, args.preview, args.density)
+        return 0
+    elif args.command == 'batch':
+        return batch(args.in_dir, args.out_dir, args.workers, args.overwrite, args.profile, args.roll,
+                     args.roll_samples, args.pipeline, args.in_flight, args.density)
+    elif args.command == 'frames':
+        return frames(args.path, args.out_dir, args.workers, args.profile)
+    elif args.command == 'strips':
+        return strips(args.path, args.out_dir, args.workers, args.profile)
+    elif args.command == 'watch':
+        return watch(args.in_dir, args.out_dir, args.workers, args.poll, args.debounce)
 
-cv2.destroyAllWindows()
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+import asyncio
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import instrument
+from batch import list_negatives, output_path_for, output_extension
+from f135 import straighten_35mm_negative, get_35mm_strip_colors
+from invert import invert_negative
+from tiff import read_negative, write_tiff
+
+# Images held in memory at once, counted from loading until written
+pipeline_in_flight = 4
+
+# Images waiting between two stages
+pipeline_queue_size = 1
+
+# Threads for loading and writing, these mostly wait for the disk or network
+pipeline_io_workers = 2
+
+
+class _Item(object):
+    # One image passing through the stages
+    __slots__ = ('in_path', 'out_path', 'negative', 'positive', 'geometry', 'colors', 'error')
+
+    def __init__(self, in_path, out_path):
+        self.in_path = in_path
+        self.out_path = out_path
+        self.negative = None
+        self.positive = None
+        self.geometry = None
+        self.colors = None
+        self.error = None
+
+
+def _load(item, preload=True):
+    item.negative = read_negative(item.in_path)
+
+    if preload and isinstance(item.negative, np.memmap):
+        # Pull the whole file now, so the compute stages do not wait for the disk
+        item.negative = np.array(item.negative)
+
+
+def _straighten(item):
+    (item.positive, item.geometry) = straighten_35mm_negative(item.negative, return_geometry=True, low_memory=True)
+    item.negative = None
+
+
+def _colors(item):
+    item.colors = get_35mm_strip_colors(item.positive, geometry=item.geometry)
+
+
+def _invert(item):
+    invert_negative(item.positive, item.colors[0], item.colors[1], in_place=True)
+
+
+def _write(item):
+    tmp_path = item.out_path + '.part' + output_extension
+    try:
+        write_tiff(tmp_path, item.positive, bgr=False)
+        os.replace(tmp_path, item.out_path)
+    finally:
+        # Only complete outputs are renamed into place, a partial one is removed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _run_step(name, func, item):
+    with instrument.image(item.in_path):
+        try:
+            with instrument.stage(name):
+                func(item)
+        except Exception:
+            item.error = traceback.format_exc()
+
+            # Nothing of a failed image is needed anymore
+            item.negative = None
+            item.positive = None
+
+
+async def _stage(name, func, executor, in_queue, out_queue, tasks=1):
+    # Runs func on every item in the executor. None marks the end of the queue.
+    loop = asyncio.get_running_loop()
+    running = [tasks]
+
+    async def work():
+        while True:
+            item = await in_queue.get()
+
+            if item is None:
+                # Leave the end mark for the other tasks, the last one passes it on
+                await in_queue.put(None)
+                running[0] -= 1
+                if running[0] == 0:
+                    await out_queue.put(None)
+                return
+
+            if item.error is None:
+                await loop.run_in_executor(executor, _run_step, name, func, item)
+
+            await out_queue.put(item)
+
+    await asyncio.gather(*[work() for i in range(0, tasks)])
+
+
+async def run_pipeline_async(jobs, workers=None, in_flight=None, preload=True, on_done=None):
+    """
+    Processes negatives in a pipeline of stages connected by bounded queues:
+    load, geometry ('straighten_35mm_negative()'), colors ('get_35mm_strip_colors()'),
+    invert and write.
+
+    Every stage runs in a thread pool, so loading and writing overlap with the compute stages
+    of other images. OpenCV releases the GIL, so the compute stages run in parallel too.
+    Images are only loaded while less than in_flight images are within the pipeline, which
+    bounds the memory.
+
+    Errors are handled like in 'batch.process_negative_file()': a failed image skips the
+    remaining stages and is reported.
+
+    :param jobs: List of tuples (in_path, out_path).
+    :param workers: Threads of the geometry stage (the slowest), defaults to the number of cores.
+    :param in_flight: Images within the pipeline at most, defaults to 'pipeline_in_flight'.
+    :param preload: If True, memory mapped negatives are read completely in the load stage.
+    :param on_done: Optional callback(in_path, error), called for every finished file.
+    :return: Tuple (processed, failed). failed is a list of (in_path, error).
+    """
+    workers = workers or os.cpu_count() or 1
+    in_flight = asyncio.Semaphore(in_flight or pipeline_in_flight)
+
+    stages = [
+        ('read', lambda item: _load(item, preload), pipeline_io_workers),
+        ('geometry', _straighten, workers),
+        ('colors', _colors, 1),
+        ('invert', _invert, 1),
+        ('write', _write, pipeline_io_workers),
+    ]
+
+    queues = [asyncio.Queue(maxsize=pipeline_queue_size) for i in range(0, len(stages) + 1)]
+
+    processed = []
+    failed = []
+
+    async def feed():
+        for (in_path, out_path) in jobs:
+            await in_flight.acquire()
+            await queues[0].put(_Item(in_path, out_path))
+
+        await queues[0].put(None)
+
+    async def collect():
+        while True:
+            item = await queues[-1].get()
+            if item is None:
+                return
+
+            in_flight.release()
+
+            if item.error is None:
+                processed.append(item.in_path)
+            else:
+                failed.append((item.in_path, item.error))
+
+            if on_done is not None:
+                on_done(item.in_path, item.error)
+
+    io_executor = ThreadPoolExecutor(max_workers=pipeline_io_workers, thread_name_prefix='pipeline-io')
+    cpu_executor = ThreadPoolExecutor(max_workers=workers + 2, thread_name_prefix='pipeline-cpu')
+
+    try:
+        tasks = [feed(), collect()]
+        for (i, (name, func, tasks_count)) in enumerate(stages):
+            executor = io_executor if name in ('read', 'write') else cpu_executor
+            tasks.append(_stage(name, func, executor, queues[i], queues[i + 1], tasks_count))
+
+        await asyncio.gather(*tasks)
+    finally:
+        io_executor.shutdown()
+        cpu_executor.shutdown()
+
+    return processed, failed
+
+
+def run_pipeline(in_dir, out_dir, workers=None, overwrite=False, in_flight=None, on_done=None):
+    """
+    Processes all negatives of a directory within this process, see 'run_pipeline_async()'.
+
+    Lists and skips files like 'batch.run_batch()'.
+
+    :param in_dir: Directory with negatives.
+    :param out_dir: Directory for positives. Will be created if missing.
+    :param workers: Threads of the geometry stage, defaults to the number of cores.
+    :param overwrite: If True, existing outputs are processed again.
+    :param in_flight: Images within the pipeline at most, defaults to 'pipeline_in_flight'.
+    :param on_done: Optional callback(in_path, error), called for every finished file.
+    :return: Tuple (processed, skipped, failed). failed is a list of (in_path, error).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    jobs = []
+    skipped = []
+    for in_path in list_negatives(in_dir):
+        out_path = output_path_for(in_path, out_dir)
+
+        if not overwrite and os.path.exists(out_path):
+            skipped.append(in_path)
+        else:
+            jobs.append((in_path, out_path))
+
+    (processed, failed) = asyncio.run(run_pipeline_async(jobs, workers, in_flight, on_done=on_done))
+
+    return processed, skipped, failed
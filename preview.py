@@ -0,0 +1,105 @@
+import math
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from f135 import straighten_35mm_negative, get_35mm_strip_colors, get_straightening_matrix, \
+    warp_straightened_region
+from instrument import instrumented, stage
+from invert import apply_lut
+from roll import create_roll_profile, create_roll_lut
+
+# Size of the downscaled negative the preview is computed on
+preview_pixels = 1.5e6
+
+# Result of 'create_preview()'
+#  > positive: straight 8bit positive of the downscaled negative, same channel order as the negative
+#  > scale: factor the negative was downscaled with, 1 if it was small enough already
+#  > angle: strip rotation in degrees, see 'StripGeometry'
+#  > profile: RollProfile with the film base colors and inversion parameters, in the dtype of the negative
+#  > confidence: confidence of the sprocket hole detection, see 'StripGeometry'
+Preview = namedtuple('Preview', ['positive', 'scale', 'angle', 'profile', 'confidence'])
+
+
+def downscale_negative(negative, pixels=None):
+    """
+    Downscales the negative to about the given number of pixels, keeping its dtype.
+
+    Rows and columns are skipped first, so only a part of a memory mapped negative is read,
+    the rest is area averaged.
+
+    :param negative: Original negative.
+    :param pixels: Pixels of the result, defaults to 'preview_pixels'.
+    :return: Tuple (downscaled negative, scale). Small negatives are returned as they are with scale 1.
+    """
+    pixels = pixels or preview_pixels
+
+    (h, w) = negative.shape[:2]
+    scale = min(1.0, math.sqrt(pixels / (h * w)))
+    if scale == 1.0:
+        return negative, scale
+
+    # Skip at most every other pixel of the area that gets averaged, keeps the noise down
+    step = max(1, int(1 / scale) // 2)
+    if step > 1:
+        negative = np.ascontiguousarray(negative[::step, ::step])
+
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    with stage('resize'):
+        small = cv2.resize(negative, size, interpolation=cv2.INTER_AREA)
+
+    return small, size[0] / w
+
+
+@instrumented
+def create_preview(negative, pixels=None, line_fit=None):
+    """
+    Runs the whole pipeline of 'batch.process_35mm_negative()' on a downscaled copy of the
+    negative, for a quick look before the full resolution pass.
+
+    The strip angle does not depend on the scale, and the film base colors are taken from the
+    downscaled negative in its original dtype. So the returned parameters can be passed to
+    'render_full()' to render the full resolution positive without detecting anything again.
+
+    :param negative: Original negative (uint8 or uint16).
+    :param pixels: Pixels of the downscaled negative, defaults to 'preview_pixels'.
+    :param line_fit: Method to fit the lines through the holes, see 'fit_line()'.
+    :return: Preview.
+    """
+    (small, scale) = downscale_negative(negative, pixels)
+
+    (rotated, geometry) = straighten_35mm_negative(small, return_geometry=True, low_memory=True, line_fit=line_fit)
+
+    (darkest_color, brightest_color) = get_35mm_strip_colors(rotated, geometry=geometry)
+    profile = create_roll_profile([(darkest_color, brightest_color)], rotated.dtype)
+
+    positive = apply_lut(rotated, create_roll_lut(profile))
+
+    if positive.dtype != np.uint8:
+        max_val = np.iinfo(positive.dtype).max
+        positive = cv2.convertScaleAbs(positive, alpha=255.0 / max_val)
+
+    return Preview(positive, scale, geometry.angle, profile, geometry.confidence)
+
+
+@instrumented
+def render_full(negative, preview, out=None):
+    """
+    Renders the full resolution positive with the angle and inversion parameters of a preview.
+
+    The output equals 'batch.process_35mm_negative()' with the preview's profile as roll profile,
+    except that the angle was detected on the downscaled negative.
+
+    :param negative: Original negative, the one the preview was created from.
+    :param preview: Preview, see 'create_preview()'.
+    :param out: Optional output buffer, see 'get_straightened_shape()'.
+    :return: Straight positive with border.
+    """
+    assert negative.dtype.name == preview.profile.dtype, \
+        "Preview is for {}, negative is {}".format(preview.profile.dtype, negative.dtype)
+
+    rotation_matrix = get_straightening_matrix(negative.shape, preview.angle)
+    rotated = warp_straightened_region(negative, rotation_matrix, out=out)
+
+    return apply_lut(rotated, create_roll_lut(preview.profile))
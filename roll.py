@@ -0,0 +1,110 @@
+import json
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+# Strips the film base colors are merged from, if a roll profile is created during a batch run
+roll_sample_strips = 3
+
+roll_profile_version = 1
+
+# Inversion parameters shared by all scans of one film roll, see 'create_roll_profile()'
+#  > dtype: name of the image dtype the values belong to, e.g. 'uint16'
+#  > darkest_color, brightest_color: merged film base colors, tuples of ints
+#  > color_correction, color_displacement, color_factor: see 'calc_inversion_params()'
+#  > strips: names of the scans the colors were taken from
+# All fields are plain python values, so profiles are hashable and can be pickled and stored as JSON.
+# Profiles are loaded without OpenCV (e.g. to validate arguments), 'invert' is imported where needed.
+RollProfile = namedtuple('RollProfile', [
+    'dtype', 'darkest_color', 'brightest_color', 'color_correction', 'color_displacement', 'color_factor', 'strips'
+])
+
+
+def create_roll_profile(strip_colors, dtype, strips=()):
+    """
+    Merges the film base colors of several strips of one roll and computes the inversion parameters.
+
+    Colors are merged by the per channel median, so one strip with a bad detection does not
+    spoil the profile.
+
+    :param strip_colors: List of tuples (darkest_color, brightest_color), see 'get_35mm_strip_colors()'.
+    :param dtype: Image dtype.
+    :param strips: Optional names of the strips, stored for reference.
+    :return: RollProfile.
+    """
+    from invert import calc_inversion_params
+
+    assert len(strip_colors) > 0, "At least one strip is needed"
+
+    dtype = np.dtype(dtype)
+
+    def merge(colors):
+        return np.round(np.median(np.array(colors, dtype=np.float64), axis=0)).astype(dtype)
+
+    darkest_color = merge([colors[0] for colors in strip_colors])
+    brightest_color = merge([colors[1] for colors in strip_colors])
+
+    (color_correction, color_displacement, color_factor) = \
+        calc_inversion_params(darkest_color, brightest_color, dtype)
+
+    return RollProfile(
+        dtype.name,
+        tuple(int(c) for c in darkest_color),
+        tuple(int(c) for c in brightest_color),
+        tuple(int(c) for c in color_correction),
+        float(color_displacement),
+        float(color_factor),
+        tuple(strips)
+    )
+
+
+def save_roll_profile(profile, path):
+    """
+    :param profile: RollProfile.
+    :param path: Path of the JSON file.
+    """
+    data = dict(profile._asdict(), version=roll_profile_version)
+
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2)
+
+
+def load_roll_profile(path):
+    """
+    :param path: Path of a JSON file written by 'save_roll_profile()'.
+    :return: RollProfile.
+    """
+    with open(path) as file:
+        data = json.load(file)
+
+    assert data.get('version') == roll_profile_version, \
+        "Unsupported roll profile version {} in {}".format(data.get('version'), path)
+
+    return RollProfile(
+        data['dtype'],
+        tuple(data['darkest_color']),
+        tuple(data['brightest_color']),
+        tuple(data['color_correction']),
+        data['color_displacement'],
+        data['color_factor'],
+        tuple(data['strips'])
+    )
+
+
+@lru_cache(maxsize=4)
+def create_roll_lut(profile):
+    """
+    Creates the inversion table of a roll profile, cached as all scans of a roll use the same table.
+
+    :param profile: RollProfile.
+    :return: Table, see 'create_inversion_lut()'. Do not modify.
+    """
+    from invert import create_inversion_lut
+
+    return create_inversion_lut(
+        np.array(profile.color_correction, dtype=np.int64),
+        profile.color_displacement,
+        profile.color_factor,
+        np.dtype(profile.dtype)
+    )
@@ -0,0 +1,126 @@
+import cv2
+import numpy as np
+
+from f135 import get_35mm_strip_geometry, get_straightened_shape, warp_straightened_region, \
+    get_35mm_negative_colors
+from instrument import instrumented
+from invert import calc_inversion_params, create_inversion_lut, apply_lut
+from strip import find_sprocket_holes, detection_scale, detection_factor, refine_sprocket_holes
+from util import scale_contours
+
+# Output rows rendered at once
+stream_tile_rows = 256
+
+# Default precision of the angle detected on the preview, in degrees
+stream_angle_tolerance = 0.05
+
+
+@instrumented
+def downscale_tiled(negative, factor, tile_rows=None):
+    """
+    Downscales by an integer factor with cv2.INTER_AREA, reading only a few rows at a time.
+    Columns and rows not filling a whole block are dropped.
+
+    Works on any array supporting numpy slicing, e.g. memory mapped files.
+
+    :param negative: Image.
+    :param factor: Integer factor, 2 means half the size.
+    :param tile_rows: Rows of the original read at once, defaults to 'stream_tile_rows'.
+    :return: Downscaled image.
+    """
+    tile_rows = tile_rows or stream_tile_rows
+
+    (h, w) = negative.shape[:2]
+    (dh, dw) = (h // factor, w // factor)
+
+    small = np.empty((dh, dw) + negative.shape[2:], dtype=negative.dtype)
+
+    # Rows of the result per block
+    block_rows = max(1, tile_rows // factor)
+
+    for y in range(0, dh, block_rows):
+        rows = min(block_rows, dh - y)
+        block = negative[y * factor:(y + rows) * factor, :dw * factor]
+        small[y:y + rows] = cv2.resize(np.ascontiguousarray(block), (dw, rows), interpolation=cv2.INTER_AREA)
+
+    return small
+
+
+@instrumented
+def detect_35mm_geometry_tiled(negative, angle_tolerance=None, refine=False):
+    """
+    Detects the sprocket holes on a preview created tile by tile and computes the strip geometry.
+
+    :param negative: Original negative, e.g. memory mapped.
+    :param angle_tolerance: Tolerated error of the angle in degrees (greater than 0), defaults to
+        'stream_angle_tolerance'.
+    :param refine: If True, holes are refined on full resolution crops.
+    :return: StripGeometry, see 'straighten_35mm_negative()'.
+    """
+    if angle_tolerance is None:
+        angle_tolerance = stream_angle_tolerance
+
+    factor = detection_factor(detection_scale(negative, angle_tolerance))
+    preview = downscale_tiled(negative, factor)
+
+    (top_holes, bottom_holes) = find_sprocket_holes(preview)
+
+    if factor > 1:
+        top_holes = scale_contours(top_holes, 1.0 / factor)
+        bottom_holes = scale_contours(bottom_holes, 1.0 / factor)
+
+        if refine:
+            top_holes = refine_sprocket_holes(negative, top_holes)
+            bottom_holes = refine_sprocket_holes(negative, bottom_holes)
+
+    return get_35mm_strip_geometry(negative.shape, top_holes, bottom_holes)
+
+
+@instrumented
+def process_35mm_negative_tiled(negative, out=None, tile_rows=None, angle_tolerance=None, refine=False):
+    """
+    Straightens and inverts a negative tile by tile, for scans larger than the available memory.
+
+    The geometry is detected on a small preview. Afterwards only the border areas needed for
+    the film base colors are rendered, and then the output is rendered in tiles of rows:
+    rotation, white balance and inversion per tile. Each tile reads just the source rows it
+    maps to, so with a memory mapped input and output, peak memory depends on the tile size
+    only (and on the rotation, which makes the source rows of a tile overlap).
+
+    Result equals 'straighten_35mm_negative()' in low memory mode followed by the inversion, up to
+    rounding of the interpolation.
+
+    :param negative: Original negative, e.g. memory mapped.
+    :param out: Output buffer (e.g. memory mapped), see 'get_straightened_shape()'. Allocated if not given.
+    :param tile_rows: Output rows per tile, defaults to 'stream_tile_rows'.
+    :param angle_tolerance: Tolerated error of the angle in degrees (greater than 0), defaults to
+        'stream_angle_tolerance'.
+    :param refine: If True, holes are refined on full resolution crops.
+    :return: Tuple (positive, geometry, (darkest_color, brightest_color)).
+    """
+    tile_rows = tile_rows or stream_tile_rows
+
+    geometry = detect_35mm_geometry_tiled(negative, angle_tolerance, refine)
+
+    (darkest_color, brightest_color) = get_35mm_negative_colors(negative, geometry)
+
+    (color_correction, color_displacement, color_factor) = \
+        calc_inversion_params(darkest_color, brightest_color, negative.dtype)
+    lut = create_inversion_lut(color_correction, color_displacement, color_factor, negative.dtype)
+
+    shape = get_straightened_shape(negative.shape)
+    if out is None:
+        out = np.empty(shape, dtype=negative.dtype)
+
+    assert out.shape == shape and out.dtype == negative.dtype, \
+        "Expected output buffer {} {}, got {} {}".format(shape, negative.dtype, out.shape, out.dtype)
+
+    (h, w) = shape[:2]
+    for y in range(0, h, tile_rows):
+        y2 = min(y + tile_rows, h)
+        tile = out[y:y2]
+
+        warp_straightened_region(negative, geometry.rotation_matrix, (0, y, w, y2), out=tile)
+        apply_lut(tile, lut)
+
+    return out, geometry, (darkest_color, brightest_color)
@@ -1,7 +1,9 @@
 import math
 
 import cv2
-from util import group_contours_by_distance, points_to_line, contour_center
+from instrument import instrumented, stage
+from util import group_contours_by_distance, points_to_line, contour_center, scale_contours, SprocketHole, \
+    contour_array, contour_rect, create_sprocket_holes
 import numpy as np
 
 border_size_rel_to_dims = 0.01
@@ -12,7 +14,36 @@ blur_min_size = 2
 
 bw_threshold_percent = 0.9
 
+# Area around a coarse sprocket hole that is searched again in full resolution
+refine_margin_rel_to_hole_size = 0.25
 
+# Downscaled sprocket hole detection, see 'detection_scale()'
+#  > smallest size (shorter side, in pixels) of a hole on the detection image
+detection_min_hole_size = 10
+#  > lower estimate of the hole size relative to the shorter side of a scan (film is 35mm, holes about 2mm)
+hole_size_rel_to_negative_height = 0.04
+
+# Multi strip scans, see 'find_strips()'
+#  > root contours with at least this share of the biggest one's area are strips
+strip_min_area_rel_to_biggest = 0.5
+#  > longer side of the image strips are searched in
+strip_detection_size = 1500
+#  > margin of background around each strip, relative to the strip's shorter side
+strip_margin_rel_to_size = 0.05
+
+
+def get_border_size(shape):
+    """
+    Computes the border size used by 'create_bordered_negative()': 1% of max dims, at least 4.
+
+    :param shape: Shape of the negative image.
+    :return: Border size in pixels.
+    """
+    (h, w) = shape[:2]
+    return int(math.ceil(max(border_size_rel_to_dims * max(h, w), border_min_size)))
+
+
+@instrumented
 def create_bordered_negative(negative):
     """
     Adds 1% wide border around the negative. Border color is white.
@@ -22,8 +53,7 @@ def create_bordered_negative(negative):
     :param negative: Negative image.
     :return: Image with additional white border.
     """
-    (h, w) = negative.shape[:2]
-    pad = int(math.ceil(max(border_size_rel_to_dims * max(h, w), border_min_size)))
+    pad = get_border_size(negative.shape)
 
     border_color = (np.iinfo(negative.dtype).max,) * 3
 
@@ -37,6 +67,7 @@ def create_bordered_negative(negative):
     return border_negative
 
 
+@instrumented
 def create_bw_negative(negative):
     """
     The image will be made black and white. The negative (strip) will be white and
@@ -44,25 +75,32 @@ def create_bw_negative(negative):
 
     Min blur size is 2, or 0.1% of max dims.
 
-    Supports any color depth.
+    Supports any color depth. Gray images (one channel) are used as they are, so for speed
+    pass a gray (and downscaled) image, see 'find_sprocket_holes()'. The result is always
+    an 8bit mask, the blurred gray image is compared straight into it.
 
     :param negative: Negative image.
-    :return: Negative as bw image. Background and holes are black, strip white.
+    :return: Negative as bw image (uint8, 0 or 255). Background and holes are black, strip white.
     """
 
     (h, w) = negative.shape[:2]
     blur_size = int(math.ceil(max(blur_size_rel_to_dims * max(h, w), blur_min_size)))
 
+    # Pixel values are integers, so comparing to the floored threshold equals cv2.threshold
     max_val = np.iinfo(negative.dtype).max
-    threshold_val = max_val * bw_threshold_percent
+    threshold_val = int(math.floor(max_val * bw_threshold_percent))
+
+    gray_negative = negative
+    if negative.ndim == 3:
+        gray_negative = cv2.cvtColor(negative, cv2.COLOR_RGB2GRAY)
 
-    gray_negative = cv2.cvtColor(negative, cv2.COLOR_BGR2GRAY)
+    # Box filter, runs in constant time per pixel no matter the blur size
     gray_blur = cv2.blur(gray_negative, (blur_size, blur_size))
-    (thresh, bw_negative) = cv2.threshold(gray_blur, threshold_val, max_val, cv2.THRESH_BINARY_INV)
 
-    return bw_negative
+    return cv2.compare(gray_blur, threshold_val, cv2.CMP_LE)
 
 
+@instrumented
 def get_sprocket_holes_contours(bw_negative):
     """
     Assumes the given image has a black background around the negative.
@@ -73,15 +111,16 @@ def get_sprocket_holes_contours(bw_negative):
     Searches the biggest contour in the first hierarchy level (prevents dust) and then grabs
     all its children as sprocket holes.
 
-    :param bw_negative: Negative with black background/border and white strip.
-    :return: All contours found within the strip. Not arranged.
+    :param bw_negative: Negative with black background/border and white strip, see 'create_bw_negative()'.
+    :return: All contours found within the strip as SprocketHole objects. Not arranged.
     """
 
-    # findContours can only handle 8bit images
-    if bw_negative.dtype is not np.uint8:
-        bw8 = bw_negative.astype(np.uint8)
+    # findContours can only handle 8bit images, other depths are turned into a mask without
+    # casting (a cast would wrap values around)
+    if bw_negative.dtype != np.uint8:
+        bw_negative = cv2.compare(bw_negative, 0, cv2.CMP_GT)
 
-    contours, hierarchy = cv2.findContours(bw8, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    contours, hierarchy = cv2.findContours(bw_negative, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
     # Grab size of first root contour, assume it is the biggest
     big_root = 0
@@ -109,9 +148,87 @@ def get_sprocket_holes_contours(bw_negative):
         child_contours.append(contours[child_contour])
         child_contour = hierarchy[0][child_contour][0]
 
-    return child_contours
+    return create_sprocket_holes(child_contours)
+
+
+@instrumented
+def find_strips(negative):
+    """
+    Finds all film strips of a scan with several strips side by side (e.g. from a flatbed).
+
+    Every root contour of the bw image (see 'create_bw_negative()') is a strip candidate, like
+    the single biggest one in 'get_sprocket_holes_contours()'. Candidates with at least
+    'strip_min_area_rel_to_biggest' of the area of the biggest one are strips, the rest is dust.
+    Detection runs on a gray image downscaled to 'strip_detection_size'.
+
+    The rects are upright, of tilted strips lying close together they may contain corners of
+    the neighbours. 'get_sprocket_holes_contours()' only uses the biggest root contour, so
+    those corners do not disturb the detection.
+
+    Supports any color depth.
+
+    :param negative: Scan with one or more strips on white background.
+    :return: List of rects (x1, y1, x2, y2) with some background around each strip, sorted
+        top to bottom (rows within the size of a sprocket hole), then left to right.
+    """
+    (h, w) = negative.shape[:2]
+
+    gray_negative = negative
+    if negative.ndim == 3:
+        gray_negative = cv2.cvtColor(negative, cv2.COLOR_RGB2GRAY)
+
+    scale = min(1.0, strip_detection_size / max(h, w))
+    factor = detection_factor(scale)
+    if factor > 1:
+        with stage('resize'):
+            gray_negative = downscale_by_factor(gray_negative, factor)
 
+    pad = get_border_size(gray_negative.shape)
+    bw_negative = create_bw_negative(create_bordered_negative(gray_negative))
 
+    contours, _ = cv2.findContours(bw_negative, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    assert len(contours) > 0, "No strip found"
+
+    sizes = [rect[1][0] * rect[1][1] for rect in map(cv2.minAreaRect, contours)]
+    min_size = max(sizes) * strip_min_area_rel_to_biggest
+
+    # Back to the coordinates of the negative, the resized dims are rounded
+    (dh, dw) = gray_negative.shape[:2]
+    (fx, fy) = (w / dw, h / dh)
+
+    rects = []
+    for (contour, size) in zip(contours, sizes):
+        if size < min_size:
+            continue
+
+        (x, y, cw, ch) = cv2.boundingRect(contour)
+        (x1, y1, x2, y2) = ((x - pad) * fx, (y - pad) * fy, (x + cw - pad) * fx, (y + ch - pad) * fy)
+
+        margin = strip_margin_rel_to_size * min(x2 - x1, y2 - y1)
+
+        rects.append((
+            max(0, int(math.floor(x1 - margin))),
+            max(0, int(math.floor(y1 - margin))),
+            min(w, int(math.ceil(x2 + margin))),
+            min(h, int(math.ceil(y2 + margin)))
+        ))
+
+    # Tops of strips side by side differ slightly, a strip starts a new row if its top is more
+    # than a sprocket hole size (see 'hole_size_rel_to_negative_height') below the top of the
+    # row's first strip. Within a row left to right.
+    strip_height = min(min(x2 - x1, y2 - y1) for (x1, y1, x2, y2) in rects)
+    hole_size = hole_size_rel_to_negative_height * strip_height
+
+    rows = []
+    for rect in sorted(rects, key=lambda rect: rect[1]):
+        if len(rows) == 0 or rect[1] - rows[-1][0][1] > hole_size:
+            rows.append([])
+        rows[-1].append(rect)
+
+    return [rect for row in rows for rect in sorted(row, key=lambda rect: rect[0])]
+
+
+@instrumented
 def split_sprocket_holes(sprocket_holes_contours):
     """
     Splits the given sprocket holes into two groups: top and bottom holes.
@@ -174,7 +291,7 @@ def get_average_sprocket_hole_size(sprocket_holes_contours):
     height_sum = 0
 
     for hole in sprocket_holes_contours:
-        rect = cv2.minAreaRect(hole)
+        rect = contour_rect(hole)
         width_sum += rect[1][0]
         height_sum += rect[1][1]
 
@@ -182,3 +299,164 @@ def get_average_sprocket_hole_size(sprocket_holes_contours):
     avg_height = height_sum / len(sprocket_holes_contours)
 
     return avg_width, avg_height
+
+
+def detection_scale(negative, angle_tolerance_degrees):
+    """
+    Computes the factor the negative can be downscaled with for detecting the sprocket holes.
+
+    A shift of one pixel over the whole image width equals an angle of atan(1/width). The
+    image is made just wide enough so that this angle is not above the given tolerance.
+    As hole centers are averaged over many pixels, the real error is usually much lower.
+
+    The scale is never so low that the holes get smaller than 'detection_min_hole_size',
+    below that they merge with the background and the detection fails.
+
+    :param negative: Negative image.
+    :param angle_tolerance_degrees: Tolerated error of the strip angle in degrees, greater than 0.
+    :return: Scale factor, never greater than 1.
+    """
+    assert angle_tolerance_degrees > 0, \
+        "Angle tolerance must be greater than 0, got {}".format(angle_tolerance_degrees)
+
+    (h, w) = negative.shape[:2]
+    needed_size = 1.0 / math.tan(math.radians(angle_tolerance_degrees))
+
+    min_scale = detection_min_hole_size / (hole_size_rel_to_negative_height * min(h, w))
+
+    return min(1.0, max(needed_size / max(h, w), min_scale))
+
+
+def detection_factor(scale):
+    """
+    Integer downscale factor for a detection scale (see 'detection_scale()'), the detection
+    image is never smaller than the scale asks for.
+
+    :param scale: Scale factor.
+    :return: Integer factor, 1 means full resolution.
+    """
+    if scale >= 1.0:
+        return 1
+
+    # Tolerance for scales like 1/3 that are not exact
+    return max(1, int(math.floor(1.0 / scale + 1e-9)))
+
+
+@instrumented
+def create_detection_image(negative, factor=1):
+    """
+    Creates the gray image the sprocket holes are detected on.
+
+    Downscaling comes first, so only a part of the negative is touched: of each block of
+    'factor' rows only the middle one is read and converted to gray, its columns are then
+    averaged in blocks of 'factor' (cv2.INTER_AREA with an integer factor). Columns and rows
+    not filling a whole block are dropped, like 'stream.downscale_tiled()' does. The blur of
+    'create_bw_negative()' takes care of the noise the row sampling leaves.
+
+    :param negative: Negative image, any color depth.
+    :param factor: Integer downscale factor, see 'detection_factor()'.
+    :return: Gray image of shape (h // factor, w // factor).
+    """
+    if factor > 1:
+        (h, w) = negative.shape[:2]
+        (dh, dw) = (h // factor, w // factor)
+        negative = negative[factor // 2:dh * factor:factor, :dw * factor]
+
+    gray_negative = negative
+    if negative.ndim == 3:
+        gray_negative = cv2.cvtColor(negative, cv2.COLOR_RGB2GRAY)
+
+    if factor > 1:
+        gray_negative = cv2.resize(gray_negative, (dw, dh), interpolation=cv2.INTER_AREA)
+
+    return gray_negative
+
+
+@instrumented
+def refine_sprocket_holes(negative, sprocket_holes_contours):
+    """
+    Searches the given (coarse) sprocket holes again in full resolution. Only a small
+    crop around each hole is processed.
+
+    If a hole can not be found properly within its crop (e.g. it touches the crop border),
+    the coarse contour is kept.
+
+    :param negative: Full resolution negative.
+    :param sprocket_holes_contours: Coarse contours in full resolution coordinates.
+    :return: List of refined sprocket holes, same order as given.
+    """
+    (h, w) = negative.shape[:2]
+    refined = []
+
+    for contour in sprocket_holes_contours:
+        (x, y, rw, rh) = cv2.boundingRect(contour_array(contour))
+        margin = int(math.ceil(max(rw, rh) * refine_margin_rel_to_hole_size))
+
+        x1 = max(x - margin, 0)
+        y1 = max(y - margin, 0)
+        x2 = min(x + rw + margin, w)
+        y2 = min(y + rh + margin, h)
+
+        # The hole is black within the bw crop, make it white to find it as outer contour
+        bw_crop = cv2.bitwise_not(create_bw_negative(negative[y1:y2, x1:x2]))
+        crop_contours, _ = cv2.findContours(bw_crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x1, y1))
+
+        center = tuple(contour_center(contour))
+        hole = contour
+
+        for crop_contour in crop_contours:
+            if cv2.pointPolygonTest(crop_contour, center, False) < 0:
+                continue
+
+            # Touching the crop border means it is connected to the background
+            (cx, cy, cw, ch) = cv2.boundingRect(crop_contour)
+            if cx > x1 and cy > y1 and cx + cw < x2 and cy + ch < y2:
+                hole = SprocketHole(crop_contour)
+
+            break
+
+        refined.append(hole)
+
+    return refined
+
+
+@instrumented
+def find_sprocket_holes(negative, scale=1.0, refine=False):
+    """
+    Creates the bw image, finds all sprocket holes and splits them into top and bottom holes.
+
+    The negative does not need a border: it is converted to gray first and only this gray
+    detection image gets a white border. With a scale lower than 1, the detection image is
+    downscaled by the integer factor of 'detection_factor()' (see 'create_detection_image()')
+    and the contours are scaled back. Optionally they get refined in full resolution
+    (see 'refine_sprocket_holes()').
+
+    Supports any color depth.
+
+    :param negative: Negative image, with or without white border.
+    :param scale: Factor for the detection image.
+    :param refine: If True, downscaled holes are searched again in full resolution.
+    :return: Tuple (top_holes, bottom_holes) in coordinates of the given negative, as SprocketHole objects.
+    """
+    factor = detection_factor(scale)
+    gray_negative = create_detection_image(negative, factor)
+
+    pad = get_border_size(gray_negative.shape)
+    bw_negative = create_bw_negative(create_bordered_negative(gray_negative))
+
+    sprocket_holes_contours = get_sprocket_holes_contours(bw_negative)
+    (top_holes, bottom_holes) = split_sprocket_holes(sprocket_holes_contours)
+
+    # Remove the border of the detection image
+    top_holes = [hole.translated((-pad, -pad)) for hole in top_holes]
+    bottom_holes = [hole.translated((-pad, -pad)) for hole in bottom_holes]
+
+    if factor > 1:
+        top_holes = scale_contours(top_holes, 1.0 / factor)
+        bottom_holes = scale_contours(bottom_holes, 1.0 / factor)
+
+        if refine:
+            top_holes = refine_sprocket_holes(negative, top_holes)
+            bottom_holes = refine_sprocket_holes(negative, bottom_holes)
+
+    return top_holes, bottom_holes
@@ -0,0 +1,115 @@
+"""
+Previous implementations the current code is compared with, and the test data for them.
+The benchmarks use them too.
+"""
+import math
+
+import numpy as np
+
+from util import contour_center
+
+# Layout of the contours of 'create_contours()' in pixels
+#  > hole_pitch: distance of neighbouring holes in a row
+#  > row_distance: distance of the top and bottom row of a strip
+#  > strip_distance: distance of neighbouring strips
+hole_pitch = 20
+row_distance = 100
+strip_distance = 300
+
+
+def create_contours(count, dust_rel_to_count=0.05, seed=0):
+    """
+    :param count: Approximate number of contours.
+    :param dust_rel_to_count: Share of randomly placed contours.
+    :param seed: Random seed.
+    :return: List of rectangular int32 contours in random order.
+    """
+    rng = np.random.RandomState(seed)
+
+    dust_count = int(count * dust_rel_to_count)
+    holes_per_row = 40
+    rows = max(1, (count - dust_count) // holes_per_row)
+
+    centers = []
+    for row in range(0, rows):
+        y = (row // 2) * strip_distance + (row % 2) * row_distance
+        for i in range(0, holes_per_row):
+            centers.append((i * hole_pitch, y))
+
+    max_y = max(c[1] for c in centers) + strip_distance
+    for i in range(0, dust_count):
+        centers.append((rng.randint(0, holes_per_row * hole_pitch), rng.randint(0, max_y)))
+
+    contours = [
+        np.array([[[x, y]], [[x + 4, y]], [[x + 4, y + 6]], [[x, y + 6]]], dtype=np.int32)
+        for (x, y) in centers
+    ]
+
+    return [contours[i] for i in rng.permutation(len(contours))]
+
+
+def legacy_n_closest_contours(self_contour, other_contours, n=1):
+    # One cv2.moments call per candidate and query, before the centers array
+    self_center = contour_center(self_contour)
+
+    distances = [math.inf] * n
+    contour_indices = [-1] * n
+
+    for index, contour in enumerate(other_contours):
+        dist = np.linalg.norm(self_center - contour_center(contour))
+
+        for i in range(0, n):
+            if dist < distances[i]:
+                distances.insert(i, dist)
+                contour_indices.insert(i, index)
+                distances.pop()
+                contour_indices.pop()
+                break
+
+    found = [i for i in contour_indices if i >= 0]
+    return [other_contours[i] for i in found], distances[:len(found)], found
+
+
+def legacy_group_contours_by_distance(contours, n=1):
+    # Previous 'group_contours_by_distance()' on top of 'legacy_n_closest_contours()'
+    groups = []
+    holes = list(contours)
+
+    while len(holes) > 0:
+        root = holes.pop(0)
+        rest = holes
+        group = [root]
+
+        distance_sum = 0
+        contour_counter = 1
+        fix_points = [root]
+
+        while len(fix_points) > 0 and len(rest) > 0:
+            new_fix_points = []
+
+            for fix_point in fix_points:
+                close, distances, indices = legacy_n_closest_contours(fix_point, rest, n)
+                added = []
+
+                for i in range(0, len(indices)):
+                    avg_distance = 0 if contour_counter < 2 else distance_sum / (contour_counter - 1)
+
+                    if contour_counter < 2 or distances[i] < avg_distance * 1.5:
+                        group.append(close[i])
+                        new_fix_points.append(close[i])
+                        added.append(indices[i])
+                        contour_counter += 1
+                        distance_sum += distances[i]
+
+                for index in sorted(added, reverse=True):
+                    rest.pop(index)
+
+                if len(rest) == 0:
+                    break
+
+            fix_points = new_fix_points
+
+        groups.append(group)
+        holes = rest
+
+    return groups
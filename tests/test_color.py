@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import color
+from color import create_levels, apply_levels
+from invert import invert_negative
+
+# Film base colors relative to the max value, like the synthetic strips of the benchmarks
+darkest_rel = (0.3, 0.42, 0.7)
+brightest_rel = (0.35, 0.5, 0.8)
+
+
+def _negative_and_colors(dtype, shape=(20, 37, 3)):
+    max_val = np.iinfo(dtype).max
+
+    negative = np.random.RandomState(0).randint(0, max_val + 1, shape).astype(dtype)
+    darkest_color = (np.array(darkest_rel) * max_val).astype(dtype)
+    brightest_color = (np.array(brightest_rel) * max_val).astype(dtype)
+
+    return negative, darkest_color, brightest_color
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+@pytest.mark.parametrize('chunk_rows', [None, 0.5, 3.3])
+def test_apply_levels_like_inversion_table(monkeypatch, dtype, chunk_rows):
+    (negative, darkest_color, brightest_color) = _negative_and_colors(dtype)
+
+    if chunk_rows is not None:
+        # Chunks of less than a row, or of rows plus a part of one, so the last chunk is shorter
+        row_bytes = negative.shape[1] * 3 * 4
+        monkeypatch.setattr(color, 'color_chunk_bytes', int(chunk_rows * row_bytes))
+
+    expected = invert_negative(negative, darkest_color, brightest_color)
+    positive = apply_levels(negative, create_levels(darkest_color, brightest_color, dtype))
+
+    assert positive.dtype == dtype
+    assert np.abs(positive.astype(np.int64) - expected).max() <= 1
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+def test_apply_levels_views_and_in_place(dtype):
+    (negative, darkest_color, brightest_color) = _negative_and_colors(dtype, (20, 74, 3))
+    levels = create_levels(darkest_color, brightest_color, dtype)
+
+    # Pixels not packed within the rows
+    view = negative[:, ::2]
+    expected = invert_negative(view, darkest_color, brightest_color)
+    assert np.abs(apply_levels(view, levels).astype(np.int64) - expected).max() <= 1
+
+    expected = apply_levels(negative, levels)
+    assert apply_levels(negative, levels, in_place=True) is negative
+    assert np.array_equal(negative, expected)
@@ -0,0 +1,24 @@
+import tracemalloc
+
+import instrument
+
+
+def test_disable_keeps_tracing_of_caller():
+    tracemalloc.start()
+    try:
+        instrument.enable()
+        instrument.disable()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_disable_stops_own_tracing():
+    assert not tracemalloc.is_tracing()
+
+    instrument.enable()
+    instrument.enable()
+    assert tracemalloc.is_tracing()
+
+    instrument.disable()
+    assert not tracemalloc.is_tracing()
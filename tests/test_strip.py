@@ -0,0 +1,43 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from strip import find_strips, detection_scale, detection_min_hole_size, hole_size_rel_to_negative_height
+
+images_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'images')
+
+
+def test_find_strips_side_by_side_left_to_right():
+    strip = cv2.imread(os.path.join(images_dir, 'test_negative_small.tiff'), cv2.IMREAD_UNCHANGED)[:, :, :3]
+    (h, w) = strip.shape[:2]
+
+    # Right strip slightly higher than the left one, a third one below
+    scan = np.full((2 * h + 200, 2 * w + 150, 3), 255, dtype=np.uint8)
+    scan[60:60 + h, 50:50 + w] = strip
+    scan[52:52 + h, 100 + w:100 + 2 * w] = strip
+    scan[150 + h:150 + 2 * h, 50:50 + w] = strip
+
+    rects = find_strips(scan)
+
+    assert len(rects) == 3
+    assert [(x1 < 50 + w // 2, y1 < h) for (x1, y1, x2, y2) in rects] == [(True, True), (False, True), (True, False)]
+
+
+@pytest.mark.parametrize('angle_tolerance', [0, -0.5])
+def test_detection_scale_rejects_invalid_tolerance(angle_tolerance):
+    with pytest.raises(AssertionError):
+        detection_scale(np.zeros((100, 600), dtype=np.uint8), angle_tolerance)
+
+
+def test_detection_scale_bounds():
+    negative = np.zeros((1400, 6000), dtype=np.uint8)
+
+    assert detection_scale(negative, 0.001) == 1.0
+    assert detection_scale(negative, 0.05) < detection_scale(negative, 0.01) < 1.0
+
+    # Holes stay big enough to be detected
+    min_scale = detection_scale(negative, 10)
+    assert min_scale * hole_size_rel_to_negative_height * 1400 == pytest.approx(detection_min_hole_size)
+    assert min_scale < detection_scale(negative, 0.05)
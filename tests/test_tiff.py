@@ -0,0 +1,131 @@
+import struct
+
+import cv2
+import numpy as np
+import pytest
+
+from tiff import write_tiff, read_negative, memmap_tiff, create_tiff_memmap, bgr_to_rgb_in_place, \
+    is_tiff_complete, TAG_PHOTOMETRIC
+
+
+def _random_image(shape, dtype, seed=0):
+    max_val = np.iinfo(dtype).max
+    return np.random.RandomState(seed).randint(0, max_val + 1, shape).astype(dtype)
+
+
+def _set_tag(path, tag, value):
+    # Overwrites an inline SHORT tag of the first IFD, written by 'create_tiff_memmap()'
+    data = bytearray(open(path, 'rb').read())
+    (ifd_offset,) = struct.unpack('<I', data[4:8])
+    (count,) = struct.unpack('<H', data[ifd_offset:ifd_offset + 2])
+
+    for i in range(0, count):
+        entry = ifd_offset + 2 + 12 * i
+        if struct.unpack('<H', data[entry:entry + 2])[0] == tag:
+            data[entry + 8:entry + 10] = struct.pack('<H', value)
+
+    open(path, 'wb').write(bytes(data))
+
+
+def _is_positive_strided(image):
+    return image.flags.c_contiguous or all(stride > 0 for stride in image.strides)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+@pytest.mark.parametrize('shape', [(67, 45), (67, 45, 3)])
+def test_write_read_round_trip(tmp_path, dtype, shape):
+    # More rows than one strip, so several strips are written
+    image = _random_image(shape, dtype)
+    path = str(tmp_path / 'image.tif')
+
+    write_tiff(path, image, bgr=False)
+
+    negative = read_negative(path)
+    assert isinstance(negative, np.memmap)
+    assert negative.flags.c_contiguous
+    assert negative.dtype == dtype
+    assert np.array_equal(negative, image)
+
+    # OpenCV reads the same file as BGR
+    bgr = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    assert np.array_equal(bgr, image[:, :, ::-1] if image.ndim == 3 else image)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+def test_write_bgr_read_rgb(tmp_path, dtype):
+    bgr = _random_image((40, 30, 3), dtype)
+    path = str(tmp_path / 'image.tif')
+
+    write_tiff(path, bgr)
+
+    assert np.array_equal(read_negative(path), bgr[:, :, ::-1])
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), bgr)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+def test_read_decoded_is_rgb_like_memmap(tmp_path, dtype):
+    bgr = _random_image((20, 30, 3), dtype)
+    path = str(tmp_path / 'image.png')
+    cv2.imwrite(path, bgr)
+
+    negative = read_negative(path)
+    assert negative.flags.c_contiguous
+    assert np.array_equal(negative, bgr[:, :, ::-1])
+
+
+def test_memmap_drops_alpha(tmp_path):
+    rgba = _random_image((10, 12, 4), np.uint8)
+    path = str(tmp_path / 'rgba.tif')
+
+    out = create_tiff_memmap(path, rgba.shape, rgba.dtype)
+    out[:] = rgba
+    out.flush()
+    del out
+
+    negative = read_negative(path)
+    assert negative.shape == (10, 12, 3)
+    assert _is_positive_strided(negative)
+    assert np.array_equal(negative, rgba[:, :, :3])
+
+
+@pytest.mark.parametrize('shape, photometric', [((10, 12, 4), 5), ((10, 12, 2), 1), ((10, 12), 0)])
+def test_memmap_rejects_other_photometric(tmp_path, shape, photometric):
+    # CMYK, gray with alpha and white is zero are left to OpenCV
+    path = str(tmp_path / 'other.tif')
+
+    out = create_tiff_memmap(path, shape, np.uint8)
+    del out
+    _set_tag(path, TAG_PHOTOMETRIC, photometric)
+
+    assert memmap_tiff(path) is None
+
+
+def test_bgr_to_rgb_in_place(tmp_path):
+    bgr = _random_image((70, 20, 3), np.uint16)
+    (written, mapped) = (str(tmp_path / 'written.tif'), str(tmp_path / 'mapped.tif'))
+
+    write_tiff(written, bgr)
+
+    out = create_tiff_memmap(mapped, bgr.shape, bgr.dtype)
+    out[:] = bgr
+    assert bgr_to_rgb_in_place(out) is out
+    out.flush()
+    del out
+
+    assert open(written, 'rb').read() == open(mapped, 'rb').read()
+
+
+def test_is_tiff_complete(tmp_path):
+    path = str(tmp_path / 'image.tif')
+    write_tiff(path, _random_image((70, 20, 3), np.uint8))
+    data = open(path, 'rb').read()
+
+    assert is_tiff_complete(path)
+
+    for size in (0, 3, 8, 100, len(data) // 2, len(data) - 1):
+        open(path, 'wb').write(data[:size])
+        assert not is_tiff_complete(path), size
+
+    # No TIFF at all, reading it reports the error
+    open(path, 'wb').write(b'junk\n')
+    assert is_tiff_complete(path)
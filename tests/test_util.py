@@ -0,0 +1,101 @@
+import math
+
+import numpy as np
+import pytest
+
+from tests.legacy import create_contours, legacy_group_contours_by_distance
+from util import fit_line, points_to_line, packed_fit_lines, contours_centers, \
+    group_points_by_distance, group_contours_by_distance
+
+line_methods = ['lstsq', 'theil_sen', 'ransac']
+
+
+def _points_on_line(gradient, displacement, count=20):
+    x = np.arange(0, count, dtype=np.float64) * 10
+    return np.stack([x, gradient * x + displacement], axis=1)
+
+
+@pytest.mark.parametrize('method', line_methods)
+@pytest.mark.parametrize('gradient, displacement', [(0, 5), (0.05, -3), (-0.3, 100), (2, 0)])
+def test_fit_line_known_lines(method, gradient, displacement):
+    points = _points_on_line(gradient, displacement)
+
+    (line, angle, residuals) = fit_line(points, method)
+
+    assert line[0] == pytest.approx(gradient, abs=1e-9)
+    assert line[1] == pytest.approx(displacement, abs=1e-6)
+    assert angle == pytest.approx(math.atan(gradient))
+    assert np.allclose(residuals, 0)
+
+
+@pytest.mark.parametrize('method', line_methods)
+def test_fit_line_vertical(method):
+    y = np.arange(0, 20, dtype=np.float64) * 10
+    points = np.stack([np.full_like(y, 42), y], axis=1)
+
+    # Direction of the points gives the sign
+    (line, angle, _) = fit_line(points, method)
+    assert line == (math.inf, pytest.approx(42))
+    assert angle == pytest.approx(math.pi / 2)
+
+    (line, angle, _) = fit_line(points[::-1], method)
+    assert line == (-math.inf, pytest.approx(42))
+    assert angle == pytest.approx(-math.pi / 2)
+
+
+@pytest.mark.parametrize('method', ['theil_sen', 'ransac'])
+def test_fit_line_outliers(method):
+    points = _points_on_line(0.1, 20)
+    points[[3, 11]] += [[0, 40], [0, -60]]
+
+    (line, _, residuals) = fit_line(points, method)
+
+    assert line[0] == pytest.approx(0.1, abs=0.01)
+    assert line[1] == pytest.approx(20, abs=1)
+    assert abs(points_to_line(points)[0] - 0.1) > 0.01
+
+    if method == 'ransac':
+        assert np.allclose(np.delete(residuals, [3, 11]), 0)
+
+
+def test_fit_line_rejects_invalid_points():
+    with pytest.raises(AssertionError):
+        fit_line([(1, 2)])
+
+    with pytest.raises(AssertionError):
+        fit_line([(1, 2), (1, 2), (3, 4)])
+
+    with pytest.raises(ValueError):
+        fit_line([(1, 2), (3, 4)], 'unknown')
+
+
+def test_packed_fit_lines_like_fit_line():
+    rng = np.random.RandomState(0)
+    sets = [
+        _points_on_line(0.02, 7) + rng.normal(0, 0.5, (20, 2)),
+        _points_on_line(-1.5, 300, count=5),
+        np.array([[3, 0], [3, 50], [3, 90]], dtype=np.float64),
+        np.array([[3, 90], [3, 50], [3, 0]], dtype=np.float64),
+    ]
+
+    # Float points, 'pack_contours()' would round them to int32
+    offsets = np.cumsum([0] + [len(points) for points in sets])
+    (lines, angles) = packed_fit_lines(np.concatenate(sets), offsets)
+
+    for (points, line, angle) in zip(sets, lines, angles):
+        (expected_line, expected_angle, _) = fit_line(points)
+        assert line == pytest.approx(expected_line)
+        assert angle == pytest.approx(expected_angle)
+
+
+@pytest.mark.parametrize('count', [40, 100, 300])
+@pytest.mark.parametrize('n', [1, 2])
+def test_group_contours_like_legacy(count, n):
+    contours = create_contours(count, seed=1)
+
+    expected = legacy_group_contours_by_distance(contours, n)
+    groups = group_contours_by_distance(contours, n)
+
+    assert [[id(c) for c in group] for group in groups] == [[id(c) for c in group] for group in expected]
+    assert group_points_by_distance(contours_centers(contours), n) == \
+        [[next(i for (i, c) in enumerate(contours) if c is g) for g in group] for group in expected]
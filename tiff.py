@@ -0,0 +1,334 @@
+import os
+import struct
+import sys
+
+import cv2
+import numpy as np
+
+# Tags used for reading and writing
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_PLANAR_CONFIG = 284
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_SAMPLE_FORMAT = 339
+
+# Field types: code -> (struct format, size)
+_field_types = {
+    1: ('B', 1),   # BYTE
+    3: ('H', 2),   # SHORT
+    4: ('I', 4),   # LONG
+    16: ('Q', 8),  # LONG8
+}
+
+TYPE_SHORT = 3
+TYPE_LONG = 4
+
+# Rows per strip of written files
+write_rows_per_strip = 64
+
+
+def read_tiff_info(path):
+    """
+    Reads the tags of the first image of a TIFF file. Pixel data is not read.
+
+    :param path: File path.
+    :return: Dict with byte_order ('<' or '>') and the tags (tag code -> tuple of values),
+        None if the file is no classic TIFF (e.g. BigTIFF).
+    """
+    with open(path, 'rb') as file:
+        header = file.read(8)
+        if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+            return None
+
+        byte_order = '<' if header[:2] == b'II' else '>'
+        (magic, ifd_offset) = struct.unpack(byte_order + 'HI', header[2:8])
+        if magic != 42:
+            return None
+
+        file.seek(ifd_offset)
+        (count,) = struct.unpack(byte_order + 'H', file.read(2))
+        entries = file.read(12 * count)
+
+        tags = {}
+        for i in range(0, count):
+            entry = entries[12 * i:12 * (i + 1)]
+            (tag, field_type, value_count) = struct.unpack(byte_order + 'HHI', entry[:8])
+
+            if field_type not in _field_types:
+                continue
+
+            (fmt, size) = _field_types[field_type]
+            value_size = size * value_count
+
+            if value_size <= 4:
+                data = entry[8:8 + value_size]
+            else:
+                (offset,) = struct.unpack(byte_order + 'I', entry[8:12])
+                file.seek(offset)
+                data = file.read(value_size)
+
+            tags[tag] = struct.unpack(byte_order + fmt * value_count, data)
+
+    return {'byte_order': byte_order, 'tags': tags}
+
+
+def is_tiff_complete(path):
+    """
+    Checks if a TIFF file was written completely, e.g. while a scanner is still writing it:
+    header, tags and all strips (or tiles) must lie within the file.
+
+    Files that are no classic TIFF count as complete, reading them reports the error.
+
+    :param path: File path.
+    :return: True if the file is complete.
+    """
+    with open(path, 'rb') as file:
+        start = file.read(4)
+
+    # Files starting like a TIFF header (or empty ones) may still be written
+    if not any(magic.startswith(start) for magic in (b'II*\0', b'MM\0*')):
+        return True
+
+    size = os.path.getsize(path)
+    if size < 8:
+        return False
+
+    try:
+        info = read_tiff_info(path)
+    except struct.error:
+        # Tags are cut off
+        return False
+
+    if info is None:
+        return True
+
+    tags = info['tags']
+    for (offsets_tag, counts_tag) in ((TAG_STRIP_OFFSETS, TAG_STRIP_BYTE_COUNTS),
+                                      (TAG_TILE_OFFSETS, TAG_TILE_BYTE_COUNTS)):
+        if offsets_tag in tags and counts_tag in tags:
+            end = max(offset + count for (offset, count) in zip(tags[offsets_tag], tags[counts_tag]))
+            return end <= size
+
+    return True
+
+
+def memmap_tiff(path, mode='r'):
+    """
+    Maps the pixel data of an uncompressed TIFF into a numpy array without reading or copying it.
+
+    Supported are stripped (not tiled), chunky (interleaved) gray or RGB(A) files with 8 or 16
+    bit unsigned samples whose strips lie one after another in the file. 16 bit files must have
+    the byte order of this machine. Anything else (e.g. CMYK or gray with alpha) is left to OpenCV.
+
+    Attention!: The channels are in file order, which is RGB (OpenCV uses BGR). The mapping
+    stays contiguous, so OpenCV works on it without copying it first. An alpha channel is left
+    out (as view with positive strides, OpenCV copies the part it is given).
+
+    :param path: File path.
+    :param mode: numpy memmap mode, 'r' or 'r+'.
+    :return: Array of shape (h, w, 3) or (h, w), None if the file can not be mapped.
+    """
+    info = read_tiff_info(path)
+    if info is None:
+        return None
+
+    tags = info['tags']
+
+    def tag(code, default=None):
+        return tags.get(code, (default,))
+
+    if TAG_STRIP_OFFSETS not in tags or tag(TAG_COMPRESSION, 1)[0] != 1:
+        return None
+
+    samples = tag(TAG_SAMPLES_PER_PIXEL, 1)[0]
+    if samples > 1 and tag(TAG_PLANAR_CONFIG, 1)[0] != 1:
+        return None
+
+    # Gray (black is zero) or RGB with optional alpha
+    photometric = tag(TAG_PHOTOMETRIC)[0]
+    if not ((samples == 1 and photometric == 1) or (samples in (3, 4) and photometric == 2)):
+        return None
+
+    bits = set(tag(TAG_BITS_PER_SAMPLE, 1))
+    if len(bits) != 1 or set(tag(TAG_SAMPLE_FORMAT, 1)) != {1}:
+        return None
+
+    bits = bits.pop()
+    if bits == 8:
+        dtype = np.dtype(np.uint8)
+    elif bits == 16:
+        native = '<' if sys.byteorder == 'little' else '>'
+        if info['byte_order'] != native:
+            return None
+        dtype = np.dtype(np.uint16)
+    else:
+        return None
+
+    width = tag(TAG_IMAGE_WIDTH)[0]
+    height = tag(TAG_IMAGE_LENGTH)[0]
+
+    offsets = tags[TAG_STRIP_OFFSETS]
+    byte_counts = tags.get(TAG_STRIP_BYTE_COUNTS)
+    size = width * height * samples * dtype.itemsize
+
+    if byte_counts is None or sum(byte_counts) < size:
+        return None
+
+    # Strips must follow each other without gaps
+    for i in range(1, len(offsets)):
+        if offsets[i] != offsets[i - 1] + byte_counts[i - 1]:
+            return None
+
+    if offsets[0] + size > os.path.getsize(path):
+        return None
+
+    shape = (height, width, samples) if samples > 1 else (height, width)
+    image = np.memmap(path, dtype=dtype, mode=mode, offset=offsets[0], shape=shape)
+
+    if samples == 4:
+        image = image[:, :, :3]
+
+    return image
+
+
+def read_negative(path):
+    """
+    Opens a scan as memory mapped array if possible (see 'memmap_tiff()'), otherwise it is decoded.
+
+    In both cases the channels are in RGB order, so results can be written with
+    'create_tiff_memmap()' or 'write_tiff()' (bgr=False) without swapping channels. The decoded
+    image is converted in place, see 'bgr_to_rgb_in_place()'.
+
+    :param path: File path.
+    :return: RGB image.
+    """
+    image = None
+    if path.lower().endswith(('.tif', '.tiff')):
+        image = memmap_tiff(path)
+
+    if image is None:
+        image = cv2.imread(path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+        assert image is not None, "Could not read image {}".format(path)
+
+        bgr_to_rgb_in_place(image)
+
+    return image
+
+
+def create_tiff_memmap(path, shape, dtype):
+    """
+    Creates an uncompressed TIFF and maps its pixel data, so results can be written straight
+    into the file (e.g. tile by tile).
+
+    Channels are stored as RGB, see 'memmap_tiff()'. Call flush() on the result when done.
+
+    :param path: File path. Will be overwritten.
+    :param shape: Image shape (h, w, 3) or (h, w).
+    :param dtype: uint8 or uint16.
+    :return: numpy memmap of the given shape.
+    """
+    dtype = np.dtype(dtype)
+    assert dtype in (np.uint8, np.uint16), "Only uint8 and uint16 are supported"
+
+    (height, width) = shape[:2]
+    samples = shape[2] if len(shape) > 2 else 1
+
+    row_size = width * samples * dtype.itemsize
+    size = row_size * height
+    assert size < 2 ** 32, "Image too big for a classic TIFF"
+
+    strips = (height + write_rows_per_strip - 1) // write_rows_per_strip
+
+    # Layout: header, IFD, out of line values, pixel data
+    tag_count = 11
+    ifd_offset = 8
+    values_offset = ifd_offset + 2 + tag_count * 12 + 4
+
+    bits_offset = values_offset
+    strip_offsets_offset = bits_offset + 2 * samples
+    byte_counts_offset = strip_offsets_offset + 4 * strips
+    data_offset = (byte_counts_offset + 4 * strips + 15) // 16 * 16
+
+    strip_offsets = [data_offset + i * write_rows_per_strip * row_size for i in range(0, strips)]
+    byte_counts = [min(write_rows_per_strip, height - i * write_rows_per_strip) * row_size for i in range(0, strips)]
+
+    def entry(tag, field_type, count, value, inline):
+        if inline:
+            fmt = _field_types[field_type][0]
+            data = struct.pack('<' + fmt, value).ljust(4, b'\0')
+        else:
+            data = struct.pack('<I', value)
+
+        return struct.pack('<HHI', tag, field_type, count) + data
+
+    entries = [
+        entry(TAG_IMAGE_WIDTH, TYPE_LONG, 1, width, True),
+        entry(TAG_IMAGE_LENGTH, TYPE_LONG, 1, height, True),
+        entry(TAG_BITS_PER_SAMPLE, TYPE_SHORT, samples, bits_offset, False) if samples > 2
+        else entry(TAG_BITS_PER_SAMPLE, TYPE_SHORT, 1, 8 * dtype.itemsize, True),
+        entry(TAG_COMPRESSION, TYPE_SHORT, 1, 1, True),
+        entry(TAG_PHOTOMETRIC, TYPE_SHORT, 1, 2 if samples >= 3 else 1, True),
+        entry(TAG_STRIP_OFFSETS, TYPE_LONG, strips, strip_offsets_offset, False) if strips > 1
+        else entry(TAG_STRIP_OFFSETS, TYPE_LONG, 1, strip_offsets[0], True),
+        entry(TAG_SAMPLES_PER_PIXEL, TYPE_SHORT, 1, samples, True),
+        entry(TAG_ROWS_PER_STRIP, TYPE_LONG, 1, write_rows_per_strip, True),
+        entry(TAG_STRIP_BYTE_COUNTS, TYPE_LONG, strips, byte_counts_offset, False) if strips > 1
+        else entry(TAG_STRIP_BYTE_COUNTS, TYPE_LONG, 1, byte_counts[0], True),
+        entry(TAG_PLANAR_CONFIG, TYPE_SHORT, 1, 1, True),
+        entry(TAG_SAMPLE_FORMAT, TYPE_SHORT, 1, 1, True),
+    ]
+    assert len(entries) == tag_count
+
+    header = b'II' + struct.pack('<HI', 42, ifd_offset)
+    ifd = struct.pack('<H', tag_count) + b''.join(entries) + struct.pack('<I', 0)
+    values = struct.pack('<' + 'H' * samples, *([8 * dtype.itemsize] * samples)) \
+        + struct.pack('<' + 'I' * strips, *strip_offsets) \
+        + struct.pack('<' + 'I' * strips, *byte_counts)
+
+    with open(path, 'wb') as file:
+        file.write((header + ifd + values).ljust(data_offset, b'\0'))
+        file.truncate(data_offset + size)
+
+    return np.memmap(path, dtype=dtype.newbyteorder('<'), mode='r+', offset=data_offset, shape=tuple(shape))
+
+
+def bgr_to_rgb_in_place(image):
+    """
+    Swaps the first and third channel in row chunks, e.g. of an image decoded by OpenCV.
+    Gray images are left as they are.
+
+    :param image: Image. Will be modified.
+    :return: The given image.
+    """
+    if image.ndim == 3:
+        for y in range(0, image.shape[0], write_rows_per_strip):
+            block = image[y:y + write_rows_per_strip]
+            block[:] = block[:, :, ::-1]
+
+    return image
+
+
+def write_tiff(path, image, bgr=True):
+    """
+    Writes an image as uncompressed TIFF through a memory map, in row chunks.
+
+    :param path: File path.
+    :param image: Image, uint8 or uint16.
+    :param bgr: If True, the image is in OpenCV's BGR order and gets stored as RGB.
+    """
+    out = create_tiff_memmap(path, image.shape, image.dtype)
+
+    for y in range(0, image.shape[0], write_rows_per_strip):
+        block = image[y:y + write_rows_per_strip]
+        out[y:y + write_rows_per_strip] = block[:, :, ::-1] if bgr and image.ndim == 3 else block
+
+    out.flush()
+    del out
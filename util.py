@@ -1,13 +1,25 @@
-import statistics
 import math
 
 import cv2
 import numpy as np
 
+from instrument import instrumented
+
+k_colors_max_samples = 20000
+
+# Line fitting, see 'fit_line()'
+#  > lines closer than this to vertical are returned as vertical
+line_vertical_tolerance = math.pi/180 * 0.1  # 0.1 degrees
+#  > pairs of points used by the robust methods at most
+line_fit_max_pairs = 2000
+#  > RANSAC inlier distance relative to the length of the point set, but at least the minimum in pixels
+ransac_threshold_rel_to_length = 0.002
+ransac_min_threshold = 1.0
+
 
 def points_to_line(points):
     """
-    Creates line based on points. Averages lines.
+    Creates line based on points, see 'fit_line()'.
 
     Attention!: Points are expected to be in the right order!
 
@@ -16,56 +28,132 @@ def points_to_line(points):
     If the line is vertical, theta will be math.inf. In case the points go from top to bottom,
     it will be positive inf, from bottom to top > negative inf.
 
-    :param points: List of points (x, y).
+    :param points: List of points (x, y) or array of shape (N, 2).
     :return: Tuple (gradient, y displacement) or (inf, x displacement) for vertical lines.
     """
+    return fit_line(points)[0]
 
-    assert len(points) > 1, "Need at least two points"
-
-    points_sorted = list(points)
-
-    angles_sum = 0
-
-    avg_x = statistics.mean(map(lambda p: p[0], points_sorted))
-    avg_y = statistics.mean(map(lambda p: p[1], points_sorted))
-
-    # Add all angles between two points
-    for i in range(1, len(points_sorted)):
-        pt1 = points_sorted[i - 1]
-        pt2 = points_sorted[i]
 
-        assert not (pt1[0] == pt2[0] and pt1[1] == pt2[1]), \
-            "Got two points equal to each other, only distinct points allowed"
+def fit_line(points, method=None):
+    """
+    Fits a line through points.
 
-        delta_y = pt2[1]-pt1[1]
-        length = np.linalg.norm(pt2-pt1)
-        angle = delta_y/length
+    Methods:
+     > 'lstsq' (default): least squares of the perpendicular distances, which handles vertical lines too
+     > 'theil_sen': median of the angles between all pairs of points, tolerates some outliers
+     > 'ransac': line through the pair of points with the most points near it (see
+       'ransac_threshold_rel_to_length'), refitted by least squares on those points
 
-        angles_sum += angle
+    Attention!: Points are expected to be in the right order! It only matters for the sign of
+    vertical lines, see 'points_to_line()'.
 
-    avg_angle = angles_sum/(len(points_sorted)-1)
+    :param points: List of points (x, y) or array of shape (N, 2).
+    :param method: Fitting method, see above.
+    :return: Tuple (line, angle, residuals). line see 'points_to_line()', angle see 'line_angle()',
+        residuals is an array of the signed perpendicular distances of the points to the line.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
 
-    # vertical line
-    vertical_tolerance = math.pi/180 * 0.1  # 0.1 degrees
-    vertical_angle = math.pi/2
+    assert len(points) > 1, "Need at least two points"
+    assert np.all(np.any(np.diff(points, axis=0) != 0, axis=1)), \
+        "Got two points equal to each other, only distinct points allowed"
+
+    if method is None or method == 'lstsq':
+        (angle, center) = _fit_line_lstsq(points)
+    elif method == 'theil_sen':
+        (angle, center) = _fit_line_theil_sen(points)
+    elif method == 'ransac':
+        (angle, center) = _fit_line_ransac(points)
+    else:
+        raise ValueError("Unknown line fitting method {}".format(method))
 
-    if math.isclose(avg_angle, vertical_angle, abs_tol=vertical_tolerance):
+    normal = np.array([-math.sin(angle), math.cos(angle)])
+    residuals = (points - center).dot(normal)
 
+    if math.isclose(abs(angle), math.pi / 2, abs_tol=line_vertical_tolerance):
         # Check approx. direction
-        delta_y_first_to_last = points_sorted[-1][1].points_sorted[0][1]
+        delta_y_first_to_last = points[-1][1] - points[0][1]
 
         if delta_y_first_to_last >= 0:
             # top to bottom
-            return math.inf, avg_x
+            line = (math.inf, float(center[0]))
         else:
             # bottom to top
-            return -math.inf, avg_x
+            line = (-math.inf, float(center[0]))
+    else:
+        # "Normal" line > return gradient and displacement
+        gradient = math.tan(angle)
+        line = (gradient, float(center[1] - center[0] * gradient))
+
+    return line, line_angle(line), residuals
+
+
+def _wrap_line_angle(angle):
+    # Lines have no direction, angles are within [-pi/2, pi/2)
+    return (angle + math.pi / 2) % math.pi - math.pi / 2
+
+
+def _fit_line_lstsq(points):
+    # Direction of the biggest spread (principal axis) minimizes the perpendicular distances
+    center = points.mean(axis=0)
+    centered = points - center
+
+    (eigenvalues, eigenvectors) = np.linalg.eigh(centered.T.dot(centered))
+    direction = eigenvectors[:, np.argmax(eigenvalues)]
+
+    return _wrap_line_angle(math.atan2(direction[1], direction[0])), center
+
+
+def _point_pairs(count):
+    (first, second) = np.triu_indices(count, 1)
+
+    if len(first) > line_fit_max_pairs:
+        # Deterministic subset, so repeated runs give the same line
+        chosen = np.random.RandomState(0).choice(len(first), line_fit_max_pairs, replace=False)
+        (first, second) = (first[chosen], second[chosen])
+
+    return first, second
+
+
+def _fit_line_theil_sen(points):
+    # Pair angles are taken relative to the least squares angle, so the median
+    # does not suffer from the wrap around at vertical lines
+    (base_angle, _) = _fit_line_lstsq(points)
+    (first, second) = _point_pairs(len(points))
+
+    deltas = points[second] - points[first]
+    pair_angles = _wrap_line_angle(np.arctan2(deltas[:, 1], deltas[:, 0]) - base_angle)
+    angle = _wrap_line_angle(base_angle + float(np.median(pair_angles)))
+
+    direction = np.array([math.cos(angle), math.sin(angle)])
+    normal = np.array([-direction[1], direction[0]])
+    center = np.median(points.dot(direction)) * direction + np.median(points.dot(normal)) * normal
+
+    return angle, center
+
+
+def _fit_line_ransac(points):
+    (base_angle, _) = _fit_line_lstsq(points)
+    (first, second) = _point_pairs(len(points))
 
-    # "Normal" line > return gradient and displacement
-    gradient = math.atan(avg_angle)
-    displacement = avg_y - (avg_x * gradient)
+    # Every pair of points is a candidate line
+    deltas = points[second] - points[first]
+    normals = np.stack([-deltas[:, 1], deltas[:, 0]], axis=1) / np.linalg.norm(deltas, axis=1)[:, np.newaxis]
 
-    return gradient, displacement
+    # Distances of all points to all candidates, shape (candidates, points)
+    distances = np.abs(np.einsum('cpk,ck->cp', points[np.newaxis, :, :] - points[first][:, np.newaxis, :], normals))
+
+    length = np.ptp(points.dot([math.cos(base_angle), math.sin(base_angle)]))
+    threshold = max(ransac_min_threshold, ransac_threshold_rel_to_length * length)
+
+    inliers = distances <= threshold
+    counts = inliers.sum(axis=1)
+
+    # Most inliers, ties are broken by the smaller distance sum
+    error = np.where(inliers, distances, 0).sum(axis=1)
+    best = np.lexsort((error, -counts))[0]
+
+    return _fit_line_lstsq(points[inliers[best]])
 
 
 def line_angle(line):
@@ -158,6 +246,102 @@ def draw_rect(img, rect, color=(255, 0, 0), thickness=1):
     cv2.rectangle(img, (rect[0], rect[1]), (rect[0]+rect[2], rect[1]+rect[3]), color, thickness)
 
 
+class SprocketHole(object):
+    """
+    Contour of a sprocket hole together with its features. Everything is computed
+    once on creation, so helpers like 'contour_center()' or 'contour_top()' only
+    look the values up.
+
+    All contour helpers of this module accept sprocket holes as well as plain contours.
+    """
+
+    __slots__ = ('contour', 'center', 'area', 'rect', 'top', 'bottom', 'left', 'right')
+
+    def __init__(self, contour):
+        """
+        :param contour: Contour (int32 array as returned by findContours).
+        """
+        self.contour = contour
+
+        M = cv2.moments(contour)
+        self.area = M['m00']
+        self.center = np.array([M['m10']/M['m00'], M['m01']/M['m00']])
+
+        self.rect = cv2.minAreaRect(contour)
+
+        self.top = contour_top(contour)
+        self.bottom = contour_bottom(contour)
+        self.left = contour_left(contour)
+        self.right = contour_right(contour)
+
+    def translated(self, offset):
+        """
+        Moves the hole. The features are moved along, nothing is computed again.
+
+        :param offset: Offset (x, y), integers.
+        :return: New sprocket hole.
+        """
+        offset = np.array(offset, dtype=np.int32)
+
+        hole = SprocketHole.__new__(SprocketHole)
+        hole.contour = self.contour + offset
+        hole.area = self.area
+        hole.center = self.center + offset
+        hole.rect = ((self.rect[0][0] + offset[0], self.rect[0][1] + offset[1]), self.rect[1], self.rect[2])
+        hole.top = self.top + offset
+        hole.bottom = self.bottom + offset
+        hole.left = self.left + offset
+        hole.right = self.right + offset
+
+        return hole
+
+
+def create_sprocket_holes(contours):
+    """
+    Creates the sprocket holes of many contours at once. Area, center and extreme points of
+    all contours are computed in a few vectorized calls (see 'pack_contours()'), the result
+    equals creating every SprocketHole on its own.
+
+    :param contours: Contours (int32 arrays as returned by findContours).
+    :return: List of sprocket holes.
+    """
+    if len(contours) == 0:
+        return []
+
+    (points, offsets) = pack_contours(contours)
+    (areas, centers) = packed_contours_moments(points, offsets)
+    assert np.all(areas > 0), "Sprocket hole contours need an area"
+
+    (tops, bottoms, lefts, rights) = packed_contours_extremes(points, offsets)
+
+    holes = []
+    for (i, contour) in enumerate(contours):
+        hole = SprocketHole.__new__(SprocketHole)
+        hole.contour = contour
+        hole.area = areas[i]
+        hole.center = centers[i]
+        hole.rect = cv2.minAreaRect(contour)
+        hole.top = tops[i]
+        hole.bottom = bottoms[i]
+        hole.left = lefts[i]
+        hole.right = rights[i]
+
+        holes.append(hole)
+
+    return holes
+
+
+def contour_array(contour):
+    """
+    :param contour: Contour or SprocketHole.
+    :return: Plain contour array, e.g. for OpenCV functions.
+    """
+    if isinstance(contour, SprocketHole):
+        return contour.contour
+
+    return contour
+
+
 def contour_center(contour):
     """
     Calculates center vie moments.
@@ -165,6 +349,9 @@ def contour_center(contour):
     :param contour: Contour to calc center for.
     :return: numpy array [cx, cy].
     """
+    if isinstance(contour, SprocketHole):
+        return contour.center
+
     M = cv2.moments(contour)
     cx = M['m10']/M['m00']
     cy = M['m01']/M['m00']
@@ -172,6 +359,101 @@ def contour_center(contour):
     return np.array([cx, cy])
 
 
+def contour_rect(contour):
+    """
+    Wraps a rotated rectangle with minimal area around the contour (cv2.minAreaRect).
+
+    :param contour: Contour.
+    :return: Rect ((cx, cy), (w, h), angle).
+    """
+    if isinstance(contour, SprocketHole):
+        return contour.rect
+
+    return cv2.minAreaRect(contour)
+
+
+def _like(original, contour):
+    # Keep the type of the given contour
+    if isinstance(original, SprocketHole):
+        return SprocketHole(contour)
+
+    return contour
+
+
+def scale_contours(contours, scale, offset=(0, 0)):
+    """
+    Scales contours found on a resized image back to the original image.
+
+    Coordinates are treated as pixel centers, so a contour found on an image resized by
+    'scale' matches the original image: x = (x_small + 0.5) / scale - 0.5.
+
+    :param contours: Contours (int32 arrays as returned by findContours) or sprocket holes.
+    :param scale: Factor the image was resized with or tuple (fx, fy).
+    :param offset: Offset (x, y) added after scaling.
+    :return: List of scaled int32 contours or sprocket holes.
+    """
+    scale = np.array(scale, dtype=np.float64)
+    offset = np.array(offset, dtype=np.float64)
+
+    scaled = []
+    for contour in contours:
+        points = (contour_array(contour).astype(np.float64) + 0.5) / scale - 0.5 + offset
+        scaled.append(_like(contour, np.round(points).astype(np.int32)))
+
+    return scaled
+
+
+def transform_contours(contours, matrix):
+    """
+    Applies an affine transformation to contours.
+
+    :param contours: Contours or sprocket holes.
+    :param matrix: 2x3 affine matrix (e.g. from cv2.getRotationMatrix2D).
+    :return: List of transformed int32 contours or sprocket holes.
+    """
+    return [
+        _like(contour, np.round(cv2.transform(contour_array(contour).astype(np.float64), matrix)).astype(np.int32))
+        for contour in contours
+    ]
+
+
+def contours_centers(contours):
+    """
+    Calculates the centers of all contours at once.
+
+    :param contours: Contours.
+    :return: Numpy array of shape (N, 2), one center (cx, cy) per contour.
+    """
+    centers = np.empty((len(contours), 2), dtype=np.float64)
+    for index, contour in enumerate(contours):
+        centers[index] = contour_center(contour)
+
+    return centers
+
+
+def n_closest_points(point, points, n=1):
+    """
+    Finds the n closest points. Points with equal distance are sorted by their index.
+
+    :param point: Point (x, y) to search closest points for.
+    :param points: Numpy array of shape (N, 2).
+    :param n: How many closest points shall be retrieved. May be greater than N.
+    :return: Tuple (indices, distances), both numpy arrays sorted by distance asc.
+    """
+    distances = np.sqrt(np.sum((points - point) ** 2, axis=1))
+
+    candidates = np.arange(len(points))
+    if n < len(points):
+        # Partition finds the n smallest, but ties at the n-th distance need to be resolved by index
+        nth_distance = distances[np.argpartition(distances, n - 1)[n - 1]]
+        candidates = np.flatnonzero(distances <= nth_distance)
+
+    order = np.lexsort((candidates, distances[candidates]))[:n]
+    indices = candidates[order]
+
+    return indices, distances[indices]
+
+
 def n_closest_contours(self_contour, other_contours, n=1, output_contour_indices=True):
     """
     Find the closest contours. Therefore the contour centers are used. The contours are sorted by distance asc.
@@ -187,38 +469,10 @@ def n_closest_contours(self_contour, other_contours, n=1, output_contour_indices
     """
     assert len(other_contours) > 0, "Need at least one other contour"
 
-    self_center = contour_center(self_contour)
-
-    # Max out each position
-    distances = [math.inf] * n
-    contour_indices = [-1] * n
+    indices, distances = n_closest_points(contour_center(self_contour), contours_centers(other_contours), n)
 
-    # now check for each contour if it has a distance lower than anything in the list
-    for index, contour in enumerate(other_contours):
-        center = contour_center(contour)
-        dist = np.linalg.norm(self_center-center)
-
-        # lower distance at any position: insert and shift, last ones will be popped
-        for i in range(0, n):
-            if dist < distances[i]:
-                # Shift
-                distances.insert(i, dist)
-                contour_indices.insert(i, index)
-
-                # Remove last ones
-                distances.pop()
-                contour_indices.pop()
-
-                break
-
-    # Check how many we actually found
-    found_counter = 0
-    for index in contour_indices:
-        if index >= 0:
-            found_counter += 1
-
-    existing_contours_indices = contour_indices[:found_counter]
-    existing_distances = distances[:found_counter]
+    existing_contours_indices = list(indices)
+    existing_distances = list(distances)
     existing_closest_contours = list(map(lambda i: other_contours[i], existing_contours_indices))
 
     if output_contour_indices:
@@ -227,121 +481,137 @@ def n_closest_contours(self_contour, other_contours, n=1, output_contour_indices
         return existing_closest_contours, existing_distances
 
 
-def closest_transitive_contours(root_contour, other_contours, n=1):
+def closest_transitive_points(root_point, points, n=1, available=None):
     """
-    Finds all contours that are close to the root (also in a transitive way)
+    Index based version of 'closest_transitive_contours()', working on points (e.g. contour centers).
 
-    Example: B is close to A by distance 10. C is close to be B by 11. C is in
-    the same group as B and A, Now comes D. It is close to C by 24. The average
-    distance until now is 10.5, but the new distance 24 is greater than
-    1.5 times the avg distance (here 15,75).
-
-    At that point computation breaks and the group of "close" contours as well as the
-    rest of the contours is returned.
-
-    Uses method 'n_closest_contours()' internally. Due to this, you can vary the parameter 'n'.
-    For more details, see doc of that method.
-
-    :param root_contour: Root.
-    :param other_contours: Other contours.
-    :param n: Number of closest contours that shall be retrieved for a current fix point.
-    :return: Tuple (close_contours, rest). Both lists of contours.
+    :param root_point: Root point (x, y).
+    :param points: Numpy array of shape (N, 2).
+    :param n: Number of closest points that shall be retrieved for a current fix point.
+    :param available: Optional boolean mask of points that may still be grouped. Grouped points
+        are set to False. If not given, all points are available.
+    :return: Tuple (group_indices, rest_indices). Group in order of adding, rest ascending.
     """
-    assert len(other_contours) > 0, "Need at least one other contour"
+    if available is None:
+        available = np.ones(len(points), dtype=bool)
 
-    rest = list(other_contours)
     group = list()
 
     distance_sum = 0
-    contour_counter = 1  # our root
-    fix_points = [root_contour]
+    point_counter = 1  # our root
+    fix_points = [root_point]
 
     # Retrieve closests as long as we have fix points
-    while len(fix_points) > 0 and len(rest) > 0:
+    while len(fix_points) > 0 and available.any():
 
         # all points we add become our new fix points
         new_fix_points = []
 
         for fix_point in fix_points:
-            # find closests for given fix point
-            contours, distances, indices = n_closest_contours(fix_point, rest, n)
-
-            # we will delete them from the rest afterwards, so we just track what we added / need to delete
-            added_contours_indices = []
+            rest = np.flatnonzero(available)
+            indices, distances = n_closest_points(fix_point, points[rest], n)
 
-            # Check every close contour if it shall be added
             for i in range(0, len(indices)):
 
                 # calc avg distance based on current distances
-                avg_distance = 0 if contour_counter < 2 else distance_sum / (contour_counter-1)
+                avg_distance = 0 if point_counter < 2 else distance_sum / (point_counter-1)
                 distance = distances[i]
 
-                contour_index = indices[i]
-                contour = contours[i]
-
                 # Add point of only one yet or distance is not larger than 1.5 times the avg. distance
-                if contour_counter < 2 or distance < avg_distance * 1.5:
-
-                    # add close contour
-                    group.append(contour)
-                    new_fix_points.append(contour)
+                if point_counter < 2 or distance < avg_distance * 1.5:
+                    point_index = rest[indices[i]]
 
-                    # remember it to be deleted from list rest
-                    added_contours_indices.append(contour_index)
+                    group.append(point_index)
+                    new_fix_points.append(points[point_index])
+                    available[point_index] = False
 
-                    contour_counter += 1
+                    point_counter += 1
                     distance_sum += distance
 
-            # remove from back to front to prevent unwanted shifts
-            added_contours_indices.sort(reverse=True)
-
-            for index_to_delete in added_contours_indices:
-                rest.pop(index_to_delete)
-
             # If nothing left, break
-            if len(rest) == 0:
+            if not available.any():
                 break
 
         # place new fix points
         fix_points = new_fix_points
 
-    return group, rest
+    return group, np.flatnonzero(available)
 
 
-def group_contours_by_distance(contours, n=1):
+def closest_transitive_contours(root_contour, other_contours, n=1):
     """
-    This method groups the contours into individual groups based on average distance to each other.
+    Finds all contours that are close to the root (also in a transitive way)
 
-    A group consists of contours that are close to each other by transitive relationship.
-    Their distances are nearly the same.
+    Example: B is close to A by distance 10. C is close to be B by 11. C is in
+    the same group as B and A, Now comes D. It is close to C by 24. The average
+    distance until now is 10.5, but the new distance 24 is greater than
+    1.5 times the avg distance (here 15,75).
+
+    At that point computation breaks and the group of "close" contours as well as the
+    rest of the contours is returned.
 
-    Uses method 'closest_transitive_contours()' internally. Due to this, you can also vary the
-    parameter 'n' to find results, that suit you need better.
-    For more details, check out doc of that method.
+    The contour centers are computed once, the search itself runs on them
+    (see 'closest_transitive_points()'). You can vary the parameter 'n',
+    for more details see doc of 'n_closest_contours()'.
 
-    :param contours: List of all contours.
-    :param n: Max number of close contours to retrieve one at a time.
-    :return: List of groups. Each group is a list of contours.
+    :param root_contour: Root.
+    :param other_contours: Other contours.
+    :param n: Number of closest contours that shall be retrieved for a current fix point.
+    :return: Tuple (close_contours, rest). Both lists of contours.
+    """
+    assert len(other_contours) > 0, "Need at least one other contour"
+
+    group, rest = closest_transitive_points(contour_center(root_contour), contours_centers(other_contours), n)
+
+    return [other_contours[i] for i in group], [other_contours[i] for i in rest]
+
+
+def group_points_by_distance(points, n=1):
     """
+    Index based version of 'group_contours_by_distance()', working on points (e.g. contour centers).
 
-    # We will sort them into groups
+    :param points: Numpy array of shape (N, 2).
+    :param n: Max number of close points to retrieve one at a time.
+    :return: List of groups. Each group is a list of point indices.
+    """
+    available = np.ones(len(points), dtype=bool)
     groups = []
-    holes = list(contours)
 
-    while len(holes) > 0:
-        root = holes.pop(0)
-        close_contours, rest = closest_transitive_contours(root, holes, n)
+    while available.any():
+        root = np.flatnonzero(available)[0]
+        available[root] = False
 
-        group = []
-        group.append(root)
-        group.extend(close_contours)
+        close_points, rest = closest_transitive_points(points[root], points, n, available)
+
+        group = [root]
+        group.extend(close_points)
 
         groups.append(group)
-        holes = rest
 
     return groups
 
 
+@instrumented
+def group_contours_by_distance(contours, n=1):
+    """
+    This method groups the contours into individual groups based on average distance to each other.
+
+    A group consists of contours that are close to each other by transitive relationship.
+    Their distances are nearly the same.
+
+    The contour centers are computed once, grouping runs on them (see 'group_points_by_distance()').
+    You can also vary the parameter 'n' to find results, that suit you need better.
+    For more details, check out doc of 'closest_transitive_contours()'.
+
+    :param contours: List of all contours.
+    :param n: Max number of close contours to retrieve one at a time.
+    :return: List of groups. Each group is a list of contours.
+    """
+    groups = group_points_by_distance(contours_centers(contours), n)
+
+    return [[contours[i] for i in group] for group in groups]
+
+
 def contour_top(contour):
     """
     Finds most top point of given contour.
@@ -349,6 +619,9 @@ def contour_top(contour):
     :param contour: Contour.
     :return: Top point (x, y) as numpy array.
     """
+    if isinstance(contour, SprocketHole):
+        return contour.top
+
     return contour[contour[:, :, 1].argmin()][0]
 
 
@@ -359,6 +632,9 @@ def contour_bottom(contour):
     :param contour: Contour.
     :return: Bottom point (x, y).
     """
+    if isinstance(contour, SprocketHole):
+        return contour.bottom
+
     return contour[contour[:, :, 1].argmax()][0]
 
 
@@ -369,6 +645,9 @@ def contour_left(contour):
     :param contour: Contour.
     :return: Left point (x, y).
     """
+    if isinstance(contour, SprocketHole):
+        return contour.left
+
     return contour[contour[:, :, 0].argmin()][0]
 
 
@@ -379,9 +658,138 @@ def contour_right(contour):
     :param contour: Contour.
     :return: Right point (x, y).
     """
+    if isinstance(contour, SprocketHole):
+        return contour.right
+
     return contour[contour[:, :, 0].argmax()][0]
 
 
+def pack_contours(contours):
+    """
+    Concatenates contours into one points array plus offsets (CSR layout), so the 'packed_*'
+    helpers compute a feature of every contour in one vectorized call.
+
+    Contour i consists of points[offsets[i]:offsets[i+1]].
+
+    :param contours: Non empty contours or sprocket holes.
+    :return: Tuple (points, offsets). points is an int32 array of shape (M, 2), offsets an
+        int64 array of length N+1.
+    """
+    arrays = [contour_array(contour).reshape((-1, 2)) for contour in contours]
+
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(array) for array in arrays], out=offsets[1:])
+
+    if len(arrays) == 0:
+        return np.empty((0, 2), dtype=np.int32), offsets
+
+    return np.concatenate(arrays).astype(np.int32, copy=False), offsets
+
+
+def _segment_ids(offsets):
+    # Contour index of every point
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _segment_arg_extreme(values, offsets, ufunc, segment_ids):
+    # Index of the first minimum/maximum of every segment, like argmin/argmax per contour
+    starts = offsets[:-1]
+    extremes = ufunc.reduceat(values, starts)
+    hits = np.flatnonzero(values == extremes[segment_ids])
+
+    return hits[np.searchsorted(hits, starts)]
+
+
+def packed_contours_extremes(points, offsets):
+    """
+    Finds the extreme points of all packed contours, see 'contour_top()' and the like.
+
+    Like those, the first point is taken if several points are equally extreme.
+
+    :param points: Points, see 'pack_contours()'.
+    :param offsets: Offsets, see 'pack_contours()'.
+    :return: Tuple (tops, bottoms, lefts, rights), arrays of shape (N, 2).
+    """
+    segment_ids = _segment_ids(offsets)
+    (x, y) = (points[:, 0], points[:, 1])
+
+    return (
+        points[_segment_arg_extreme(y, offsets, np.minimum, segment_ids)],
+        points[_segment_arg_extreme(y, offsets, np.maximum, segment_ids)],
+        points[_segment_arg_extreme(x, offsets, np.minimum, segment_ids)],
+        points[_segment_arg_extreme(x, offsets, np.maximum, segment_ids)]
+    )
+
+
+def packed_contours_moments(points, offsets):
+    """
+    Computes area and center of all packed contours from the polygon moments, like cv2.moments
+    does for a single contour (see 'contour_center()').
+
+    :param points: Points, see 'pack_contours()'.
+    :param offsets: Offsets, see 'pack_contours()'.
+    :return: Tuple (areas, centers). areas has shape (N,), centers shape (N, 2). Contours
+        without area get the center nan.
+    """
+    starts = offsets[:-1]
+
+    # Following point of every point, the last point of a contour is followed by its first
+    following = np.arange(1, len(points) + 1)
+    following[offsets[1:] - 1] = starts
+
+    (x, y) = (points[:, 0].astype(np.float64), points[:, 1].astype(np.float64))
+    (xn, yn) = (x[following], y[following])
+
+    cross = x * yn - xn * y
+
+    m00 = np.add.reduceat(cross, starts) / 2
+    m10 = np.add.reduceat((x + xn) * cross, starts) / 6
+    m01 = np.add.reduceat((y + yn) * cross, starts) / 6
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centers = np.stack([m10 / m00, m01 / m00], axis=1)
+
+    return np.abs(m00), centers
+
+
+def packed_fit_lines(points, offsets):
+    """
+    Fits one line per packed point set by least squares of the perpendicular distances, see
+    'fit_line()'. E.g. the top lines of the sprocket holes of many strips at once.
+
+    :param points: Points of shape (M, 2), ordered within every set.
+    :param offsets: Offsets of the sets, see 'pack_contours()'. Every set needs two distinct points.
+    :return: Tuple (lines, angles). lines is a list of lines, see 'points_to_line()', angles an
+        array of the angles, see 'line_angle()'.
+    """
+    starts = offsets[:-1]
+    counts = np.diff(offsets)
+    segment_ids = _segment_ids(offsets)
+
+    points = np.asarray(points, dtype=np.float64)
+    centers = np.add.reduceat(points, starts) / counts[:, np.newaxis]
+    centered = points - centers[segment_ids]
+
+    sxx = np.add.reduceat(centered[:, 0] ** 2, starts)
+    syy = np.add.reduceat(centered[:, 1] ** 2, starts)
+    sxy = np.add.reduceat(centered[:, 0] * centered[:, 1], starts)
+
+    # Principal axis of the 2x2 scatter matrix in closed form
+    axis_angles = _wrap_line_angle(0.5 * np.arctan2(2 * sxy, sxx - syy))
+
+    lines = []
+    for (i, angle) in enumerate(axis_angles):
+        if math.isclose(abs(angle), math.pi / 2, abs_tol=line_vertical_tolerance):
+            # Direction like 'fit_line()': first to last point of the set
+            top_to_bottom = points[offsets[i + 1] - 1][1] - points[starts[i]][1] >= 0
+            lines.append((math.inf if top_to_bottom else -math.inf, float(centers[i][0])))
+        else:
+            gradient = math.tan(angle)
+            lines.append((gradient, float(centers[i][1] - centers[i][0] * gradient)))
+
+    return lines, np.array([line_angle(line) for line in lines])
+
+
 def contours_center_line(contours):
     """
     Computes for each contour the center and uses the center points to create
@@ -394,6 +802,31 @@ def contours_center_line(contours):
     return points_to_line(centers)
 
 
+def contours_extremes(contours):
+    """
+    Finds the extreme points of all contours, see 'contour_top()' and the like. Sprocket
+    holes have them already, plain contours are packed and handled at once
+    (see 'packed_contours_extremes()').
+
+    :param contours: Non empty list of contours or sprocket holes.
+    :return: Tuple (tops, bottoms, lefts, rights), arrays of shape (N, 2).
+    """
+    if all(isinstance(contour, SprocketHole) for contour in contours):
+        return tuple(
+            np.array([getattr(hole, name) for hole in contours]) for name in ('top', 'bottom', 'left', 'right')
+        )
+
+    return packed_contours_extremes(*pack_contours(contours))
+
+
+def _points_to_line_packed(points):
+    # Least squares line like 'points_to_line()', as single set of 'packed_fit_lines()'
+    assert len(points) > 1, "Need at least two points"
+
+    (lines, _) = packed_fit_lines(points, np.array([0, len(points)]))
+    return lines[0]
+
+
 def contours_top_line(contours):
     """
     Creates line that runs along the top side of all contours.
@@ -403,8 +836,8 @@ def contours_top_line(contours):
     :param contours: Contours.
     :return: Line (gradient, y displacement).
     """
-    tops = list(map(lambda cnt: contour_top(cnt), contours))
-    return points_to_line(tops)
+    (tops, _, _, _) = contours_extremes(contours)
+    return _points_to_line_packed(tops)
 
 
 def contours_bottom_line(contours):
@@ -416,8 +849,8 @@ def contours_bottom_line(contours):
     :param contours: Contours.
     :return: Line (gradient, y displacement).
     """
-    bottoms = list(map(lambda cnt: contour_bottom(cnt), contours))
-    return points_to_line(bottoms)
+    (_, bottoms, _, _) = contours_extremes(contours)
+    return _points_to_line_packed(bottoms)
 
 
 def most_left_contour(contours):
@@ -425,19 +858,13 @@ def most_left_contour(contours):
     Searches the contour which has the most extreme left point.
 
     :param contours: Contours.
-    :return: Most extreme contour.
+    :return: Most extreme contour, the first one if several are equal. None if there are no contours.
     """
+    if len(contours) == 0:
+        return None
 
-    min_x = math.inf
-    left = None
-    for contour in contours:
-        cl = contour_left(contour)[0]
-
-        if cl < min_x:
-            left = contour
-            min_x = cl
-
-    return left
+    (_, _, lefts, _) = contours_extremes(contours)
+    return contours[int(np.argmin(lefts[:, 0]))]
 
 
 def most_right_contour(contours):
@@ -445,37 +872,48 @@ def most_right_contour(contours):
     Searches the contour which has the most extreme right point.
 
     :param contours: Contours.
-    :return: Most extreme contour.
+    :return: Most extreme contour, the first one if several are equal. None if there are no contours.
     """
+    if len(contours) == 0:
+        return None
 
-    max_x = -math.inf
-    right = None
-    for contour in contours:
-        cr = contour_right(contour)[0]
-
-        if cr > max_x:
-            right = contour
-            max_x = cr
+    (_, _, _, rights) = contours_extremes(contours)
+    return contours[int(np.argmax(rights[:, 0]))]
 
-    return right
 
-
-def get_k_colors(img, k):
+@instrumented
+def get_k_colors(img, k, max_samples=None):
     """
     Returns k most dominant colors via k-means algorithm.
 
+    Only a regular grid of at most 'max_samples' pixels is used. Instead of random
+    centers, k-means starts with the samples split into k equally sized groups by
+    brightness. By that the result is the same on every run.
+
     Handles any color depth.
 
     :param img: Image to retrieve k colors from.
     :param k: Number of colors.
+    :param max_samples: Max number of pixels used, defaults to 'k_colors_max_samples'.
     :return: List of colors. Colors are numpy arrays..
     """
-    data = img.reshape((-1, 3))
+    if max_samples is None:
+        max_samples = k_colors_max_samples
 
+    (h, w) = img.shape[:2]
+    step = max(1, int(math.ceil(math.sqrt(h * w / max_samples))))
+
+    # Slicing keeps a view, only the samples get copied
+    data = img[::step, ::step].reshape((-1, 3))
     data = np.float32(data)
+
+    brightness_order = np.argsort(data.sum(axis=1), kind='stable')
+    labels = np.empty((len(data), 1), dtype=np.int32)
+    labels[brightness_order, 0] = np.arange(len(data)) * k // len(data)
+
     iterations = 10
     criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 1.0)
-    ret, label, center = cv2.kmeans(data, k, None, criteria, iterations, cv2.KMEANS_RANDOM_CENTERS)
+    ret, label, center = cv2.kmeans(data, k, labels, criteria, 1, cv2.KMEANS_USE_INITIAL_LABELS)
 
     return list(map(lambda col: np.array([col[0], col[1], col[2]], dtype=img.dtype), center))
 
@@ -487,22 +925,11 @@ def sort_colors_by_brightness(colors):
     :param colors: List of 3 value arrays/tuples.
     :return: Colors sorted by brightness ascending.
     """
-    def color_weight(col):
-        f_col = np.float32(col)
-        return f_col[0] + f_col[1] + f_col[2]
-
-    col_and_avgs = list(
-        map(
-            lambda col: (col, color_weight(col)),  # We just need it for sorting, so no /3 needed
-            colors
-        )
-    )
-
-    # Sort by average value (gray value)
-    sorted_cols = sorted(col_and_avgs, key=lambda tup: tup[1])
+    # We just need it for sorting, so no /3 needed
+    weights = np.float32(np.array(colors, dtype=np.float64).reshape((-1, 3))).sum(axis=1, dtype=np.float32)
 
-    # Return only colors
-    return list(map(lambda tup: tup[0], sorted_cols))
+    # Stable, equally bright colors keep their order
+    return [colors[i] for i in np.argsort(weights, kind='stable')]
 
 
 def calc_white_balance_diff(color):
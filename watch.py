@@ -0,0 +1,296 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from batch import input_extensions, output_path_for, process_negative_file, _init_worker
+from tiff import is_tiff_complete
+
+# Without close events (polling, or files present at start), a file is processed once its size
+# and modification time did not change for this long (seconds) and its TIFF structure is complete
+watch_debounce = 0.2
+
+# Rescan interval of the polling fallback (seconds)
+watch_poll_interval = 0.5
+
+# inotify events, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+_inotify_event = struct.Struct('iIII')
+
+
+class _InotifyWatcher(object):
+    # Reports names of files written or moved into a directory and whether they were closed, Linux only
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed for {}".format(path))
+
+    def wait(self, timeout):
+        """
+        :param timeout: Seconds to wait for events at most.
+        :return: Dict file name -> True if the last event was closing after writing or moving in.
+        """
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return {}
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return {}
+
+        names = {}
+        offset = 0
+        while offset + _inotify_event.size <= len(data):
+            (wd, mask, cookie, length) = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            # Events are in order, writing again after closing opens the file again
+            if name:
+                names[os.fsdecode(name)] = (mask & (IN_CLOSE_WRITE | IN_MOVED_TO)) != 0
+
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PollingWatcher(object):
+    # Reports names of new or changed files by rescanning the directory
+
+    def __init__(self, path):
+        self.path = path
+        self.state = self._scan()
+
+    def _scan(self):
+        state = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                state[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+        return state
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, watch_poll_interval))
+
+        state = self._scan()
+        names = {name: None for (name, value) in state.items() if self.state.get(name) != value}
+        self.state = state
+
+        return names
+
+    def close(self):
+        pass
+
+
+def create_watcher(path, poll=False):
+    """
+    :param path: Directory to watch.
+    :param poll: If True, the directory is polled even if inotify is available.
+    :return: Watcher with close() and wait(timeout), which returns a dict of changed files: name ->
+        True if closed after writing, False if still written, None if unknown (polling).
+    """
+    if not poll:
+        try:
+            return _InotifyWatcher(path)
+        except (OSError, AttributeError):
+            # No inotify (not Linux, or no watches left)
+            pass
+
+    return _PollingWatcher(path)
+
+
+def needs_processing(in_path, out_dir):
+    """
+    :param in_path: Path of negative.
+    :param out_dir: Output directory.
+    :return: True if there is no positive yet or the negative is newer.
+    """
+    out_path = output_path_for(in_path, out_dir)
+
+    try:
+        return os.stat(out_path).st_mtime < os.stat(in_path).st_mtime
+    except FileNotFoundError:
+        return True
+
+
+def _init_watch_worker():
+    _init_worker()
+
+    # Ctrl+C stops watching in the main process, started files are finished
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _warm_up():
+    # Runs once per worker: imports are done by unpickling, the pool spawns all workers now
+    return os.getpid()
+
+
+def watch(in_dir, out_dir, workers=None, poll=False, debounce=None, on_done=None, should_stop=None):
+    """
+    Watches a directory for new negatives (e.g. the hot folder of a scanner) and processes them
+    like 'batch.run_batch()' until stopped.
+
+    With inotify, files are processed once they were closed after writing or moved into the
+    directory. Otherwise (polling, or files present at start) once their size and modification
+    time were stable for the debounce time. In both cases the TIFF structure must be complete
+    (see 'is_tiff_complete()'), so scanners pausing while writing do not lead to partly read
+    scans: incomplete files wait for the next change. A file changed while it was processed is
+    processed again, its first result is not reported. Negatives already in the directory
+    without positive are processed at start. The worker processes are started and have imported
+    OpenCV and numpy before watching begins, so the first scan does not pay for it.
+
+    Latency is the time from the last modification of the negative until its positive is written.
+
+    Ctrl+C (KeyboardInterrupt) ends watching like should_stop, files already started are finished.
+
+    Like 'batch.run_batch()', a file whose worker raised (or died, e.g. out of memory) is reported
+    as failed and watching goes on. A broken worker pool is started again.
+
+    :param in_dir: Watched directory.
+    :param out_dir: Directory for positives, must differ from in_dir. Will be created if missing.
+    :param workers: Number of worker processes, defaults to the number of cores.
+    :param poll: If True, the directory is polled instead of using inotify.
+    :param debounce: Seconds a file without close event must be unchanged, defaults to 'watch_debounce'.
+    :param on_done: Optional callback(in_path, error, latency, processing_time) for every finished file.
+    :param should_stop: Optional callable, watching ends as soon as it returns True.
+    :return: List of tuples (in_path, error, latency, processing_time) of all finished files.
+    """
+    assert os.path.realpath(in_dir) != os.path.realpath(out_dir), "Output directory must differ from watched one"
+    os.makedirs(out_dir, exist_ok=True)
+
+    debounce = watch_debounce if debounce is None else debounce
+    workers = workers or os.cpu_count() or 1
+
+    # path -> ((size, mtime) of the last check, time it was seen unchanged first, closed), see 'create_watcher()'
+    pending = {}
+    # future -> (path, (size, mtime) when submitted, submit time)
+    running = {}
+    results = []
+
+    def add(name, closed=None):
+        path = os.path.join(in_dir, name)
+        if name.lower().endswith(input_extensions) and '.part' not in name and \
+                path not in (job[0] for job in running.values()):
+            pending[path] = (None, 0, closed)
+
+    def file_state(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def start_executor():
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_watch_worker)
+        wait([executor.submit(_warm_up) for i in range(0, workers)])
+        return executor
+
+    def finish(future):
+        (path, state, t_submit) = running.pop(future)
+        try:
+            (in_path, error, records) = future.result()
+        except Exception:
+            (in_path, error) = (path, traceback.format_exc())
+        t_done = time.time()
+
+        # Changed while processed (e.g. read while a scanner still wrote it): the result is outdated
+        try:
+            if file_state(path) != state:
+                pending[path] = (None, 0, None)
+                return
+        except FileNotFoundError:
+            pass
+
+        result = (in_path, error, t_done - state[1] / 1e9, t_done - t_submit)
+        results.append(result)
+
+        if on_done is not None:
+            on_done(*result)
+
+    watcher = create_watcher(in_dir, poll)
+    executor = start_executor()
+
+    try:
+        for name in sorted(os.listdir(in_dir)):
+            if needs_processing(os.path.join(in_dir, name), out_dir):
+                add(name)
+
+        try:
+            while should_stop is None or not should_stop():
+                # Short waits while files are pending or running, so they are picked up quickly
+                timeout = debounce / 2 if pending or running else watch_poll_interval
+                for (name, closed) in watcher.wait(timeout).items():
+                    add(name, closed)
+
+                now = time.time()
+                for (path, (last_state, stable_since, closed)) in list(pending.items()):
+                    try:
+                        state = file_state(path)
+                    except FileNotFoundError:
+                        del pending[path]
+                        continue
+
+                    if closed is None:
+                        if state != last_state:
+                            pending[path] = (state, now, closed)
+                            continue
+                        if now - stable_since < debounce:
+                            continue
+                    elif not closed:
+                        # Written right now, waiting for the close event
+                        continue
+
+                    # Incomplete files are dropped, the watcher reports them again once written further
+                    del pending[path]
+                    if not is_tiff_complete(path):
+                        continue
+
+                    job = (process_negative_file, path, output_path_for(path, out_dir))
+                    try:
+                        future = executor.submit(*job)
+                    except BrokenProcessPool:
+                        # A worker died, the files it ran are reported as failed by 'finish()'
+                        executor.shutdown()
+                        executor = start_executor()
+                        future = executor.submit(*job)
+                    running[future] = (path, state, time.time())
+
+                if running:
+                    (done, _) = wait(list(running), timeout=0, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+        for future in list(running):
+            finish(future)
+    finally:
+        executor.shutdown()
+
+    return results